@@ -1,38 +1,33 @@
 from collections import defaultdict
-from datetime import datetime
 
 import pandas as pd
 from ibapi.client import EClient
 from ibapi.contract import Contract
 from ibapi.wrapper import EWrapper
 
-from back_test.settings import TZ, logger
+from back_test.settings import logger
+from trading_bot.clients.history_buffer import HistoryBuffer
 
 
 class IBapi(EWrapper, EClient):
     def __init__(self):
         EClient.__init__(self, self)
-        self.data = defaultdict(list)
+        self.data = dict()
         self.extended_hours_data = True
         self.time_frame = '1 min'
         self.data_frames = defaultdict(pd.DataFrame)
 
     def historicalData(self, reqId, bar):
         # print(reqId, datetime.fromtimestamp(int(bar.date)), bar.open, bar.high, bar.low, bar.close)
-        data = {'datetime': bar.date, 'open': bar.open, 'high': bar.high, 'low': bar.low, 'close': bar.close,
-                'volume': bar.volume}
-        self.data[reqId].append(data)
+        history = self.data.get(reqId)
+        if history is None:
+            history = self.data[reqId] = HistoryBuffer()
+        history.append(bar)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
         # super().historicalDataEnd(reqId, start, end)
         # print("HistoricalDataEnd. ReqId:", reqId, "from", start, "to", end)
-        df = pd.DataFrame(self.data[reqId])
-        del self.data[reqId]
-        if self.time_frame in ['1 day']:
-            df['datetime'] = pd.to_datetime(df['datetime']).dt.tz_localize(TZ)
-        else:
-            df['datetime'] = df['datetime'].apply(lambda x: datetime.fromtimestamp(int(x)).astimezone(TZ))
-        df = df.set_index('datetime')
+        df = self.data.pop(reqId, HistoryBuffer()).frame(self.time_frame in ['1 day'])
         if not self.extended_hours_data:
             df = df.between_time('09:30', '15:59')
         self.data_frames[reqId] = df
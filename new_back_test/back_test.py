@@ -58,9 +58,11 @@ class BackTest:
         df['signal'] = np.select(conditions, choices, default=np.nan)
 
     def run(self):
-        while not len(self.client.data_frames[self.unique_id]):
-            pass
+        self.client.readiness.wait_history(self.unique_id)
         df = self.client.data_frames[self.unique_id]
+        if not len(df):
+            logger.debug(f'{self.symbol}: No historical data received, skipping')
+            return
         self.strategy_super_trend(df)
         logger.info(f'{self.symbol}: Data fetched, Running back test')
         start_point = max(self.st_period, self.ema_period) * 5
@@ -1,43 +1,61 @@
 from collections import defaultdict
 
 import pandas as pd
-from dateutil.parser import parse
 from ibapi.client import EClient
 from ibapi.contract import Contract
 from ibapi.wrapper import EWrapper
 
-from new_back_test.settings import TZ, logger
+from new_back_test.settings import logger
+from trading_bot.clients.history_buffer import HistoryBuffer
+from trading_bot.clients.history_scheduler import HistoricalDataScheduler
+from trading_bot.clients.readiness import Readiness, CONNECTED, NEXT_VALID_ID
 
 
 class IBapi(EWrapper, EClient):
     def __init__(self):
         EClient.__init__(self, self)
-        self.data = defaultdict(list)
+        self.data = dict()
         self.time_frame = '1 min'
         self.data_frames = defaultdict(pd.DataFrame)
+        self.history_scheduler = HistoricalDataScheduler(self, logger=logger)
+        self.readiness = Readiness()
+
+    def connectAck(self):
+        super().connectAck()
+        self.readiness.set(CONNECTED)
+
+    def wait_ready(self, timeout=30):
+        if self.readiness.wait(CONNECTED, NEXT_VALID_ID, timeout=timeout):
+            return True
+        logger.error(f'TWS not ready after {timeout} seconds, waiting for: '
+                     f'{self.readiness.pending(CONNECTED, NEXT_VALID_ID)}')
+        return False
 
     def historicalData(self, reqId, bar):
-        data = {'datetime': bar.date, 'open': bar.open, 'high': bar.high, 'low': bar.low, 'close': bar.close,
-                'volume': bar.volume}
-        self.data[reqId].append(data)
+        history = self.data.get(reqId)
+        if history is None:
+            history = self.data[reqId] = HistoryBuffer()
+        history.append(bar)
 
     def historicalDataEnd(self, reqId: int, start: str, end: str):
-        df = pd.DataFrame(self.data[reqId])
-        del self.data[reqId]
-        if self.time_frame in ['1 day']:
-            df['datetime'] = pd.to_datetime(df['datetime']).dt.tz_localize(TZ)
-        else:
-            df['datetime'] = df['datetime'].apply(lambda x: parse(x).astimezone(TZ))
-        df = df.set_index('datetime')
+        df = self.data.pop(reqId, HistoryBuffer()).frame(self.time_frame in ['1 day'])
         self.data_frames[reqId] = df
+        self.history_scheduler.on_end(reqId)
+        self.readiness.set_history(reqId)
         logger.debug(f'{reqId}: Historical Data fetched for id: {reqId}')
 
     def nextValidId(self, orderId: int):
         super().nextValidId(orderId)
         self.nextorderId = orderId
+        self.readiness.set(NEXT_VALID_ID)
         logger.info(f'The next valid order id is: {self.nextorderId}')
 
     def error(self, reqId, errorCode, errorString):
+        if self.history_scheduler.on_error(reqId, errorCode, errorString):
+            if reqId not in self.history_scheduler.pending:
+                # Dropped for good, wake whoever waits on its data
+                self.readiness.set_history(reqId)
+            return
         logger.debug(f'Error: {errorCode}, {errorString}')
 
     @staticmethod
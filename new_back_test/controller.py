@@ -1,5 +1,4 @@
 import threading
-import time
 import os
 import signal
 from datetime import datetime
@@ -12,6 +11,7 @@ from new_back_test.clients.ib import IBapi
 from new_back_test.back_test import BackTest
 from new_back_test.settings import RECORDS_DIR, logger, TZ
 from new_back_test.utils import calc_columns, calc_metrics
+from trading_bot.clients.history_scheduler import PRIORITY_BULK
 
 
 class Controller:
@@ -64,7 +64,8 @@ def run(account_mode, symbols, stop_loss, trailing_stop_loss, st_period, st_mult
     client.connect('127.0.0.1', socket_port, 123)
     client_thread = threading.Thread(target=client.run, daemon=True)
     client_thread.start()
-    time.sleep(3)
+    if not client.wait_ready():
+        return
 
     client.nextorderId += 1
     duration = f'{days} D'
@@ -74,8 +75,8 @@ def run(account_mode, symbols, stop_loss, trailing_stop_loss, st_period, st_mult
 
     for i, s in enumerate(symbols, start=client.nextorderId):
         contract = client.make_contract(s, 'STK', 'SMART', 'ISLAND')
-        client.reqHistoricalData(i, contract, end_date, duration, time_frame, what_type,
-                                 int(only_regular_session_data), 1, False, [])
+        client.history_scheduler.request(i, contract, end_date, duration, time_frame, what_type,
+                                         int(only_regular_session_data), 2, False, priority=PRIORITY_BULK)
 
         bt_instances.append(BackTest(client=client, unique_id=i, symbol=s, stop_loss=stop_loss,
                                      trailing_stop_loss=trailing_stop_loss, pos_limit=pos_limit,
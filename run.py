@@ -1,6 +1,4 @@
 import json
-from threading import Thread
-from time import sleep
 
 import uvicorn
 from fastapi import FastAPI
@@ -18,18 +16,14 @@ ORDER_TYPE = 'LMT'   # Choices LMT, MKT. LMT for limit order and MKT for market
 app = FastAPI()
 client = IBapi()
 socket_port = 7497 if TRADING_MODE.lower() == 'paper' else 7496
-client.connect('127.0.0.1', socket_port, 123)
-client_thread = Thread(target=client.run, daemon=True)
-client_thread.start()
+client.start('127.0.0.1', socket_port, 123)
+client.wait_ready()
 client.reqPositions()
-client.reqAccountSummary(9002, "All", "$LEDGER")
+client.reqAccountUpdates(True, '')
 client.reqAllOpenOrders()
-client.reqExecutions(10001, ExecutionFilter())
+client.reqExecutions(client.next_req_id(), ExecutionFilter())
 
-# while not client.total_amount:
-#     pass
-
-sleep(1)
+client.wait_account()
 logger.info('Trading bot server started, running...')
 
 
@@ -59,8 +53,8 @@ async def trigger_trade(params: Params):
         return {'error': 'Invalid price', 'msg': 'price must be greater than 0 and less than position_size'}
 
     logger.debug('Parameters validated, making trade...')
-    unique_id = client.nextorderId
-    contract = client.make_contract(symbol, 'STK', 'SMART', 'ISLAND')
+    unique_id = client.next_req_id()
+    contract = client.get_contract(symbol)
 
     # Initialize Trading bot
     trading_bot = TvTradeManager(client, unique_id=unique_id, trading_mode=TRADING_MODE,
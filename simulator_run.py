@@ -0,0 +1,37 @@
+#  Parameters  #
+
+# Port to listen on, 7497 stands in for paper TWS and 7496 for live so controllers run against it unchanged
+port = 7497
+
+# Symbols returned by scanner subscriptions
+scanner_symbols = ['AAPL', 'MSFT', 'AMZN', 'TSLA', 'NVDA', 'AMD', 'META', 'NFLX', 'GOOGL', 'INTC']
+
+# Positions held at start, i.e. {symbol: (quantity, average cost)}
+positions = {}
+
+cash = 100000  # Account cash balance
+
+# Folder with recorded bars as <SYMBOL>.csv files with datetime, open, high, low, close, volume columns.
+# Symbols without a file get random walk prices, None to use random walk for every symbol
+data_dir = None
+
+start_price = 50  # Starting price of random walk symbols
+volatility = 0.0005  # Standard deviation of the random walk per tick
+
+# Load, every tick_interval seconds each streamed symbol prints ticks_per_step trades and updates its depth
+tick_interval = 0.1
+ticks_per_step = 1
+
+bar_update_interval = 5  # Seconds between keepUpToDate bar updates
+scanner_interval = 30  # Seconds between scanner result updates
+
+ack_latency = 0.05  # Seconds before an order is acknowledged
+fill_latency = 0.1  # Seconds between an order becoming marketable and its fill
+
+#  Parameters End  #
+
+if __name__ == '__main__':
+    kwargs = {i: j for i, j in locals().items() if not i.startswith('__')}
+    from trading_bot.clients.tws_simulator import run
+
+    run(**kwargs)
@@ -0,0 +1,73 @@
+import threading
+
+from trading_bot.settings import logger
+
+# Account values kept from the account updates stream, by the attribute they are read through
+ACCOUNT_KEYS = {'TotalCashBalance': 'cash', 'BuyingPower': 'buying_power', 'NetLiquidation': 'net_liquidation',
+                'AvailableFunds': 'available_funds', 'UnrealizedPnL': 'unrealized_pnl', 'RealizedPnL': 'realized_pnl'}
+CURRENCIES = ('USD', 'BASE')
+
+
+class AccountBook:
+    """
+    Account values and per position P&L kept current by one long lived account updates subscription, so sizing
+    reads them from memory instead of requesting the account summary again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = dict()
+        self.portfolio = dict()
+        self.update_time = None
+
+    def update_value(self, key, value, currency):
+        if key not in ACCOUNT_KEYS or currency not in CURRENCIES:
+            return
+        try:
+            value = float(value)
+        except ValueError:
+            logger.debug(f'Ignoring account value {key}: {value}')
+            return
+        with self.lock:
+            self.values[(key, currency)] = value
+
+    def value(self, key, default=0.0):
+        # USD when TWS sent it, the base currency total otherwise
+        for currency in CURRENCIES:
+            value = self.values.get((key, currency))
+            if value is not None:
+                return value
+        return default
+
+    @property
+    def cash(self):
+        return self.value('TotalCashBalance')
+
+    @property
+    def buying_power(self):
+        return self.value('BuyingPower')
+
+    @property
+    def net_liquidation(self):
+        return self.value('NetLiquidation')
+
+    @property
+    def available_funds(self):
+        return self.value('AvailableFunds')
+
+    @property
+    def unrealized_pnl(self):
+        return self.value('UnrealizedPnL')
+
+    @property
+    def realized_pnl(self):
+        return self.value('RealizedPnL')
+
+    def update_portfolio(self, symbol, position, market_price, market_value, avg_cost, unrealized_pnl, realized_pnl):
+        with self.lock:
+            self.portfolio[symbol] = {'symbol': symbol, 'position': position, 'market_price': market_price,
+                                      'market_value': market_value, 'avg_cost': avg_cost,
+                                      'unrealized_pnl': unrealized_pnl, 'realized_pnl': realized_pnl}
+
+    def pnl(self, symbol):
+        return self.portfolio.get(symbol)
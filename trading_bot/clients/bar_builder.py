@@ -0,0 +1,132 @@
+import threading
+
+from trading_bot.clients.history_buffer import last_session
+from trading_bot.clients.history_scheduler import PRIORITY_CANDIDATE, PRIORITY_POSITION
+from trading_bot.settings import logger
+
+TICKS, REAL_TIME_BARS = 'ticks', 'real_time_bars'
+# Seed request per bar interval in seconds: duration and bar size
+SEED_BARS = {1: ('1800 S', '1 secs'), 5: ('7200 S', '5 secs'), 60: ('2 D', '1 min')}
+REAL_TIME_BAR_SECONDS = 5
+
+
+class BuildRequest:
+    def __init__(self, contract, interval, source):
+        self.contract = contract
+        self.interval = interval
+        self.source = source
+        self.seed_id = None
+        self.seeded = False
+        self.first_time = None
+        self.bar = None
+        self.pending = []
+
+
+class BarBuilder:
+    """
+    Rolls tick-by-tick trades or 5 second real time bars into OHLCV bars of interval seconds in the bar store, so
+    live bars need one small historical seed request per symbol instead of a keepUpToDate subscription. Bars built
+    before the seed arrives are held back and written after it, seed bars from the first built bar on are dropped.
+    """
+
+    def __init__(self, client, bar_store):
+        self.client = client
+        self.bar_store = bar_store
+        self.lock = threading.Lock()
+        self.requests = dict()
+        self.seeds = dict()
+
+    def __contains__(self, req_id):
+        return req_id in self.requests
+
+    def is_seed(self, req_id):
+        return req_id in self.seeds
+
+    def start(self, req_id, contract, interval=60, source=TICKS, priority=PRIORITY_CANDIDATE):
+        if interval not in SEED_BARS or source == REAL_TIME_BARS and interval % REAL_TIME_BAR_SECONDS:
+            raise ValueError(f'Cannot build {interval} second bars from {source}')
+        with self.lock:
+            self.requests[req_id] = BuildRequest(contract, interval, source)
+        self.request_seed(req_id, priority)
+        if source == TICKS:
+            self.client.reqTickByTickData(req_id, contract, 'AllLast', 0, False)
+        else:
+            self.client.reqRealTimeBars(req_id, contract, REAL_TIME_BAR_SECONDS, 'TRADES', False, [])
+
+    def request_seed(self, req_id, priority=PRIORITY_POSITION):
+        # Also after a reconnect, bars missed meanwhile come with the new seed
+        with self.lock:
+            request = self.requests.get(req_id)
+            if request is None:
+                return
+            self.seeds.pop(request.seed_id, None)
+            request.seed_id = self.client.next_req_id()
+            request.seeded, request.first_time, request.bar, request.pending = False, None, None, []
+            self.seeds[request.seed_id] = req_id
+        duration, bar_size = SEED_BARS[request.interval]
+        self.client.history_scheduler.request(request.seed_id, request.contract, '', duration, bar_size, 'TRADES', 0,
+                                              2, False, priority=priority)
+
+    def seed(self, seed_id, history, extended_hours=True):
+        with self.lock:
+            req_id = self.seeds.pop(seed_id, None)
+            request = self.requests.get(req_id)
+            if request is None or request.seed_id != seed_id:
+                return
+            times, columns = last_session(history, extended_hours=extended_hours)
+            if request.first_time is not None:
+                keep = times < request.first_time
+                times, columns = times[keep], {f: c[keep] for f, c in columns.items()}
+            self.bar_store.load(req_id, times, columns)
+            request.seeded = True
+            for bar in request.pending + ([request.bar] if request.bar is not None else []):
+                self.bar_store.update(req_id, *bar)
+            request.pending = []
+        logger.debug(f'{req_id}: Seeded {len(times)} bars for {request.contract.symbol}')
+
+    def on_tick(self, req_id, time, price, size):
+        request = self.requests.get(req_id)
+        if request is not None:
+            with self.lock:
+                self._add(req_id, request, time, price, price, price, price, size)
+
+    def on_bar(self, req_id, time, open_, high, low, close, volume):
+        request = self.requests.get(req_id)
+        if request is not None:
+            with self.lock:
+                self._add(req_id, request, time, open_, high, low, close, volume)
+
+    def _add(self, req_id, request, time, open_, high, low, close, volume):
+        bucket = time - time % request.interval
+        bar = request.bar
+        if bar is not None and bucket < bar[0]:
+            return
+        if bar is None or bucket > bar[0]:
+            if bar is not None and not request.seeded:
+                request.pending.append(bar)
+            if request.first_time is None:
+                request.first_time = bucket
+            last = self.bar_store.get(req_id).last() if request.seeded and req_id in self.bar_store else None
+            if last is not None and last[0] == bucket:
+                # Same interval as the last seed bar, carry on from it
+                bar = [bucket, last[1], max(last[2], high), min(last[3], low), close, last[5] + volume]
+            else:
+                bar = [bucket, open_, high, low, close, volume]
+            request.bar = bar
+        else:
+            bar[2] = max(bar[2], high)
+            bar[3] = min(bar[3], low)
+            bar[4] = close
+            bar[5] += volume
+        if request.seeded:
+            self.bar_store.update(req_id, *bar)
+
+    def release(self, req_id):
+        with self.lock:
+            request = self.requests.pop(req_id, None)
+            if request is None:
+                return
+            self.bar_store.release(req_id)
+            seed_pending = self.seeds.pop(request.seed_id, None) is not None
+        if seed_pending:
+            self.client.history_scheduler.cancel(request.seed_id)
@@ -0,0 +1,172 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from trading_bot.settings import TZ
+
+BAR_FIELDS = ('open', 'high', 'low', 'close', 'volume', 'prev_close')
+
+
+def to_epoch_seconds(index):
+    index = pd.DatetimeIndex(index)
+    if index.tz is None:
+        index = index.tz_localize(TZ)
+    return np.asarray(index.tz_convert('UTC').tz_localize(None), dtype='datetime64[s]').astype('int64')
+
+
+class BarSeries:
+    """
+    Bars of one subscription in preallocated column arrays holding at most capacity bars.
+    Arrays are allocated at twice the capacity, when the tail is reached the last capacity bars are moved to
+    fresh arrays, so appends are amortised O(1), views are always contiguous and views handed out earlier
+    are never overwritten by a later move.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.start = 0
+        self.end = 0
+        self.version = 0
+        self.times, self.columns = self._allocate()
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + sum(c.nbytes for c in self.columns.values())
+
+    def _allocate(self):
+        size = self.capacity * 2
+        return np.zeros(size, dtype='int64'), {f: np.full(size, np.nan) for f in BAR_FIELDS}
+
+    def _compact(self):
+        times, columns = self._allocate()
+        length = self.end - self.start
+        times[:length] = self.times[self.start:self.end]
+        for f in BAR_FIELDS:
+            columns[f][:length] = self.columns[f][self.start:self.end]
+        self.times, self.columns = times, columns
+        self.start, self.end = 0, length
+
+    def load(self, times, columns):
+        times = np.asarray(times, dtype='int64')[-self.capacity:]
+        length = len(times)
+        with self.lock:
+            self.times, self.columns = self._allocate()
+            self.times[:length] = times
+            for f in BAR_FIELDS:
+                if f in columns:
+                    self.columns[f][:length] = np.asarray(columns[f], dtype='float64')[-self.capacity:]
+            self.start, self.end = 0, length
+            self.version += 1
+
+    def update(self, time, open_, high, low, close, volume):
+        with self.lock:
+            if self.end > self.start:
+                last_time = self.times[self.end - 1]
+                if time < last_time:
+                    return
+                if time == last_time:
+                    i = self.end - 1
+                    self.columns['open'][i] = open_
+                    self.columns['high'][i] = high
+                    self.columns['low'][i] = low
+                    self.columns['close'][i] = close
+                    self.columns['volume'][i] = volume
+                    self.version += 1
+                    return
+                prev_close = self.columns['prev_close'][self.end - 1]
+            else:
+                prev_close = np.nan
+
+            if self.end == len(self.times):
+                self._compact()
+            i = self.end
+            self.times[i] = time
+            self.columns['open'][i] = open_
+            self.columns['high'][i] = high
+            self.columns['low'][i] = low
+            self.columns['close'][i] = close
+            self.columns['volume'][i] = volume
+            self.columns['prev_close'][i] = prev_close
+            self.end += 1
+            if self.end - self.start > self.capacity:
+                self.start += 1
+            self.version += 1
+
+    def last(self):
+        # time, open, high, low, close, volume of the last bar
+        with self.lock:
+            if self.end == self.start:
+                return None
+            i = self.end - 1
+            return (int(self.times[i]),) + tuple(float(self.columns[f][i]) for f in BAR_FIELDS[:5])
+
+    def view(self, field):
+        with self.lock:
+            if field == 'time':
+                return self.times[self.start:self.end]
+            return self.columns[field][self.start:self.end]
+
+    def views(self):
+        with self.lock:
+            return self.times[self.start:self.end], {f: self.columns[f][self.start:self.end] for f in BAR_FIELDS}
+
+    def snapshot(self):
+        # Read-only copies, the last bar of a view still changes until the next bar starts
+        with self.lock:
+            times = self.times[self.start:self.end].copy()
+            columns = {f: self.columns[f][self.start:self.end].copy() for f in BAR_FIELDS}
+            version = self.version
+        for array in (times, *columns.values()):
+            array.flags.writeable = False
+        return version, times, columns
+
+    def frame(self):
+        times, columns = self.views()
+        index = pd.to_datetime(times, unit='s', utc=True).tz_convert(TZ)
+        return pd.DataFrame(columns, index=index, columns=list(BAR_FIELDS), copy=False)
+
+
+class BarStore:
+    def __init__(self, capacity=2000):
+        self.capacity = capacity
+        self.series = dict()
+
+    def __contains__(self, req_id):
+        return req_id in self.series
+
+    def get(self, req_id):
+        return self.series.get(req_id)
+
+    def create(self, req_id, capacity=None):
+        series = self.series.get(req_id)
+        if series is None:
+            series = BarSeries(capacity or self.capacity)
+            self.series[req_id] = series
+        return series
+
+    def load(self, req_id, times, columns):
+        series = self.create(req_id)
+        series.load(times, columns)
+        return series
+
+    def load_frame(self, req_id, df):
+        series = self.create(req_id)
+        series.load(to_epoch_seconds(df.index), {f: df[f].values for f in BAR_FIELDS if f in df.columns})
+        return series
+
+    def update(self, req_id, time, open_, high, low, close, volume):
+        self.create(req_id).update(time, open_, high, low, close, volume)
+
+    def frame(self, req_id):
+        series = self.series.get(req_id)
+        if series is None:
+            return pd.DataFrame(columns=list(BAR_FIELDS))
+        return series.frame()
+
+    def release(self, req_id):
+        return self.series.pop(req_id, None)
@@ -0,0 +1,158 @@
+import threading
+import zlib
+
+from trading_bot.clients.bar_builder import BarBuilder
+from trading_bot.clients.history_scheduler import HistoricalDataScheduler
+from trading_bot.clients.ib_client import IBapi
+from trading_bot.clients.journal import journal_path
+from trading_bot.clients.market_data_budget import MarketDataBudget
+from trading_bot.clients.snapshot import SnapshotPublisher
+from trading_bot.settings import JOURNAL, logger
+
+
+class IBClientPool:
+    """
+    Several client connections to the same TWS behind the IBapi interface. Orders, order status, positions and
+    account values stay on their own connection so acks never queue behind market data, scanners and historical
+    bars go on a second one and tick-by-tick and depth streams are spread over market_data_connections by symbol.
+    Request ids, contracts and the data stores are shared so callers read them as from a single client, anything
+    not routed here goes to the order connection.
+    """
+
+    def __init__(self, market_data_connections=2, journal=JOURNAL):
+        self.journal_enabled = journal
+        self.orders = IBapi(journal=False)
+        self.history = IBapi(journal=False)
+        self.market_data = [IBapi(journal=False) for _ in range(max(market_data_connections, 1))]
+        self.connections = [self.orders, self.history] + self.market_data
+        self.lock = threading.Lock()
+        self.routes = dict()
+
+        for connection in self.connections[1:]:
+            connection.req_ids = self.orders.req_ids
+            connection.contract_cache = self.orders.contract_cache
+        for connection in self.market_data[1:]:
+            connection.tick_store = self.market_data[0].tick_store
+            connection.depth_books = self.market_data[0].depth_books
+        # Line and depth limits are per account
+        self.market_data_budget = MarketDataBudget()
+        for connection in self.connections:
+            connection.market_data_budget = self.market_data_budget
+
+        # One scheduler for all historical requests since pacing is per account, sending through the pool
+        self.history_scheduler = HistoricalDataScheduler(self)
+        self.history.history_scheduler = self.history_scheduler
+        self.bar_store = self.history.bar_store
+        # Trades come in on the market data connections and bars go to the history connection's store
+        self.bar_builder = BarBuilder(self, self.bar_store)
+        for connection in self.connections:
+            connection.bar_builder = self.bar_builder
+        self.data = self.history.data
+        self.scanned_contracts = self.history.scanned_contracts
+        self.tick_store = self.market_data[0].tick_store
+        self.depth_books = self.market_data[0].depth_books
+        # Books of the order connection, bars and market data of the shared stores above
+        self.snapshots = SnapshotPublisher(self)
+
+    def __getattr__(self, name):
+        return getattr(self.orders, name)
+
+    def start(self, host, port, client_id):
+        for i, connection in enumerate(self.connections):
+            if self.journal_enabled:
+                connection.start_journal(journal_path(str(client_id + i)))
+            connection.start(host, port, client_id + i)
+        logger.debug(f'Started {len(self.connections)} TWS connections, client ids {client_id} to '
+                     f'{client_id + len(self.connections) - 1}')
+
+    def stop(self):
+        for connection in self.connections:
+            connection.stop()
+
+    def cancel_request(self, req_id):
+        self._unroute(('tick', req_id), None)
+        self._unroute(('bars', req_id), None)
+        self._unroute(('depth', req_id), None)
+        for connection in self.connections:
+            connection.cancel_request(req_id)
+
+    def snapshot(self):
+        return self.snapshots.current()
+
+    def memory_report(self):
+        # Market data connections share their stores, keep one row per request preferring the one with a state
+        report = dict()
+        for connection in self.connections:
+            for row in connection.memory_report():
+                key = (row['kind'], row['req_id'])
+                if key not in report or report[key]['state'] is None:
+                    report[key] = row
+        return sorted(report.values(), key=lambda x: x['bytes'], reverse=True)
+
+    def instrumentation_snapshot(self):
+        return {connection.clientId: connection.instrumentation_snapshot() for connection in self.connections}
+
+    def isConnected(self):
+        # The scheduler checks this before sending historical requests
+        return self.history.isConnected()
+
+    def wait_ready(self, timeout=30):
+        return all(connection.wait_ready(timeout) for connection in self.connections)
+
+    def wait_account(self, timeout=30):
+        return self.orders.wait_account(timeout)
+
+    def market_data_connection(self, symbol):
+        return self.market_data[zlib.crc32(symbol.encode()) % len(self.market_data)]
+
+    def _route(self, req_id, connection):
+        with self.lock:
+            self.routes[req_id] = connection
+        return connection
+
+    def _unroute(self, req_id, default):
+        with self.lock:
+            return self.routes.pop(req_id, default)
+
+    def reqTickByTickData(self, reqId, contract, tickType, numberOfTicks, ignoreSize):
+        connection = self._route(('tick', reqId), self.market_data_connection(contract.symbol))
+        connection.reqTickByTickData(reqId, contract, tickType, numberOfTicks, ignoreSize)
+
+    def cancelTickByTickData(self, reqId):
+        self._unroute(('tick', reqId), self.market_data[0]).cancelTickByTickData(reqId)
+
+    def reqRealTimeBars(self, reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions):
+        connection = self._route(('bars', reqId), self.market_data_connection(contract.symbol))
+        connection.reqRealTimeBars(reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions)
+
+    def cancelRealTimeBars(self, reqId):
+        self._unroute(('bars', reqId), self.market_data[0]).cancelRealTimeBars(reqId)
+
+    def reqMktDepth(self, reqId, contract, numRows, isSmartDepth, mktDepthOptions):
+        connection = self._route(('depth', reqId), self.market_data_connection(contract.symbol))
+        connection.reqMktDepth(reqId, contract, numRows, isSmartDepth, mktDepthOptions)
+
+    def cancelMktDepth(self, reqId, isSmartDepth):
+        self._unroute(('depth', reqId), self.market_data[0]).cancelMktDepth(reqId, isSmartDepth)
+
+    def reqHistoricalData(self, reqId, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                          formatDate, keepUpToDate, chartOptions):
+        self.history.reqHistoricalData(reqId, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                                       formatDate, keepUpToDate, chartOptions)
+
+    def cancelHistoricalData(self, reqId):
+        self.history.cancelHistoricalData(reqId)
+
+    def reqScannerSubscription(self, reqId, subscription, scannerSubscriptionOptions,
+                               scannerSubscriptionFilterOptions):
+        self.history.reqScannerSubscription(reqId, subscription, scannerSubscriptionOptions,
+                                            scannerSubscriptionFilterOptions)
+
+    def cancelScannerSubscription(self, reqId):
+        self.history.cancelScannerSubscription(reqId)
+
+    def reqContractDetails(self, reqId, contract):
+        self.history.reqContractDetails(reqId, contract)
+
+    def get_contract(self, symbol, sec_type='STK', exch='SMART', prim_exch='ISLAND', curr='USD'):
+        return self.history.get_contract(symbol, sec_type, exch, prim_exch, curr)
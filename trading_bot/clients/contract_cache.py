@@ -0,0 +1,103 @@
+import copy
+import json
+import os
+import threading
+import time
+
+from ibapi.contract import Contract
+
+from trading_bot.settings import BASE_DIR, logger
+
+CACHE_FILE = BASE_DIR / 'cache' / 'contracts.json'
+CONTRACT_FIELDS = ('conId', 'symbol', 'secType', 'exchange', 'primaryExchange', 'currency', 'localSymbol',
+                   'tradingClass')
+# Symbols get delisted or reassigned, qualify them again after a week
+CACHE_TTL = 7 * 24 * 3600
+NO_SECURITY_DEFINITION = 200
+
+
+class ContractCache:
+    """
+    Qualified contracts keyed by symbol and security type, persisted to a json file between runs. Entries older
+    than ttl seconds are dropped on lookup, get returns a copy callers are free to modify.
+    """
+
+    def __init__(self, path=CACHE_FILE, ttl=CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.contracts = dict()
+        self.dirty = False
+        self.load()
+
+    def __len__(self):
+        return len(self.contracts)
+
+    @staticmethod
+    def key(symbol, sec_type):
+        return f'{symbol}:{sec_type}'
+
+    def get(self, symbol, sec_type='STK'):
+        key = self.key(symbol, sec_type)
+        with self.lock:
+            entry = self.contracts.get(key)
+            if entry is None:
+                return None
+            contract, added = entry
+            if time.time() - added > self.ttl:
+                del self.contracts[key]
+                self.dirty = True
+                return None
+        return copy.copy(contract)
+
+    def invalidate(self, symbol, sec_type='STK'):
+        with self.lock:
+            if self.contracts.pop(self.key(symbol, sec_type), None) is not None:
+                self.dirty = True
+                logger.debug(f'{symbol}: Dropped cached {sec_type} contract')
+
+    def add(self, contract):
+        if not contract.conId:
+            return
+        cached = Contract()
+        for field in CONTRACT_FIELDS:
+            setattr(cached, field, getattr(contract, field))
+        # Scanner and contract details results leave exchange empty or set to the listing exchange
+        cached.exchange = 'SMART'
+        key = self.key(cached.symbol, cached.secType)
+        with self.lock:
+            current = self.contracts.get(key)
+            if current is not None and current[0].conId == cached.conId:
+                cached = current[0]
+            self.contracts[key] = (cached, time.time())
+            self.dirty = True
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.debug(f'Could not read contract cache {self.path}: {e}')
+            return
+        for key, fields in data.items():
+            contract = Contract()
+            for field in CONTRACT_FIELDS:
+                if field in fields:
+                    setattr(contract, field, fields[field])
+            # Entries saved without a time are qualified again
+            self.contracts[key] = (contract, fields.get('added', 0))
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {k: dict({f: getattr(c, f) for f in CONTRACT_FIELDS}, added=added)
+                    for k, (c, added) in self.contracts.items()}
+            self.dirty = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
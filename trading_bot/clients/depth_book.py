@@ -0,0 +1,120 @@
+import sys
+import threading
+
+INSERT, UPDATE, DELETE = 0, 1, 2
+ASK, BID = 0, 1
+
+
+class DepthSide:
+    """One side of the book, rows ordered by position, with running level/size/notional totals."""
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.prices = []
+        self.sizes = []
+        self.total_size = 0
+        self.notional = 0.0
+
+    def __len__(self):
+        return len(self.prices)
+
+    def _add(self, price, size):
+        self.total_size += size
+        self.notional += price * size
+
+    def _remove(self, price, size):
+        self.total_size -= size
+        self.notional -= price * size
+        if not self.prices:
+            self.total_size, self.notional = 0, 0.0
+
+    def insert(self, position, price, size):
+        position = min(position, len(self.prices))
+        self.prices.insert(position, price)
+        self.sizes.insert(position, size)
+        self._add(price, size)
+        if len(self.prices) > self.depth:
+            self._remove(self.prices.pop(), self.sizes.pop())
+
+    def update(self, position, price, size):
+        if position >= len(self.prices):
+            self.insert(position, price, size)
+            return
+        self._remove(self.prices[position], self.sizes[position])
+        self.prices[position] = price
+        self.sizes[position] = size
+        self._add(price, size)
+
+    def delete(self, position):
+        if position < len(self.prices):
+            price, size = self.prices.pop(position), self.sizes.pop(position)
+            self._remove(price, size)
+
+    @property
+    def nbytes(self):
+        # Row lists and the float objects they hold
+        return sys.getsizeof(self.prices) + sys.getsizeof(self.sizes) + len(self.prices) * 2 * sys.getsizeof(0.0)
+
+    @property
+    def price_level(self):
+        return self.notional / self.total_size if self.total_size else float('nan')
+
+
+class DepthBook:
+    """Level-2 book for one market depth request, applies IB insert/update/delete operations by row position."""
+
+    def __init__(self, depth):
+        self.lock = threading.Lock()
+        self.bids = DepthSide(depth)
+        self.asks = DepthSide(depth)
+        self.updates = 0
+
+    def apply(self, position, operation, side, price, size):
+        book_side = self.bids if side == BID else self.asks
+        with self.lock:
+            if operation == INSERT:
+                book_side.insert(position, price, size)
+            elif operation == UPDATE:
+                book_side.update(position, price, size)
+            elif operation == DELETE:
+                book_side.delete(position)
+            self.updates += 1
+
+    @property
+    def nbytes(self):
+        return self.bids.nbytes + self.asks.nbytes
+
+    def metrics(self):
+        with self.lock:
+            return {'bid_levels': len(self.bids), 'ask_levels': len(self.asks),
+                    'bid_size': self.bids.total_size, 'ask_size': self.asks.total_size,
+                    'bid_price_level': self.bids.price_level, 'ask_price_level': self.asks.price_level,
+                    'updates': self.updates}
+
+
+class DepthBooks:
+    def __init__(self, depth=10):
+        self.depth = depth
+        self.books = dict()
+
+    def __contains__(self, req_id):
+        return req_id in self.books
+
+    def get(self, req_id):
+        return self.books.get(req_id)
+
+    def create(self, req_id, depth=None):
+        book = self.books.get(req_id)
+        if book is None:
+            book = DepthBook(depth or self.depth)
+            self.books[req_id] = book
+        return book
+
+    def apply(self, req_id, position, operation, side, price, size):
+        book = self.books.get(req_id)
+        if book is None:
+            book = self.create(req_id)
+        book.apply(position, operation, side, price, size)
+
+    def release(self, req_id):
+        return self.books.pop(req_id, None)
@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+
+from ibapi.common import NO_VALID_ID
+
+from trading_bot.clients.fast_decoder import FAST_CALLBACKS
+from trading_bot.settings import logger
+
+# Callbacks whose first argument is a request id, run on the worker picked by it. The rest (order status,
+# executions, positions, account and session callbacks) stay on the message loop thread
+SHARDED_CALLBACKS = frozenset((
+    'tickPrice', 'tickSize', 'tickString', 'tickGeneric', 'tickByTickAllLast', 'tickByTickBidAsk',
+    'tickByTickMidPoint', 'realtimeBar', 'historicalData', 'historicalDataEnd', 'historicalDataUpdate',
+    'updateMktDepth', 'updateMktDepthL2', 'scannerData', 'scannerDataEnd', 'contractDetails',
+    'contractDetailsEnd', 'error',
+) + FAST_CALLBACKS)
+# Callbacks queued on one worker before the dispatcher warns it is falling behind, at most once a minute
+BACKLOG_LIMIT = 10000
+BACKLOG_WARN_INTERVAL = 60
+
+
+class CallbackDispatcher:
+    """
+    Stands in for the wrapper the decoder calls, so the message loop thread only decodes. Market data, history,
+    scanner and contract callbacks are queued to one of workers threads picked by request id, which keeps each
+    stream in order while a slow handler no longer holds up order status, executions and positions behind it.
+    """
+
+    def __init__(self, client, workers=4, backlog_limit=BACKLOG_LIMIT):
+        self.client = client
+        self.backlog_limit = backlog_limit
+        self.warned_at = None
+        self.queues = [queue.SimpleQueue() for _ in range(workers)]
+        self.threads = []
+        self.dispatchers = dict()
+
+    def __getattr__(self, name):
+        if name not in SHARDED_CALLBACKS:
+            return getattr(self.client, name)
+        dispatcher = self.dispatchers.get(name)
+        if dispatcher is None:
+            dispatcher = self.dispatchers[name] = self._dispatcher(name)
+        return dispatcher
+
+    def _dispatcher(self, name):
+        client, queues = self.client, self.queues
+
+        def dispatch(req_id, *args):
+            # Connection wide errors have no request id and are handled right away
+            if name == 'error' and req_id == NO_VALID_ID or not self.threads:
+                return getattr(client, name)(req_id, *args)
+            q = queues[req_id % len(queues)]
+            q.put((getattr(client, name), req_id, args))
+            if q.qsize() > self.backlog_limit:
+                self._warn_backlog()
+
+        return dispatch
+
+    def start(self):
+        if self.threads:
+            return
+        self.threads = [threading.Thread(target=self._run, args=(q,), daemon=True) for q in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        threads, self.threads = self.threads, []
+        for q in self.queues[:len(threads)]:
+            q.put(None)
+
+    def drain(self, timeout=5):
+        # Waits for the callbacks queued so far, True if all ran within timeout
+        if not self.threads:
+            return True
+        events = [threading.Event() for _ in self.queues]
+        for q, event in zip(self.queues, events):
+            q.put(event)
+        return all(event.wait(timeout) for event in events)
+
+    def backlog(self):
+        return [q.qsize() for q in self.queues]
+
+    def _warn_backlog(self):
+        now = time.monotonic()
+        if self.warned_at is not None and now - self.warned_at < BACKLOG_WARN_INTERVAL:
+            return
+        self.warned_at = now
+        logger.warning(f'Callback workers falling behind, queued callbacks per worker: {self.backlog()}')
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            method, req_id, args = item
+            try:
+                method(req_id, *args)
+            except Exception as e:
+                logger.exception(e)
@@ -0,0 +1,59 @@
+from ibapi.decoder import Decoder
+from ibapi.message import IN
+from ibapi.server_versions import MIN_SERVER_VER_SMART_DEPTH
+
+TICK_BY_TICK = str(IN.TICK_BY_TICK).encode()
+MARKET_DEPTH_L2 = str(IN.MARKET_DEPTH_L2).encode()
+HISTORICAL_DATA_UPDATE = str(IN.HISTORICAL_DATA_UPDATE).encode()
+# Client methods the fast path calls in place of the EWrapper callbacks, all take the request id first
+FAST_CALLBACKS = ('on_trade_tick', 'on_depth', 'on_bar_update')
+# Last and AllLast, bid/ask and midpoint ticks go through the standard decoder
+TRADE_TICK_TYPES = (b'1', b'2')
+
+
+class FastDecoder(Decoder):
+    """
+    Decoder reading trade ticks, level 2 depth and historical bar updates by field position straight into the
+    client's on_trade_tick, on_depth and on_bar_update hooks, skipping the generic field parsing and the
+    TickAttribLast and BarData objects the stock decoder builds. Every other message, and any of these that does
+    not parse, goes through the standard decoder.
+    """
+
+    def __init__(self, wrapper, serverVersion):
+        super().__init__(wrapper, serverVersion)
+        self.parsers = {TICK_BY_TICK: self._tick_by_tick, MARKET_DEPTH_L2: self._market_depth_l2,
+                        HISTORICAL_DATA_UPDATE: self._historical_data_update}
+
+    def interpret(self, fields):
+        parse = self.parsers.get(fields[0]) if fields else None
+        parsed = None
+        if parse is not None:
+            try:
+                parsed = parse(fields)
+            except (ValueError, IndexError):
+                parsed = None
+        if parsed is None:
+            super().interpret(fields)
+            return
+        name, args = parsed
+        getattr(self.wrapper, name)(*args)
+
+    @staticmethod
+    def _tick_by_tick(fields):
+        # msg id, req id, tick type, time, price, size, mask, exchange, special conditions
+        if fields[2] not in TRADE_TICK_TYPES:
+            return None
+        return 'on_trade_tick', (int(fields[1]), int(fields[3]), float(fields[4]), int(fields[5]))
+
+    def _market_depth_l2(self, fields):
+        # msg id, version, req id, position, market maker, operation, side, price, size, smart depth
+        if self.serverVersion >= MIN_SERVER_VER_SMART_DEPTH and len(fields) < 10:
+            return None
+        return 'on_depth', (int(fields[2]), int(fields[3]), int(fields[5]), int(fields[6]), float(fields[7]),
+                            int(fields[8]))
+
+    @staticmethod
+    def _historical_data_update(fields):
+        # msg id, req id, bar count, date, open, close, high, low, average, volume
+        return 'on_bar_update', (int(fields[1]), fields[3].decode(errors='backslashreplace'), float(fields[4]),
+                                 float(fields[6]), float(fields[7]), float(fields[5]), int(fields[9]))
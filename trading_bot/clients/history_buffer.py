@@ -0,0 +1,78 @@
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from trading_bot.clients.bar_store import to_epoch_seconds
+from trading_bot.settings import TZ
+
+HISTORY_FIELDS = ('open', 'high', 'low', 'close', 'volume')
+# Minutes of the day, regular session and the 04:00-15:59 window the previous close is taken from
+REGULAR_SESSION = (9 * 60 + 30, 15 * 60 + 59)
+CLOSE_WINDOW = (4 * 60, 15 * 60 + 59)
+
+
+class HistoryBuffer:
+    """
+    Bars of one historical data request as they arrive, in typed arrays so the whole request becomes a frame in
+    one vectorized step instead of converting bar by bar. Dates are kept as sent, epoch seconds for intraday bars
+    (formatDate 2) and YYYYMMDD for daily ones.
+    """
+
+    def __init__(self):
+        self.dates = []
+        self.columns = {f: array('d') for f in HISTORY_FIELDS}
+
+    def __len__(self):
+        return len(self.dates)
+
+    @property
+    def nbytes(self):
+        return sum(c.buffer_info()[1] * c.itemsize for c in self.columns.values()) + len(self.dates) * 60
+
+    def append(self, bar):
+        self.dates.append(bar.date)
+        columns = self.columns
+        columns['open'].append(bar.open)
+        columns['high'].append(bar.high)
+        columns['low'].append(bar.low)
+        columns['close'].append(bar.close)
+        columns['volume'].append(bar.volume)
+
+    def epoch_seconds(self, daily=False):
+        if daily:
+            return to_epoch_seconds(pd.to_datetime(self.dates))
+        return np.array(self.dates).astype('int64')
+
+    def arrays(self):
+        return {f: np.array(c, dtype='float64') for f, c in self.columns.items()}
+
+    def frame(self, daily=False):
+        index = pd.to_datetime(self.epoch_seconds(daily), unit='s', utc=True).tz_convert(TZ).rename('datetime')
+        return pd.DataFrame(self.arrays(), index=index, columns=list(HISTORY_FIELDS), copy=False)
+
+
+def last_session(history, daily=False, extended_hours=True):
+    """
+    Bars of the last day in history with prev_close set to the close of the last 04:00-15:59 bar of an earlier
+    day, as epoch seconds and columns ready for BarSeries.load.
+    """
+    times = history.epoch_seconds(daily)
+    columns = history.arrays()
+    local = pd.to_datetime(times, unit='s', utc=True).tz_convert(TZ).tz_localize(None)
+    minutes = np.asarray(local.hour * 60 + local.minute)
+    days = np.asarray(local, dtype='datetime64[D]')
+
+    if not extended_hours and not daily:
+        keep = (minutes >= REGULAR_SESSION[0]) & (minutes <= REGULAR_SESSION[1])
+        times, minutes, days = times[keep], minutes[keep], days[keep]
+        columns = {f: c[keep] for f, c in columns.items()}
+    if not len(times):
+        return times, columns
+
+    last_day = days == days[-1]
+    earlier = ~last_day & (minutes >= CLOSE_WINDOW[0]) & (minutes <= CLOSE_WINDOW[1])
+    prev_close = columns['close'][earlier][-1] if earlier.any() else np.nan
+    columns = {f: c[last_day] for f, c in columns.items()}
+    columns['prev_close'] = np.full(last_day.sum(), prev_close)
+    return times[last_day], columns
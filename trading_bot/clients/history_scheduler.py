@@ -0,0 +1,202 @@
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+
+from trading_bot.settings import logger
+
+PRIORITY_POSITION, PRIORITY_CANDIDATE, PRIORITY_BULK = 0, 1, 2
+PACING_ERROR_CODES = (162, 420)
+NO_DATA_ERROR_CODES = (162, 200, 321, 354, 366)
+
+
+class HistoricalRequest:
+    def __init__(self, req_id, contract, args, priority, seq):
+        self.req_id = req_id
+        self.contract = contract
+        self.args = args
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+        self.not_before = 0
+        self.sent_at = None
+
+    @property
+    def contract_key(self):
+        # args follow reqHistoricalData: end, duration, bar size, what to show, use rth, ...
+        return self.contract.symbol, self.contract.secType, self.contract.exchange, self.args[3]
+
+    @property
+    def small_bars(self):
+        # IB only counts requests for bars of 30 seconds or less against the requests per window limit
+        size, unit = self.args[2].split()
+        return unit.startswith('sec') and int(size) <= 30
+
+    @property
+    def key(self):
+        return self.contract_key + self.args[:3] + self.args[4:5]
+
+
+class HistoricalDataScheduler:
+    """
+    Queues reqHistoricalData calls by priority (open positions, then new candidates, then backtest bulk) and
+    sends them as fast as IB historical data pacing allows: at most max_requests per window seconds for bars of 30
+    seconds or less, no identical request within identical_interval seconds, fewer than same_contract_limit
+    requests for one contract and what_to_show within same_contract_window seconds and at most max_concurrent
+    requests waiting for historicalDataEnd. Requests rejected for pacing are retried with backoff.
+    """
+
+    def __init__(self, client, max_requests=60, window=600, max_concurrent=50, identical_interval=15,
+                 same_contract_limit=5, same_contract_window=2, request_timeout=120, retry_delay=10,
+                 max_attempts=5, logger=logger):
+        self.client = client
+        self.logger = logger
+        self.max_requests = max_requests
+        self.window = window
+        self.max_concurrent = max_concurrent
+        self.identical_interval = identical_interval
+        self.same_contract_limit = same_contract_limit
+        self.same_contract_window = same_contract_window
+        self.request_timeout = request_timeout
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.condition = threading.Condition()
+        self.pending = dict()
+        self.in_flight = dict()
+        self.sent_times = deque()
+        self.identical_sent = dict()
+        self.contract_sent = defaultdict(deque)
+        self.paused_until = 0
+        self.counter = itertools.count()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def request(self, req_id, contract, end_date_time, duration, bar_size, what_to_show, use_rth, format_date,
+                keep_up_to_date, chart_options=None, priority=PRIORITY_CANDIDATE):
+        args = (end_date_time, duration, bar_size, what_to_show, use_rth, format_date, keep_up_to_date,
+                chart_options or [])
+        with self.condition:
+            self.pending[req_id] = HistoricalRequest(req_id, contract, args, priority, next(self.counter))
+            self._start()
+            self.condition.notify()
+
+    def cancel(self, req_id):
+        with self.condition:
+            sent = self.pending.pop(req_id, None) is None
+            if sent:
+                self.in_flight.pop(req_id, None)
+            self.condition.notify()
+        if sent:
+            self.client.cancelHistoricalData(req_id)
+        # No end comes for a cancelled request, wake whoever waits on its data
+        self.client.readiness.set_history(req_id)
+
+    def on_end(self, req_id):
+        with self.condition:
+            if self.in_flight.pop(req_id, None) is not None:
+                self.condition.notify()
+
+    def on_error(self, req_id, error_code, error_string):
+        with self.condition:
+            request = self.in_flight.get(req_id)
+            if request is None:
+                return False
+            if error_code in PACING_ERROR_CODES and 'pacing' in error_string.lower():
+                del self.in_flight[req_id]
+                request.attempts += 1
+                if request.attempts >= self.max_attempts:
+                    self.logger.debug(f'{req_id}: Historical data request dropped after {request.attempts} pacing '
+                                      f'violations')
+                    return True
+                delay = self.retry_delay * 2 ** (request.attempts - 1)
+                request.not_before = time.monotonic() + delay
+                self.paused_until = max(self.paused_until, time.monotonic() + self.retry_delay)
+                self.pending[req_id] = request
+                self.logger.debug(f'{req_id}: Historical data pacing violation, retrying in {delay} seconds')
+                self.condition.notify()
+                return True
+            if error_code in NO_DATA_ERROR_CODES:
+                del self.in_flight[req_id]
+                self.logger.debug(f'{req_id}: Historical data request failed, {error_code}: {error_string}')
+                self.condition.notify()
+                return True
+        return False
+
+    def on_disconnect(self):
+        # Requests in flight will never see their end, send them again once reconnected. Returns their ids so the
+        # client can drop the partial data received for them.
+        with self.condition:
+            req_ids = list(self.in_flight)
+            for req_id, request in self.in_flight.items():
+                request.sent_at = None
+                self.pending[req_id] = request
+            self.in_flight.clear()
+            self.condition.notify()
+        return req_ids
+
+    def _start(self):
+        # Callers hold the condition
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _wait_time(self, request, now):
+        waits = [request.not_before - now, self.paused_until - now]
+        if request.small_bars and len(self.sent_times) >= self.max_requests:
+            waits.append(self.sent_times[0] + self.window - now)
+        last_identical = self.identical_sent.get(request.key)
+        if last_identical is not None:
+            waits.append(last_identical + self.identical_interval - now)
+        contract_sent = self.contract_sent.get(request.contract_key)
+        if contract_sent and len(contract_sent) >= self.same_contract_limit:
+            waits.append(contract_sent[-self.same_contract_limit] + self.same_contract_window - now)
+        return max(waits)
+
+    def _expire(self, now):
+        while self.sent_times and self.sent_times[0] <= now - self.window:
+            self.sent_times.popleft()
+        for key in [k for k, v in self.identical_sent.items() if v <= now - self.identical_interval]:
+            del self.identical_sent[key]
+        for key in list(self.contract_sent):
+            sent = self.contract_sent[key]
+            while sent and sent[0] <= now - self.same_contract_window:
+                sent.popleft()
+            if not sent:
+                del self.contract_sent[key]
+        for req_id in [r for r, req in self.in_flight.items() if req.sent_at <= now - self.request_timeout]:
+            self.logger.debug(f'{req_id}: No end received for historical data request, releasing its slot')
+            del self.in_flight[req_id]
+
+    def _next_request(self, now):
+        # Highest priority request that can go now, otherwise how long until one can
+        wait = None
+        for request in sorted(self.pending.values(), key=lambda r: (r.priority, r.seq)):
+            request_wait = self._wait_time(request, now)
+            if request_wait <= 0:
+                return request, 0
+            wait = request_wait if wait is None else min(wait, request_wait)
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self.condition:
+                now = time.monotonic()
+                self._expire(now)
+                if not self.pending or len(self.in_flight) >= self.max_concurrent or not self.client.isConnected():
+                    self.condition.wait(timeout=1)
+                    continue
+                request, wait = self._next_request(now)
+                if request is None:
+                    self.condition.wait(timeout=min(wait, 1))
+                    continue
+                del self.pending[request.req_id]
+                request.sent_at = now
+                self.in_flight[request.req_id] = request
+                if request.small_bars:
+                    self.sent_times.append(now)
+                self.identical_sent[request.key] = now
+                self.contract_sent[request.contract_key].append(now)
+
+            self.client.reqHistoricalData(request.req_id, request.contract, *request.args)
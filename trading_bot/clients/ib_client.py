@@ -1,8 +1,7 @@
-from collections import defaultdict
-from queue import Queue
+import sys
+import threading
 from datetime import datetime
 
-import pandas as pd
 from dateutil.parser import parse
 from ibapi.client import EClient
 from ibapi.contract import Contract
@@ -11,113 +10,434 @@ from ibapi.wrapper import EWrapper
 from ibapi.scanner import ScannerSubscription
 from ibapi.scanner import ScanData
 
-from trading_bot.settings import TZ, logger
+from trading_bot.clients.account_book import AccountBook
+from trading_bot.clients.bar_builder import BarBuilder, TICKS
+from trading_bot.clients.bar_store import BarStore
+from trading_bot.clients.contract_cache import ContractCache, NO_SECURITY_DEFINITION
+from trading_bot.clients.depth_book import DepthBooks
+from trading_bot.clients.dispatcher import CallbackDispatcher
+from trading_bot.clients.fast_decoder import FastDecoder
+from trading_bot.clients.history_buffer import HistoryBuffer, last_session
+from trading_bot.clients.history_scheduler import HistoricalDataScheduler, PRIORITY_CANDIDATE, PRIORITY_POSITION
+from trading_bot.clients.id_allocator import IdAllocator, SlotPool, REQ_ID_START
+from trading_bot.clients.instrumentation import Instrumentation
+from trading_bot.clients.journal import JournalWriter, JournalQueue
+from trading_bot.clients.market_data_budget import MarketDataBudget, LIMIT_ERROR_CODES
+from trading_bot.clients.order_book import OrderBook
+from trading_bot.clients.outbound_gateway import OutboundGateway
+from trading_bot.clients.position_book import PositionBook
+from trading_bot.clients.readiness import (Readiness, CONNECTED, NEXT_VALID_ID, ACCOUNT_SUMMARY_END,
+                                           ACCOUNT_DOWNLOAD_END, POSITION_END, OPEN_ORDER_END, EXEC_DETAILS_END)
+from trading_bot.clients.snapshot import SnapshotPublisher
+from trading_bot.clients.subscriptions import (SubscriptionRegistry, TICK_BY_TICK, REAL_TIME_BARS, MKT_DEPTH,
+                                               HISTORICAL, SCANNER,
+                                               POSITIONS, ACCOUNT_SUMMARY, ACCOUNT_UPDATES, EXECUTIONS, OPEN_ORDERS,
+                                               RECLAIMED)
+from trading_bot.clients.tick_buffer import TickStore
+from trading_bot.settings import DISPATCH_WORKERS, FAST_DECODE, INSTRUMENT, JOURNAL, TZ, logger
 
 
 class IBapi(EWrapper, EClient):
-    def __init__(self):
+    def __init__(self, journal=JOURNAL, instrument=INSTRUMENT, dispatch_workers=DISPATCH_WORKERS,
+                 fast_decode=FAST_DECODE):
         EClient.__init__(self, self)
-        self.orders = []
-        self.exec_orders = []
-        self.positions = []
-        self.total_amount = 0
-        self.open_stocks_limit = 0
-        self.l2_data = defaultdict(list)
-        self.ltp_data = defaultdict(Queue)
+        self.fast_decode = fast_decode
+        self.dispatcher = CallbackDispatcher(self, dispatch_workers) if dispatch_workers else None
+        self.gateway = OutboundGateway(self, ready=self.ready_to_send)
+        self.journal = None
+        if journal:
+            self.start_journal()
+        self.instrumentation = None
+        if instrument:
+            self.instrumentation = Instrumentation(self)
+            self.instrumentation.attach()
+        self.order_book = OrderBook()
+        self.position_book = PositionBook()
+        self.account_book = AccountBook()
+        self.order_ids = IdAllocator()
+        self.req_ids = IdAllocator(start=REQ_ID_START, block_size=8)
+        self.position_slots = SlotPool()
+        self.depth_books = DepthBooks()
+        self.market_data_budget = MarketDataBudget()
+        self.tick_store = TickStore()
         self.scanned_contracts = dict()
+        self.contract_cache = ContractCache()
 
-        self.data = defaultdict(list)
+        self.data = dict()
         self.extended_hours_data = True
         self.time_frame = '1 min'
-        self.data_frames = defaultdict(pd.DataFrame)
+        self.bar_store = BarStore()
+        self.history_scheduler = HistoricalDataScheduler(self)
+        self.bar_builder = BarBuilder(self, self.bar_store)
+        self.snapshots = SnapshotPublisher(self)
+
+        self.readiness = Readiness()
+        self.subscriptions = SubscriptionRegistry()
+        self.connection_params = None
+        self.reconnect_delay = 1
+        self.max_reconnect_delay = 60
+        self.stopped = threading.Event()
+        self.client_thread = None
+
+    def start(self, host, port, client_id):
+        # Connects and keeps the message loop running, reconnecting and replaying subscriptions if TWS drops us
+        self.connection_params = (host, port, client_id)
+        self.stopped.clear()
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        self.connect(host, port, client_id)
+        self.gateway.start()
+        self.client_thread = threading.Thread(target=self.run_forever, daemon=True)
+        self.client_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.gateway.stop()
+        self.disconnect()
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+        if self.journal is not None:
+            self.journal.close()
+        if self.instrumentation is not None:
+            self.instrumentation.stop()
+
+    def start_journal(self, path=None):
+        # Before connecting, the reader thread keeps the queue it was started with
+        self.journal = JournalWriter(path)
+        self.msg_queue = JournalQueue(self.journal, self)
+        if getattr(self, 'instrumentation', None) is not None:
+            self.instrumentation.wrap_queue(self.msg_queue)
+
+    def connect(self, host, port, clientId):
+        super().connect(host, port, clientId)
+        # A new decoder comes with every connection, it calls the dispatcher in place of the client
+        if self.decoder is None:
+            return
+        wrapper = self.dispatcher if self.dispatcher is not None else self
+        if self.fast_decode:
+            self.decoder = FastDecoder(wrapper, self.decoder.serverVersion)
+        else:
+            self.decoder.wrapper = wrapper
+
+    def run_forever(self):
+        delay = self.reconnect_delay
+        while not self.stopped.is_set():
+            if self.isConnected():
+                self.run()
+                if self.stopped.is_set():
+                    break
+                delay = self.reconnect_delay
+                logger.info('Connection to TWS lost, reconnecting')
+
+            self.stopped.wait(delay)
+            if self.stopped.is_set():
+                break
+            try:
+                self.connect(*self.connection_params)
+            except Exception as e:
+                logger.debug(f'Reconnect to TWS failed: {e}')
+            if not self.isConnected():
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            logger.info('Reconnected to TWS')
+            self.replay_subscriptions()
+            self.market_data_budget.restore()
+
+    def replay_subscriptions(self, cancel_first=False):
+        # cancel_first when the session survived and TWS may still hold the old request ids
+        subscriptions = self.subscriptions.active()
+        logger.debug(f'Replaying {len(subscriptions)} subscriptions')
+        for subscription in subscriptions:
+            if cancel_first:
+                self._cancel_stream(subscription)
+            if subscription.kind == HISTORICAL:
+                # Bars missed while disconnected come with the new request, rebuild the series from it
+                self.bar_store.release(subscription.req_id)
+                self.data.pop(subscription.req_id, None)
+                self.history_scheduler.request(*subscription.args, priority=PRIORITY_POSITION)
+                continue
+            if subscription.kind == MKT_DEPTH:
+                self.depth_books.release(subscription.req_id)
+            if subscription.req_id in self.bar_builder:
+                self.bar_builder.request_seed(subscription.req_id)
+            try:
+                getattr(self, subscription.method)(*subscription.args)
+            except Exception as e:
+                logger.exception(f'Could not replay {subscription}: {e}')
+
+    def _cancel_stream(self, subscription):
+        req_id = subscription.req_id
+        with self.gateway.context((subscription.kind, req_id), cancel=True):
+            if subscription.kind == TICK_BY_TICK:
+                EClient.cancelTickByTickData(self, req_id)
+            elif subscription.kind == REAL_TIME_BARS:
+                EClient.cancelRealTimeBars(self, req_id)
+            elif subscription.kind == MKT_DEPTH:
+                EClient.cancelMktDepth(self, req_id, subscription.args[3])
+            elif subscription.kind == HISTORICAL:
+                EClient.cancelHistoricalData(self, req_id)
+            elif subscription.kind == SCANNER:
+                EClient.cancelScannerSubscription(self, req_id)
+
+    def release(self, kind, req_id, subscription=None):
+        # Frees what the client holds for a cancelled request, messages still arriving for it are dropped
+        self.subscriptions.retire(kind, req_id)
+        if subscription is not None:
+            subscription.state = RECLAIMED
+        if kind in (TICK_BY_TICK, REAL_TIME_BARS) and req_id in self.bar_builder:
+            self.bar_builder.release(req_id)
+        if kind == TICK_BY_TICK:
+            self.tick_store.release(req_id)
+        elif kind == MKT_DEPTH:
+            self.depth_books.release(req_id)
+        elif kind == HISTORICAL:
+            self.bar_store.release(req_id)
+            self.data.pop(req_id, None)
+        elif kind == SCANNER:
+            self.scanned_contracts.pop(req_id, None)
+
+    def cancel_request(self, req_id):
+        # Cancels every stream still open under req_id, for callers dropping an instance
+        for subscription in self.subscriptions.active():
+            if subscription.req_id != req_id:
+                continue
+            if subscription.kind == TICK_BY_TICK:
+                self.cancelTickByTickData(req_id)
+            elif subscription.kind == REAL_TIME_BARS:
+                self.cancelRealTimeBars(req_id)
+            elif subscription.kind == MKT_DEPTH:
+                self.cancelMktDepth(req_id, subscription.args[3])
+            elif subscription.kind == HISTORICAL:
+                self.history_scheduler.cancel(req_id)
+            elif subscription.kind == SCANNER:
+                self.cancelScannerSubscription(req_id)
+
+    def build_bars(self, req_id, contract, interval=60, source=TICKS, priority=PRIORITY_CANDIDATE):
+        # Live bars in bar_store under req_id, built here from trades after a small historical seed
+        self.bar_builder.start(req_id, contract, interval, source, priority)
+
+    def snapshot(self):
+        # Consistent read-only view of positions, orders and market data for evaluating trades in parallel
+        return self.snapshots.current()
+
+    def memory_report(self):
+        # Approximate bytes held per request, subscriptions move from open to streaming once they hold data
+        report = dict()
+        stores = ((TICK_BY_TICK, self.tick_store.buffers), (MKT_DEPTH, self.depth_books.books),
+                  (HISTORICAL, self.bar_store.series))
+        for kind, buffers in stores:
+            for req_id, buffer in list(buffers.items()):
+                report[(kind, req_id)] = buffer.nbytes
+        for req_id, history in list(self.data.items()):
+            report[(HISTORICAL, req_id)] = report.get((HISTORICAL, req_id), 0) + history.nbytes
+        for req_id, contracts in list(self.scanned_contracts.items()):
+            report[(SCANNER, req_id)] = sys.getsizeof(contracts) + sum(sys.getsizeof(vars(c))
+                                                                       for c in contracts.values())
+
+        states = {(s.kind, s.req_id): s.state for s in self.subscriptions.active()}
+        # State None for buffers of one shot requests, which have no subscription
+        return [{'kind': kind, 'req_id': req_id, 'state': states.get((kind, req_id)), 'bytes': size}
+                for (kind, req_id), size in sorted(report.items(), key=lambda x: x[1], reverse=True)]
+
+    def sendMsg(self, msg):
+        self.gateway.submit(msg)
+
+    def send_now(self, msg):
+        super().sendMsg(msg)
+
+    def ready_to_send(self):
+        # After startApi went out on this connection
+        return self.isConnected() and self.readiness.is_set(CONNECTED)
+
+    def connectAck(self):
+        super().connectAck()
+        self.readiness.set(CONNECTED)
+
+    def instrumentation_snapshot(self):
+        return self.instrumentation.snapshot() if self.instrumentation is not None else None
+
+    def wait_ready(self, timeout=30):
+        # Connected with a valid order id, call before sending the startup requests
+        if self.readiness.wait(CONNECTED, NEXT_VALID_ID, timeout=timeout):
+            return True
+        logger.error(f'TWS not ready after {timeout} seconds, waiting for: '
+                     f'{self.readiness.pending(CONNECTED, NEXT_VALID_ID)}')
+        return False
+
+    def wait_account(self, timeout=30):
+        # Account values, positions and open orders all received
+        names = (ACCOUNT_DOWNLOAD_END, POSITION_END, OPEN_ORDER_END)
+        if self.readiness.wait(*names, timeout=timeout):
+            return True
+        logger.error(f'Account data not received after {timeout} seconds, waiting for: '
+                     f'{self.readiness.pending(*names)}')
+        return False
+
+    def connectionClosed(self):
+        super().connectionClosed()
+        self.readiness.clear()
+        if self.dispatcher is not None and not self.dispatcher.drain():
+            logger.warning('Callbacks still queued after the connection closed')
+        for req_id in self.history_scheduler.on_disconnect():
+            self.data.pop(req_id, None)
+        logger.debug('TWS connection closed')
 
     def nextValidId(self, orderId: int):
         super().nextValidId(orderId)
-        self.nextorderId = orderId
-        print('The next valid order id is: ', self.nextorderId)
+        self.order_ids.reset(orderId)
+        if orderId >= REQ_ID_START:
+            logger.warning(f'Order id {orderId} reached the request id range starting at {REQ_ID_START}')
+        self.readiness.set(NEXT_VALID_ID)
+        print('The next valid order id is: ', orderId)
+
+    @property
+    def nextorderId(self):
+        return self.order_ids.peek()
+
+    def next_order_id(self):
+        return self.order_ids.allocate()
+
+    def next_req_id(self):
+        return self.req_ids.allocate()
+
+    @property
+    def total_amount(self):
+        return self.account_book.cash
+
+    @property
+    def open_stocks_limit(self):
+        return self.position_slots.available
 
     def orderStatus(self, orderId, status, filled, remaining, avgFullPrice, permId, parentId, lastFillPrice, clientId,
                     whyHeld, mktCapPrice):
-        self.orders.append({'order_id': orderId, 'status': status, 'avg_price': avgFullPrice, 'filled': filled})
+        self.order_book.update_status(orderId, status, avgFullPrice, filled, remaining)
         # print('orderStatus - orderid:', orderId, 'status:', status, 'filled', filled, 'remaining', remaining,
         #       'lastFillPrice', lastFillPrice)
 
     def execDetails(self, reqId, contract, execution):
-        self.exec_orders.append({'order_id': reqId, 'symbol': contract.symbol, 'exec_order_id': execution.orderId,
-                                 'exec_avg_price': execution.avgPrice,
-                                 'exec_time': parse(execution.time).astimezone(TZ)})
+        self.order_book.add_execution(execution.orderId, contract.symbol, execution.avgPrice,
+                                      parse(execution.time).astimezone(TZ), shares=execution.shares, req_id=reqId)
 
         # print('Order Executed: ', reqId, contract.symbol, contract.secType, contract.currency, execution.execId,
         #       execution.orderId, execution.shares, execution.lastLiquidity, execution.avgPrice)
 
+    def execDetailsEnd(self, reqId: int):
+        super().execDetailsEnd(reqId)
+        self.readiness.set(EXEC_DETAILS_END)
+
+    def openOrder(self, orderId, contract, order, orderState):
+        super().openOrder(orderId, contract, order, orderState)
+        self.order_book.add_order(orderId, orderState.status)
+
+    def openOrderEnd(self):
+        super().openOrderEnd()
+        self.readiness.set(OPEN_ORDER_END)
+
+    def placeOrder(self, orderId, contract, order):
+        self.order_book.add_order(orderId)
+        with self.gateway.context(('order', orderId)):
+            super().placeOrder(orderId, contract, order)
+
+    def cancelOrder(self, orderId):
+        with self.gateway.context(('order', orderId), cancel=True):
+            super().cancelOrder(orderId)
+
     def position(self, account: str, contract: Contract, position, avgCost: float):
         super().position(account, contract, position, avgCost)
-        for pos in self.positions:
-            if pos['symbol'] == contract.symbol:
-                pos['position'] = position
-                pos['avg_cost'] = avgCost
-                break
-        else:
-            self.positions.append({'symbol': contract.symbol, 'position': position, 'avg_cost': avgCost})
+        self.position_book.update(contract.symbol, contract.conId, position, avgCost)
         # print("Position.", "Account:", account, "Symbol:", contract.symbol, "SecType:", contract.secType,
         #       "Currency:", contract.currency, "Position:", position, "Avg cost:", avgCost)
 
+    def positionEnd(self):
+        super().positionEnd()
+        self.readiness.set(POSITION_END)
+
     def accountSummary(self, reqId: int, account: str, tag: str, value: str, currency: str):
         super().accountSummary(reqId, account, tag, value, currency)
-        if tag == 'TotalCashBalance':
-            self.total_amount = float(value)
-            # print('total amount', self.total_amount)
+        self.account_book.update_value(tag, value, currency)
         # print("AccountSummary. ReqId:", reqId, "Account:", account, "Tag: ", tag, "Value:", value, "Currency:",
         #       currency)
 
+    def accountSummaryEnd(self, reqId: int):
+        super().accountSummaryEnd(reqId)
+        self.readiness.set(ACCOUNT_SUMMARY_END)
+
+    def updateAccountValue(self, key: str, val: str, currency: str, accountName: str):
+        self.account_book.update_value(key, val, currency)
+
+    def updatePortfolio(self, contract: Contract, position, marketPrice: float, marketValue: float,
+                        averageCost: float, unrealizedPNL: float, realizedPNL: float, accountName: str):
+        self.account_book.update_portfolio(contract.symbol, position, marketPrice, marketValue, averageCost,
+                                           unrealizedPNL, realizedPNL)
+
+    def updateAccountTime(self, timeStamp: str):
+        self.account_book.update_time = timeStamp
+
+    def accountDownloadEnd(self, accountName: str):
+        super().accountDownloadEnd(accountName)
+        self.readiness.set(ACCOUNT_DOWNLOAD_END)
+
     def tickByTickAllLast(self, reqId, tickType, time, price, size, tickAtrribLast, exchange, specialConditions):
-        # print(reqId, tickType, time, price, size, datetime.fromtimestamp(int(time)).astimezone(TZ))
-        # self.queue.put({'id': reqId, 'ltp_time': datetime.fromtimestamp(int(time)).astimezone(TZ), 'ltp': price})
-        # print({'id': reqId, 'ltp_time': time, 'ltp': price})
-        self.ltp_data[reqId].put({'id': reqId, 'ltp_time': datetime.fromtimestamp(int(time)).astimezone(TZ),
-                                  'ltp': price})
+        self.on_trade_tick(reqId, time, price, size)
+
+    def on_trade_tick(self, reqId, time, price, size):
+        # Also called by the fast decoder with just the fields used here
+        if self.subscriptions.is_retired(TICK_BY_TICK, reqId):
+            return
+        self.subscriptions.streaming(TICK_BY_TICK, reqId)
+        self.tick_store.append(reqId, time, price, size)
+        self.bar_builder.on_tick(reqId, time, price, size)
+
+    def realtimeBar(self, reqId, time, open_, high, low, close, volume, wap, count):
+        if self.subscriptions.is_retired(REAL_TIME_BARS, reqId):
+            return
+        self.subscriptions.streaming(REAL_TIME_BARS, reqId)
+        self.bar_builder.on_bar(reqId, time, open_, high, low, close, volume)
 
     def historicalData(self, reqId, bar):
         # print(reqId, datetime.fromtimestamp(int(bar.date)), bar.open, bar.high, bar.low, bar.close)
-        data = {'datetime': bar.date, 'open': bar.open, 'high': bar.high, 'low': bar.low, 'close': bar.close,
-                'volume': bar.volume}
-        self.data[reqId].append(data)
+        if self.subscriptions.is_retired(HISTORICAL, reqId):
+            return
+        self.subscriptions.streaming(HISTORICAL, reqId)
+        history = self.data.get(reqId)
+        if history is None:
+            history = self.data[reqId] = HistoryBuffer()
+        history.append(bar)
+
+    def historicalDataEnd(self, reqId: int, start: str, end: str):
+        super().historicalDataEnd(reqId, start, end)
+        self.history_scheduler.on_end(reqId)
+        if self.bar_builder.is_seed(reqId):
+            self.bar_builder.seed(reqId, self.data.pop(reqId, None) or HistoryBuffer(), self.extended_hours_data)
+        self.readiness.set_history(reqId)
 
     def historicalDataUpdate(self, reqId, bar):
+        self.on_bar_update(reqId, bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume)
+
+    def on_bar_update(self, reqId, date, open_, high, low, close, volume):
+        # Also called by the fast decoder, without building a BarData
+        if self.subscriptions.is_retired(HISTORICAL, reqId):
+            return
+        self.subscriptions.streaming(HISTORICAL, reqId)
         if self.time_frame in ['1 day']:
-            bar_date_time = parse(bar.date).astimezone(tz=TZ)
+            bar_time = int(TZ.localize(parse(date)).timestamp())
         else:
-            bar_date_time = datetime.fromtimestamp(int(bar.date)).astimezone(TZ)
-
-        data = {'open': bar.open, 'high': bar.high, 'low': bar.low, 'close': bar.close, 'volume': bar.volume}
-
-        if not len(self.data_frames[reqId]):
-            df = pd.DataFrame(self.data[reqId])
-            del self.data[reqId]
-            if self.time_frame in ['1 day']:
-                df['datetime'] = pd.to_datetime(df['datetime']).dt.tz_localize(TZ)
-                df['datetime'] = df['datetime'].dt.date
-            else:
-                df['datetime'] = df['datetime'].apply(lambda x: datetime.fromtimestamp(int(x)).astimezone(TZ))
-            df = df.set_index('datetime')
-            if not self.extended_hours_data:
-                df = df.between_time('09:30', '15:59')
-            daily = pd.DataFrame(
-                df.between_time('04:00', '15:59').groupby(pd.Grouper(freq='1D'))['close'].last().dropna(axis=0))
-            daily['close'] = daily['close'].shift(1)
+            bar_time = int(date)
+
+        if reqId not in self.bar_store:
+            # First update, the bars received so far become today's series with the previous session close
+            history = self.data.pop(reqId, None)
+            if not history:
+                return
             try:
-                df = pd.merge_asof(df, daily, right_index=True, left_index=True)
-                df.columns = ['open', 'high', 'low', 'close', 'volume', 'prev_close']
-                df = df[df.index.date == df.index[-1].date()]
-                self.data_frames[reqId] = df
+                times, columns = last_session(history, self.time_frame in ['1 day'], self.extended_hours_data)
+                self.bar_store.load(reqId, times, columns)
                 logger.debug(f'{reqId}: Historical Data fetched for id: {reqId}')
             except Exception as e:
                 logger.exception(e)
                 return
 
-        self.data_frames[reqId].loc[bar_date_time] = data
-        # print(reqId, bar_date_time, data)
-        # print(self.data_frames[reqId])
+        self.bar_store.update(reqId, bar_time, open_, high, low, close, volume)
 
     def mktDepthExchanges(self, depthMktDataDescriptions):
         super().mktDepthExchanges(depthMktDataDescriptions)
@@ -130,30 +450,209 @@ class IBapi(EWrapper, EClient):
         print("UpdateMarketDepth. ReqId:", reqId, "Position:", position, "Operation:",
               operation, "Side:", side, "Price:", price, "Size:", size)
 
+    def reqMktDepth(self, reqId, contract, numRows, isSmartDepth, mktDepthOptions):
+        self.depth_books.create(reqId, numRows)
+        self.subscriptions.add(MKT_DEPTH, reqId, 'reqMktDepth',
+                               (reqId, contract, numRows, isSmartDepth, mktDepthOptions))
+        self.market_data_budget.request(MKT_DEPTH, reqId, lambda: self._send_mkt_depth(
+            reqId, contract, numRows, isSmartDepth, mktDepthOptions))
+
+    def _send_mkt_depth(self, reqId, contract, numRows, isSmartDepth, mktDepthOptions):
+        with self.gateway.context((MKT_DEPTH, reqId)):
+            super().reqMktDepth(reqId, contract, numRows, isSmartDepth, mktDepthOptions)
+
+    def cancelMktDepth(self, reqId, isSmartDepth):
+        subscription = self.subscriptions.remove(MKT_DEPTH, reqId)
+        if self.market_data_budget.release(MKT_DEPTH, reqId):
+            with self.gateway.context((MKT_DEPTH, reqId), cancel=True):
+                super().cancelMktDepth(reqId, isSmartDepth)
+        self.release(MKT_DEPTH, reqId, subscription)
+
+    def reqTickByTickData(self, reqId, contract, tickType, numberOfTicks, ignoreSize):
+        self.subscriptions.add(TICK_BY_TICK, reqId, 'reqTickByTickData',
+                               (reqId, contract, tickType, numberOfTicks, ignoreSize))
+        self.market_data_budget.request(TICK_BY_TICK, reqId, lambda: self._send_tick_by_tick(
+            reqId, contract, tickType, numberOfTicks, ignoreSize))
+
+    def _send_tick_by_tick(self, reqId, contract, tickType, numberOfTicks, ignoreSize):
+        with self.gateway.context((TICK_BY_TICK, reqId)):
+            super().reqTickByTickData(reqId, contract, tickType, numberOfTicks, ignoreSize)
+
+    def reqRealTimeBars(self, reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions):
+        self.subscriptions.add(REAL_TIME_BARS, reqId, 'reqRealTimeBars',
+                               (reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions))
+        self.market_data_budget.request(REAL_TIME_BARS, reqId, lambda: self._send_real_time_bars(
+            reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions))
+
+    def _send_real_time_bars(self, reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions):
+        with self.gateway.context((REAL_TIME_BARS, reqId)):
+            super().reqRealTimeBars(reqId, contract, barSize, whatToShow, useRTH, realTimeBarsOptions)
+
+    def cancelRealTimeBars(self, reqId):
+        subscription = self.subscriptions.remove(REAL_TIME_BARS, reqId)
+        if self.market_data_budget.release(REAL_TIME_BARS, reqId):
+            with self.gateway.context((REAL_TIME_BARS, reqId), cancel=True):
+                super().cancelRealTimeBars(reqId)
+        self.release(REAL_TIME_BARS, reqId, subscription)
+
+    def cancelTickByTickData(self, reqId):
+        subscription = self.subscriptions.remove(TICK_BY_TICK, reqId)
+        if self.market_data_budget.release(TICK_BY_TICK, reqId):
+            with self.gateway.context((TICK_BY_TICK, reqId), cancel=True):
+                super().cancelTickByTickData(reqId)
+        self.release(TICK_BY_TICK, reqId, subscription)
+
+    def reqHistoricalData(self, reqId, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                          formatDate, keepUpToDate, chartOptions):
+        if keepUpToDate:
+            self.subscriptions.add(HISTORICAL, reqId, 'reqHistoricalData',
+                                   (reqId, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                                    formatDate, keepUpToDate, chartOptions))
+        else:
+            self.subscriptions.revive(HISTORICAL, reqId)
+        with self.gateway.context((HISTORICAL, reqId)):
+            super().reqHistoricalData(reqId, contract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH,
+                                      formatDate, keepUpToDate, chartOptions)
+
+    def cancelHistoricalData(self, reqId):
+        subscription = self.subscriptions.remove(HISTORICAL, reqId)
+        with self.gateway.context((HISTORICAL, reqId), cancel=True):
+            super().cancelHistoricalData(reqId)
+        self.release(HISTORICAL, reqId, subscription)
+
+    def reqScannerSubscription(self, reqId, subscription, scannerSubscriptionOptions,
+                               scannerSubscriptionFilterOptions):
+        self.subscriptions.add(SCANNER, reqId, 'reqScannerSubscription',
+                               (reqId, subscription, scannerSubscriptionOptions, scannerSubscriptionFilterOptions))
+        with self.gateway.context((SCANNER, reqId)):
+            super().reqScannerSubscription(reqId, subscription, scannerSubscriptionOptions,
+                                           scannerSubscriptionFilterOptions)
+
+    def cancelScannerSubscription(self, reqId):
+        subscription = self.subscriptions.remove(SCANNER, reqId)
+        with self.gateway.context((SCANNER, reqId), cancel=True):
+            super().cancelScannerSubscription(reqId)
+        self.release(SCANNER, reqId, subscription)
+
+    def reqPositions(self):
+        self.subscriptions.add(POSITIONS, None, 'reqPositions', ())
+        with self.gateway.context((POSITIONS,)):
+            super().reqPositions()
+
+    def cancelPositions(self):
+        self.subscriptions.remove(POSITIONS)
+        super().cancelPositions()
+
+    def reqAccountSummary(self, reqId, groupName, tags):
+        self.subscriptions.add(ACCOUNT_SUMMARY, reqId, 'reqAccountSummary', (reqId, groupName, tags))
+        super().reqAccountSummary(reqId, groupName, tags)
+
+    def cancelAccountSummary(self, reqId):
+        self.subscriptions.remove(ACCOUNT_SUMMARY, reqId)
+        super().cancelAccountSummary(reqId)
+
+    def reqAccountUpdates(self, subscribe, acctCode):
+        if subscribe:
+            self.subscriptions.add(ACCOUNT_UPDATES, None, 'reqAccountUpdates', (subscribe, acctCode))
+        else:
+            self.subscriptions.remove(ACCOUNT_UPDATES)
+        with self.gateway.context((ACCOUNT_UPDATES,)):
+            super().reqAccountUpdates(subscribe, acctCode)
+
+    def reqExecutions(self, reqId, execFilter):
+        # One shot, but sent again after a reconnect to pick up fills that happened while disconnected
+        self.subscriptions.add(EXECUTIONS, None, 'reqExecutions', (reqId, execFilter))
+        with self.gateway.context((EXECUTIONS,)):
+            super().reqExecutions(reqId, execFilter)
+
+    def reqAllOpenOrders(self):
+        self.subscriptions.add(OPEN_ORDERS, None, 'reqAllOpenOrders', ())
+        with self.gateway.context((OPEN_ORDERS,)):
+            super().reqAllOpenOrders()
+
     def updateMktDepthL2(self, reqId, position, marketMaker, operation, side, price, size, isSmartDepth):
         super().updateMktDepthL2(reqId, position, marketMaker, operation, side, price, size, isSmartDepth)
-        self.l2_data[reqId].append({'position': position, 'market_maker': marketMaker, 'operation': operation,
-                                    'side': side, 'price': price, 'size': size})
+        self.on_depth(reqId, position, operation, side, price, size)
+
+    def on_depth(self, reqId, position, operation, side, price, size):
+        # Also called by the fast decoder with just the fields used here
+        if self.subscriptions.is_retired(MKT_DEPTH, reqId):
+            return
+        self.subscriptions.streaming(MKT_DEPTH, reqId)
+        self.depth_books.apply(reqId, position, operation, side, price, size)
         # print("UpdateMarketDepthL2. ReqId:", reqId, "Position:", position, "MarketMaker:", marketMaker, "Operation:",
         #       operation, "Side:", side, "Price:", price, "Size:", size, "isSmartDepth:", isSmartDepth)
 
     def error(self, reqId, errorCode, errorString):
-        pass
+        if errorCode in (1100, 1101, 1102):
+            logger.info(f'{errorCode}: {errorString}')
+        if errorCode == 1101:
+            # TWS is still connected but IB dropped the market data, subscribe again
+            self.replay_subscriptions(cancel_first=True)
+            return
+        if reqId in self.order_book:
+            # Order errors come with the order status, none of the request handlers below applies
+            return
+        if errorCode in LIMIT_ERROR_CODES:
+            self.market_data_budget.on_rejected(LIMIT_ERROR_CODES[errorCode], reqId)
+            return
+        if errorCode == NO_SECURITY_DEFINITION:
+            self.invalidate_contract(reqId)
+        if self.history_scheduler.on_error(reqId, errorCode, errorString) and self.bar_builder.is_seed(reqId) and \
+                reqId not in self.history_scheduler.pending:
+            # Seed dropped for good, show the bars built from trades without it
+            self.bar_builder.seed(reqId, self.data.pop(reqId, None) or HistoryBuffer(), self.extended_hours_data)
         # print('Error:', errorCode, errorString)
 
     def scannerData(self, reqId: int, rank: int, contractDetails, distance: str, benchmark: str, projection: str,
                     legsStr: str):
         super().scannerData(reqId, rank, contractDetails, distance, benchmark, projection, legsStr)
+        if self.subscriptions.is_retired(SCANNER, reqId):
+            return
+        self.subscriptions.streaming(SCANNER, reqId)
         if reqId not in self.scanned_contracts:
             self.scanned_contracts[reqId] = dict()
         self.scanned_contracts[reqId][rank] = contractDetails.contract
+        self.contract_cache.add(contractDetails.contract)
         # print("ScannerData. ReqId:", reqId,
         #       ScanData(contractDetails.contract, rank, distance, benchmark, projection, legsStr))
 
     def scannerDataEnd(self, reqId: int):
         super().scannerDataEnd(reqId)
+        self.contract_cache.save()
         # print("ScannerDataEnd. ReqId:", reqId)
 
+    def reqContractDetails(self, reqId, contract):
+        # Many instances asking for the same unqualified contract need only one answer to fill the cache
+        with self.gateway.context(('contract_details', contract.symbol, contract.secType)):
+            super().reqContractDetails(reqId, contract)
+
+    def contractDetails(self, reqId: int, contractDetails):
+        super().contractDetails(reqId, contractDetails)
+        self.contract_cache.add(contractDetails.contract)
+
+    def contractDetailsEnd(self, reqId: int):
+        super().contractDetailsEnd(reqId)
+        self.contract_cache.save()
+
+    def invalidate_contract(self, req_id):
+        # TWS no longer knows the contract a request was sent with, qualify it again next time
+        for subscription in self.subscriptions.active():
+            if subscription.req_id != req_id:
+                continue
+            for arg in subscription.args:
+                if isinstance(arg, Contract):
+                    self.contract_cache.invalidate(arg.symbol, arg.secType)
+
+    def get_contract(self, symbol, sec_type='STK', exch='SMART', prim_exch='ISLAND', curr='USD'):
+        contract = self.contract_cache.get(symbol, sec_type)
+        if contract is not None:
+            return contract
+        # Not qualified yet, use the plain contract now and cache the qualified one for next time
+        contract = self.make_contract(symbol, sec_type, exch, prim_exch, curr)
+        self.reqContractDetails(self.next_req_id(), contract)
+        return contract
+
     @staticmethod
     def get_sub(scan_name, above_price, below_price, above_volume, average_volume, market_cap_usd,
                 limit=10):
@@ -0,0 +1,78 @@
+import threading
+
+# Request ids start above any order id an account reaches so errors for the two never mix, TWS ids are 32 bit
+REQ_ID_START = 1000000000
+
+
+class IdAllocator:
+    """
+    Thread safe id counter. With block_size > 1 each thread takes a block of ids at a time and hands them out
+    without touching the shared lock, ids are then unique but only increasing per thread, so keep
+    block_size at 1 for order ids which TWS expects in increasing order.
+    """
+
+    def __init__(self, start=0, block_size=1):
+        self.lock = threading.Lock()
+        self.next_id = start
+        self.block_size = block_size
+        self.local = threading.local()
+
+    def peek(self):
+        return self.next_id
+
+    def reset(self, start):
+        with self.lock:
+            self.next_id = max(self.next_id, start)
+
+    def reserve(self, count):
+        with self.lock:
+            start = self.next_id
+            self.next_id += count
+        return range(start, start + count)
+
+    def allocate(self):
+        if self.block_size <= 1:
+            with self.lock:
+                allocated = self.next_id
+                self.next_id += 1
+            return allocated
+
+        block = getattr(self.local, 'block', None)
+        if not block:
+            block = iter(self.reserve(self.block_size))
+            self.local.block = block
+        try:
+            return next(block)
+        except StopIteration:
+            self.local.block = None
+            return self.allocate()
+
+
+class SlotPool:
+    """Open position slots, acquire() atomically takes one if any is free and release() gives it back."""
+
+    def __init__(self, capacity=0):
+        self.lock = threading.Lock()
+        self.capacity = capacity
+        self.in_use = 0
+
+    @property
+    def available(self):
+        return self.capacity - self.in_use
+
+    def set_capacity(self, capacity):
+        with self.lock:
+            self.capacity = capacity
+
+    def acquire(self, force=False):
+        # force is for positions that already exist at startup and must be counted even over capacity
+        with self.lock:
+            if not force and self.in_use >= self.capacity:
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            if self.in_use > 0:
+                self.in_use -= 1
@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import deque
+
+from ibapi.message import IN
+from ibapi.wrapper import EWrapper
+
+from trading_bot.clients.fast_decoder import FAST_CALLBACKS
+from trading_bot.settings import logger
+
+BUCKETS = 32
+MESSAGE_NAMES = {str(v).encode(): k for k, v in vars(IN).items() if not k.startswith('_')}
+
+
+class Histogram:
+    """Durations in power of two microsecond buckets, enough for percentiles without keeping samples."""
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile, in seconds
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return (1 << i) / 1e6
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'total': self.total, 'mean': self.total / self.count if self.count else 0.0,
+                'max': self.max, 'p50': self.percentile(50), 'p99': self.percentile(99)}
+
+
+class Instrumentation:
+    """
+    Per connection counters: callbacks called and time spent in each handler, queue lag from the reader thread
+    receiving a message to the message loop taking it, and messages and bytes per message type. Updates happen on
+    the reader and message loop threads without locks, snapshot() is a best effort copy.
+    """
+
+    def __init__(self, client, log_interval=60):
+        self.client = client
+        self.log_interval = log_interval
+        self.callbacks = dict()
+        self.queue_lag = Histogram()
+        self.messages = dict()
+        self.stamps = deque()
+        self.started = time.monotonic()
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def attach(self):
+        # Before connecting, the reader thread keeps the queue it was started with
+        self.wrap_queue(self.client.msg_queue)
+        for name in dir(EWrapper):
+            if not name.startswith('_') and name != 'logAnswer' and callable(getattr(EWrapper, name)):
+                setattr(self.client, name, self._wrap_callback(name, getattr(self.client, name)))
+        for name in FAST_CALLBACKS:
+            setattr(self.client, name, self._wrap_callback(name, getattr(self.client, name)))
+        if self.log_interval:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def wrap_queue(self, msg_queue):
+        put, get = msg_queue._put, msg_queue._get
+        stamps = self.stamps
+
+        def _put(item):
+            stamps.append(time.perf_counter())
+            put(item)
+
+        def _get():
+            item = get()
+            now = time.perf_counter()
+            self._dequeued(item, now - stamps.popleft() if stamps else 0.0)
+            return item
+
+        msg_queue._put, msg_queue._get = _put, _get
+
+    def _dequeued(self, item, lag):
+        self.queue_lag.add(lag)
+        msg_id = item[:item.find(b'\0')]
+        stats = self.messages.get(msg_id)
+        if stats is None:
+            stats = self.messages[msg_id] = [0, 0]
+        stats[0] += 1
+        stats[1] += len(item)
+
+    def _wrap_callback(self, name, method):
+        histogram = self.callbacks[name] = Histogram()
+        perf_counter = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                histogram.add(perf_counter() - start)
+
+        timed.__name__ = name
+        return timed
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            'elapsed': elapsed,
+            'callbacks': {k: v.snapshot() for k, v in list(self.callbacks.items()) if v.count},
+            'queue_lag': self.queue_lag.snapshot(),
+            'queue_size': self.client.msg_queue.qsize(),
+            'dispatch_backlog': self.client.dispatcher.backlog() if self.client.dispatcher is not None else [],
+            'messages': {MESSAGE_NAMES.get(k, k.decode(errors='replace')): {'count': c, 'bytes': b}
+                         for k, (c, b) in list(self.messages.items())},
+        }
+
+    def summary(self, top=5):
+        snapshot = self.snapshot()
+        messages = sum(m['count'] for m in snapshot['messages'].values())
+        size = sum(m['bytes'] for m in snapshot['messages'].values())
+        busiest = sorted(snapshot['callbacks'].items(), key=lambda x: x[1]['total'], reverse=True)[:top]
+        handlers = ', '.join(f'{k} {v["count"]}x p99 {v["p99"] * 1e3:.2f}ms' for k, v in busiest)
+        lag = snapshot['queue_lag']
+        return (f'{messages} msgs, {size} bytes in {snapshot["elapsed"]:.0f}s, queue {snapshot["queue_size"]}, '
+                f'lag p50 {lag["p50"] * 1e3:.2f}ms p99 {lag["p99"] * 1e3:.2f}ms max {lag["max"] * 1e3:.2f}ms, '
+                f'handlers: {handlers}')
+
+    def _run(self):
+        while not self.stopped.wait(self.log_interval):
+            logger.info(f'Client {self.client.clientId} callbacks: {self.summary()}')
+            report = self.client.memory_report()
+            logger.info(f'Client {self.client.clientId} buffers: {len(report)} requests, '
+                        f'{sum(r["bytes"] for r in report) / 1e6:.1f} MB')
+            slots = ', '.join(f'{k} {v["in_use"]}/{v["capacity"]} used, {v["queued"]} queued, wait p50 '
+                              f'{v["wait"]["p50"]:.1f}s max {v["wait"]["max"]:.1f}s'
+                              for k, v in self.client.market_data_budget.metrics().items())
+            logger.info(f'Client {self.client.clientId} market data slots: {slots}')
@@ -0,0 +1,135 @@
+import os
+import queue
+import struct
+import threading
+import time
+from datetime import datetime
+
+from ibapi import comm
+from ibapi.decoder import Decoder
+
+from trading_bot.settings import BASE_DIR, TZ, logger
+
+JOURNAL_DIR = BASE_DIR / 'journal'
+MAGIC = b'IBJ1'
+FILE_HEADER = struct.Struct('<4sd')
+RECORD_HEADER = struct.Struct('<BdI')
+MESSAGE, SERVER_VERSION = 0, 1
+
+
+def journal_path(name=None):
+    stamp = datetime.now(tz=TZ).strftime("%Y-%m-%d_%H%M%S")
+    return JOURNAL_DIR / (f'{stamp}_{name}.ibj' if name else f'{stamp}.ibj')
+
+
+class JournalWriter:
+    """
+    Append-only binary journal of raw inbound TWS messages. Each record is kind, monotonic time and length followed
+    by the message bytes exactly as read from the socket, so replaying it goes through the normal decoder.
+    """
+
+    def __init__(self, path=None, flush_interval=1):
+        self.path = path or journal_path()
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, time.time()))
+        self.last_flush = time.monotonic()
+        logger.debug(f'Journaling TWS messages to {self.path}')
+
+    def write(self, kind, payload):
+        now = time.monotonic()
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(RECORD_HEADER.pack(kind, now, len(payload)))
+            self.file.write(payload)
+            if now - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = now
+
+    def write_message(self, msg):
+        self.write(MESSAGE, msg)
+
+    def write_server_version(self, version):
+        self.write(SERVER_VERSION, str(version).encode())
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class JournalQueue(queue.Queue):
+    """
+    Client message queue that journals every message as the reader thread receives it, preceded by the server
+    version whenever a (re)connect changes it since the decoder needs it to read the messages back.
+    """
+
+    def __init__(self, writer, client):
+        super().__init__()
+        self.writer = writer
+        self.client = client
+        self.server_version = None
+
+    def put(self, item, block=True, timeout=None):
+        server_version = self.client.serverVersion()
+        if server_version != self.server_version:
+            self.server_version = server_version
+            self.writer.write_server_version(server_version)
+        self.writer.write_message(item)
+        super().put(item, block, timeout)
+
+
+def read_journal(path):
+    # Yields (kind, monotonic time, payload) records, stops at a truncated tail
+    with open(path, 'rb') as f:
+        magic, _ = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a TWS journal')
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            kind, timestamp, length = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield kind, timestamp, payload
+
+
+class JournalReplayer:
+    """
+    Feeds a journal back through the EWrapper methods of wrapper, at the recorded pace divided by speed, or as fast
+    as possible with speed=None.
+    """
+
+    def __init__(self, path, wrapper, speed=1):
+        self.path = path
+        self.wrapper = wrapper
+        self.speed = speed
+        self.decoder = Decoder(wrapper, 0)
+        self.count = 0
+
+    def replay(self):
+        start = first = None
+        for kind, timestamp, payload in read_journal(self.path):
+            if kind == SERVER_VERSION:
+                self.decoder.serverVersion = int(payload)
+                continue
+            if self.speed:
+                if first is None:
+                    start, first = time.monotonic(), timestamp
+                wait = (timestamp - first) / self.speed - (time.monotonic() - start)
+                if wait > 0:
+                    time.sleep(wait)
+            try:
+                self.decoder.interpret(comm.read_fields(payload))
+            except Exception as e:
+                logger.exception(f'Could not replay journal message {payload[:40]}: {e}')
+            self.count += 1
+        logger.debug(f'Replayed {self.count} messages from {self.path}')
+        return self.count
+
@@ -0,0 +1,149 @@
+import heapq
+import itertools
+import threading
+import time
+
+from trading_bot.clients.history_scheduler import PRIORITY_CANDIDATE, PRIORITY_POSITION
+from trading_bot.clients.instrumentation import Histogram
+from trading_bot.clients.subscriptions import TICK_BY_TICK, MKT_DEPTH, REAL_TIME_BARS
+from trading_bot.settings import DEPTH_SLOTS, MARKET_DATA_LINES, TICK_BY_TICK_SLOTS, logger
+
+# TWS errors for a depth or tick-by-tick request over the account limit
+LIMIT_ERROR_CODES = {309: MKT_DEPTH, 10190: TICK_BY_TICK}
+# Seconds a capacity lowered by a limit error holds before the configured one is tried again
+LIMIT_COOLDOWN = 300
+
+
+class Slots:
+    def __init__(self, capacity):
+        self.limit = capacity
+        self.capacity = capacity
+        self.restore_timer = None
+        # req_id to the send callable, kept to send it again if TWS rejects it
+        self.holders = dict()
+        self.queue = []
+        self.queued = dict()
+        self.waits = Histogram()
+        self.granted = 0
+
+
+class MarketDataBudget:
+    """
+    Hands out the account's depth and tick-by-tick slots and the real time bar streams, each stream also taking one
+    of the market data lines. Real time bars have no limit of their own, only the lines.
+    Requests over the limit wait, by priority and first come first served within one, and are sent as soon as a
+    cancel frees a slot so an instance never waits on a stream TWS silently refused. A limit error from TWS puts
+    the request back at the head of the queue and lowers the capacity to what the account actually allows, until
+    cooldown seconds pass or TWS reconnects.
+    """
+
+    def __init__(self, depth_slots=DEPTH_SLOTS, tick_by_tick_slots=TICK_BY_TICK_SLOTS, lines=MARKET_DATA_LINES,
+                 cooldown=LIMIT_COOLDOWN):
+        self.lines = lines
+        self.cooldown = cooldown
+        self.slots = {MKT_DEPTH: Slots(depth_slots), TICK_BY_TICK: Slots(tick_by_tick_slots),
+                      REAL_TIME_BARS: Slots(lines)}
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def request(self, kind, req_id, send):
+        # Sends now if a slot is free or req_id already holds one (a replay), queues send otherwise
+        slots = self.slots.get(kind)
+        if slots is None:
+            send()
+            return
+        with self.lock:
+            if req_id not in slots.holders:
+                queued = slots.queued.get(req_id)
+                if queued is not None:
+                    queued[3] = send
+                    return
+                entry = [PRIORITY_CANDIDATE, next(self.counter), req_id, send, time.monotonic()]
+                heapq.heappush(slots.queue, entry)
+                slots.queued[req_id] = entry
+                sends = self._grant()
+                if req_id in slots.queued:
+                    logger.debug(f'{req_id}: Waiting for a {kind} slot, {len(slots.queued)} queued')
+            else:
+                slots.holders[req_id] = send
+                sends = [send]
+        for send in sends:
+            send()
+
+    def release(self, kind, req_id):
+        # Frees the slot of req_id, False if the request was still queued and so never sent
+        slots = self.slots.get(kind)
+        if slots is None:
+            return True
+        with self.lock:
+            if slots.queued.pop(req_id, None) is not None:
+                return False
+            sent = slots.holders.pop(req_id, None) is not None
+            sends = self._grant()
+        for send in sends:
+            send()
+        return sent
+
+    def on_rejected(self, kind, req_id):
+        slots = self.slots.get(kind)
+        if slots is None:
+            return
+        with self.lock:
+            send = slots.holders.pop(req_id, None)
+            if send is None:
+                return
+            slots.capacity = max(len(slots.holders), 1)
+            entry = [PRIORITY_POSITION - 1, next(self.counter), req_id, send, time.monotonic()]
+            heapq.heappush(slots.queue, entry)
+            slots.queued[req_id] = entry
+            if slots.restore_timer is not None:
+                slots.restore_timer.cancel()
+            slots.restore_timer = threading.Timer(self.cooldown, self.restore, (kind,))
+            slots.restore_timer.daemon = True
+            slots.restore_timer.start()
+        logger.info(f'{req_id}: {kind} request over the account limit, capacity lowered to {slots.capacity}')
+
+    def restore(self, kind=None):
+        # Back to the configured capacity for kind, or all kinds after a reconnect. TWS lowers it again if needed
+        with self.lock:
+            for k, slots in self.slots.items():
+                if kind not in (None, k) or slots.capacity == slots.limit:
+                    continue
+                if slots.restore_timer is not None:
+                    slots.restore_timer.cancel()
+                    slots.restore_timer = None
+                slots.capacity = slots.limit
+                logger.info(f'{k} capacity restored to {slots.capacity}')
+            sends = self._grant()
+        for send in sends:
+            send()
+
+    def _grant(self):
+        # Sends for the queued requests that fit now, callers run them outside the lock
+        sends = []
+        while self._lines_in_use() < self.lines:
+            best = None
+            for slots in self.slots.values():
+                while slots.queue and slots.queued.get(slots.queue[0][2]) is not slots.queue[0]:
+                    heapq.heappop(slots.queue)
+                if slots.queue and len(slots.holders) < slots.capacity and \
+                        (best is None or slots.queue[0][:2] < best.queue[0][:2]):
+                    best = slots
+            if best is None:
+                break
+            priority, seq, req_id, send, queued_at = heapq.heappop(best.queue)
+            del best.queued[req_id]
+            best.holders[req_id] = send
+            best.waits.add(time.monotonic() - queued_at)
+            best.granted += 1
+            sends.append(send)
+        return sends
+
+    def _lines_in_use(self):
+        return sum(len(slots.holders) for slots in self.slots.values())
+
+    def metrics(self):
+        with self.lock:
+            return {kind: {'capacity': slots.capacity, 'in_use': len(slots.holders), 'queued': len(slots.queued),
+                           'granted': slots.granted, 'wait': slots.waits.snapshot()}
+                    for kind, slots in self.slots.items()}
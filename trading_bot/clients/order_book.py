@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+TERMINAL_STATUSES = ('Filled', 'Cancelled', 'ApiCancelled', 'Inactive')
+CANCELLED_STATUSES = ('Cancelled', 'ApiCancelled', 'Inactive')
+
+
+def order_key(order_id):
+    # Order ids come back from the db as strings, from TWS as ints
+    try:
+        return int(order_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class OrderBook:
+    """
+    Latest order status and execution per order id.
+    Terminal orders are dropped after retention_seconds or once more than max_terminal_orders are kept.
+    watch() hands out a Future per order id that resolves once the order is completely filled, cancelled or
+    inactive, partial fills do not resolve it. Use asyncio.wrap_future() on it to await from a coroutine.
+    """
+
+    def __init__(self, retention_seconds=6 * 60 * 60, max_terminal_orders=10000):
+        self.retention_seconds = retention_seconds
+        self.max_terminal_orders = max_terminal_orders
+        self.lock = threading.RLock()
+        self.statuses = dict()
+        self.executions = dict()
+        # Orders placed or reported by openOrder that have not reached a terminal status yet
+        self.open_orders = set()
+        self.terminal_orders = OrderedDict()
+        self.watchers = dict()
+        self.version = 0
+
+    def __len__(self):
+        return len(self.statuses.keys() | self.executions.keys())
+
+    def __contains__(self, order_id):
+        order_id = order_key(order_id)
+        return order_id in self.open_orders or order_id in self.statuses or order_id in self.executions
+
+    def add_order(self, order_id, status=None):
+        # status is the one openOrder reports, TWS also sends it for orders already filled or cancelled
+        order_id = order_key(order_id)
+        if order_id is None or status in TERMINAL_STATUSES:
+            return
+        with self.lock:
+            # Working, an execution may have settled it before its openOrder came in
+            self._reopen(order_id)
+            self.version += 1
+
+    def update_status(self, order_id, status, avg_price, filled, remaining=None):
+        order_id = order_key(order_id)
+        with self.lock:
+            self.statuses[order_id] = {'order_id': order_id, 'status': status, 'avg_price': avg_price,
+                                       'filled': filled, 'remaining': remaining}
+            self.version += 1
+            done = status in TERMINAL_STATUSES or remaining == 0 and filled
+            if done:
+                self._mark_terminal(order_id)
+            else:
+                self._reopen(order_id)
+            future = self.watchers.pop(order_id, None) if done else None
+        self._resolve(future, order_id, status if status in TERMINAL_STATUSES else 'Filled')
+
+    def add_execution(self, order_id, symbol, avg_price, exec_time, shares=0, req_id=None):
+        order_id = order_key(order_id)
+        with self.lock:
+            prev = self.executions.get(order_id)
+            self.executions[order_id] = {'order_id': req_id, 'symbol': symbol, 'exec_order_id': order_id,
+                                         'exec_avg_price': avg_price, 'exec_time': exec_time,
+                                         'shares': shares + (prev['shares'] if prev else 0)}
+            self.version += 1
+            # A fill of a working order may be partial, its order status says when it is done. Executions of
+            # orders not working any more, like the ones TWS sends at startup, settle them right away
+            future = None
+            if order_id not in self.open_orders:
+                self._mark_terminal(order_id)
+                future = self.watchers.pop(order_id, None)
+        self._resolve(future, order_id, 'Filled')
+
+    def watch(self, order_id, callback=None):
+        order_id = order_key(order_id)
+        with self.lock:
+            future = self.watchers.get(order_id)
+            if future is None:
+                future = Future()
+                status = self.statuses.get(order_id)
+                if order_id in self.executions and order_id not in self.open_orders:
+                    self._resolve(future, order_id, 'Filled')
+                elif status is not None and status['status'] in TERMINAL_STATUSES:
+                    self._resolve(future, order_id, status['status'])
+                else:
+                    self.watchers[order_id] = future
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def get_status(self, order_id):
+        return self.statuses.get(order_key(order_id))
+
+    def get_execution(self, order_id, symbol=None):
+        execution = self.executions.get(order_key(order_id))
+        if execution is None or (symbol is not None and execution['symbol'] != symbol):
+            return None
+        return execution
+
+    def snapshot(self):
+        # Status and execution records are replaced on change, never modified, so copying the dicts is enough
+        with self.lock:
+            return self.version, dict(self.statuses), dict(self.executions)
+
+    def open_order_ids(self):
+        with self.lock:
+            return frozenset(self.open_orders)
+
+    def _resolve(self, future, order_id, status):
+        if future is not None and not future.done():
+            future.set_result({'order_id': order_id, 'status': status,
+                               'execution': self.executions.get(order_id)})
+
+    def _reopen(self, order_id):
+        # Callers hold the lock
+        self.terminal_orders.pop(order_id, None)
+        self.open_orders.add(order_id)
+
+    def _mark_terminal(self, order_id):
+        # Callers hold the lock
+        now = time.monotonic()
+        self.open_orders.discard(order_id)
+        self.terminal_orders[order_id] = now
+        self.terminal_orders.move_to_end(order_id)
+        self._prune(now)
+
+    def _prune(self, now):
+        while self.terminal_orders:
+            order_id, marked_at = next(iter(self.terminal_orders.items()))
+            if now - marked_at < self.retention_seconds and len(self.terminal_orders) <= self.max_terminal_orders:
+                break
+            del self.terminal_orders[order_id]
+            self.statuses.pop(order_id, None)
+            self.executions.pop(order_id, None)
@@ -0,0 +1,158 @@
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from ibapi.message import OUT
+
+from trading_bot.settings import logger
+
+# Every placeOrder shares one first in first out class, TWS rejects an order id lower than one it has seen
+PRIORITY_CANCEL, PRIORITY_ORDER, PRIORITY_DATA = 0, 1, 2
+CANCEL_MESSAGES = {str(v) for k, v in vars(OUT).items() if k.startswith('CANCEL_')} | {str(OUT.REQ_GLOBAL_CANCEL)}
+ORDER_MESSAGES = {str(OUT.PLACE_ORDER), str(OUT.CANCEL_ORDER)}
+# Sent straight away, TWS ignores everything else on a connection until it has seen it
+DIRECT_MESSAGES = {str(OUT.START_API)}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def wait_time(self):
+        # Seconds until a token is available, takes it when there is one
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class OutboundGateway:
+    """
+    Every message to TWS goes through here so a burst from many trade manager threads never goes over the
+    outbound message limit IB disconnects clients for. Messages leave at most rate per second after an initial
+    burst, cancels first, then orders, then data requests, first in first out within a priority.
+    Requests queued under the same key are coalesced: a newer placeOrder or data request for the same id replaces
+    the queued one and a cancel of a data request still in the queue drops both.
+    """
+
+    def __init__(self, client, ready=None, rate=40, burst=10):
+        self.client = client
+        self.ready = ready or client.isConnected
+        self.bucket = TokenBucket(rate, burst)
+        self.condition = threading.Condition()
+        self.queue = []
+        self.pending = dict()
+        self.counter = itertools.count()
+        self.local = threading.local()
+        self.sent = 0
+        self.coalesced = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        # Until started again messages go straight to the socket, where a closed connection refuses them
+        self.stopped.set()
+        self.thread = None
+        with self.condition:
+            self.condition.notify()
+
+    @contextmanager
+    def context(self, key=None, priority=None, cancel=False):
+        # Tags the message the wrapped EClient call sends with its coalescing key and priority
+        self.local.context = (key, priority, cancel)
+        try:
+            yield
+        finally:
+            self.local.context = None
+
+    def submit(self, msg):
+        msg_id = msg[:msg.find('\0')]
+        if msg_id in DIRECT_MESSAGES or self.thread is None:
+            self.client.send_now(msg)
+            return
+        key, priority, cancel = getattr(self.local, 'context', None) or (None, None, False)
+        cancel = cancel or msg_id in CANCEL_MESSAGES
+        if priority is None:
+            priority = PRIORITY_CANCEL if cancel else PRIORITY_ORDER if msg_id in ORDER_MESSAGES else PRIORITY_DATA
+
+        with self.condition:
+            queued = self.pending.get(key) if key is not None else None
+            if queued is not None:
+                self.coalesced += 1
+                if cancel and not queued[4] and msg_id != str(OUT.CANCEL_ORDER):
+                    # The request never went out so there is nothing to cancel
+                    self._drop(queued)
+                    return
+                if cancel == queued[4]:
+                    # Same request again, send the latest version in the place of the first
+                    queued[3] = msg
+                    return
+                # A cancel must not overtake the order it cancels, nor that order the ones placed before it
+                priority = max(priority, queued[0])
+            self._push([priority, next(self.counter), key, msg, cancel])
+            self.condition.notify()
+
+    def _push(self, entry):
+        heapq.heappush(self.queue, entry)
+        if entry[2] is not None:
+            self.pending[entry[2]] = entry
+
+    def _drop(self, entry):
+        # Lazy removal, the sender skips entries with no message
+        entry[3] = None
+        self.pending.pop(entry[2], None)
+
+    def clear(self):
+        with self.condition:
+            self.queue.clear()
+            self.pending.clear()
+
+    def _next(self):
+        # The next message to send, False when out of tokens and None once stopped
+        with self.condition:
+            while not self.stopped.is_set():
+                while self.queue and self.queue[0][3] is None:
+                    heapq.heappop(self.queue)
+                if self.queue and self.ready():
+                    break
+                self.condition.wait(0.5)
+            else:
+                return None
+            wait = self.bucket.wait_time()
+            if wait:
+                self.condition.wait(wait)
+                return False
+            entry = heapq.heappop(self.queue)
+            if entry[2] is not None and self.pending.get(entry[2]) is entry:
+                del self.pending[entry[2]]
+            return entry[3]
+
+    def _run(self):
+        while True:
+            msg = self._next()
+            if msg is None:
+                return
+            if msg is False:
+                continue
+            try:
+                self.client.send_now(msg)
+                self.sent += 1
+            except Exception as e:
+                logger.exception(f'Could not send message {msg[:20]!r} to TWS: {e}')
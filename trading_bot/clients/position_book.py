@@ -0,0 +1,75 @@
+import threading
+
+from trading_bot.settings import logger
+
+
+class PositionBook:
+    """
+    Positions keyed by symbol and conId. version is bumped on every change so readers can skip work with
+    changed_since(), subscribers are called with (position, delta) on each change.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_symbol = dict()
+        self.by_con_id = dict()
+        self.version = 0
+        self.subscribers = []
+
+    def __len__(self):
+        return len(self.by_symbol)
+
+    def __iter__(self):
+        return iter(list(self.by_symbol.values()))
+
+    def update(self, symbol, con_id, position, avg_cost):
+        with self.lock:
+            prev = self.by_symbol.get(symbol)
+            if prev is not None and prev['position'] == position and prev['avg_cost'] == avg_cost:
+                return
+            self.version += 1
+            pos = {'symbol': symbol, 'con_id': con_id, 'position': position, 'avg_cost': avg_cost,
+                   'version': self.version}
+            self.by_symbol[symbol] = pos
+            if con_id:
+                self.by_con_id[con_id] = pos
+            delta = position - (prev['position'] if prev is not None else 0)
+            subscribers = list(self.subscribers)
+
+        for callback in subscribers:
+            try:
+                callback(pos, delta)
+            except Exception as e:
+                logger.exception(e)
+
+    def get(self, symbol):
+        return self.by_symbol.get(symbol)
+
+    def get_by_con_id(self, con_id):
+        return self.by_con_id.get(con_id)
+
+    def position(self, symbol, con_id=0):
+        # By conId when the contract is qualified, a symbol alone may be shared by several contracts
+        pos = self.by_con_id.get(con_id) if con_id else None
+        if pos is None:
+            pos = self.by_symbol.get(symbol)
+        return pos['position'] if pos is not None else 0
+
+    def snapshot(self):
+        with self.lock:
+            return self.version, dict(self.by_symbol)
+
+    def changed_since(self, version, symbol=None):
+        if symbol is None:
+            return self.version != version
+        pos = self.by_symbol.get(symbol)
+        return pos is not None and pos['version'] > version
+
+    def subscribe(self, callback):
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
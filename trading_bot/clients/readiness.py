@@ -0,0 +1,65 @@
+import threading
+import time
+
+CONNECTED = 'connected'
+NEXT_VALID_ID = 'next_valid_id'
+ACCOUNT_SUMMARY_END = 'account_summary_end'
+ACCOUNT_DOWNLOAD_END = 'account_download_end'
+POSITION_END = 'position_end'
+OPEN_ORDER_END = 'open_order_end'
+EXEC_DETAILS_END = 'exec_details_end'
+SESSION_EVENTS = (CONNECTED, NEXT_VALID_ID, ACCOUNT_SUMMARY_END, ACCOUNT_DOWNLOAD_END, POSITION_END,
+                  OPEN_ORDER_END, EXEC_DETAILS_END)
+
+
+class Readiness:
+    """
+    Events set by the client callbacks once TWS has answered, so startup code can wait on the real condition with
+    a timeout instead of sleeping or spinning. History events are per request id.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {name: threading.Event() for name in SESSION_EVENTS}
+        self.history_events = dict()
+
+    def set(self, name):
+        self.events[name].set()
+
+    def is_set(self, name):
+        return self.events[name].is_set()
+
+    def wait(self, *names, timeout=None):
+        # True once all names are set, False if the timeout runs out first
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for name in names:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not self.events[name].wait(remaining):
+                return False
+        return True
+
+    def pending(self, *names):
+        return [name for name in names if not self.events[name].is_set()]
+
+    def clear(self):
+        # Session events only, a reconnect has to go through the handshake again
+        for event in self.events.values():
+            event.clear()
+
+    def history(self, req_id):
+        with self.lock:
+            event = self.history_events.get(req_id)
+            if event is None:
+                event = threading.Event()
+                self.history_events[req_id] = event
+            return event
+
+    def set_history(self, req_id):
+        self.history(req_id).set()
+
+    def wait_history(self, req_id, timeout=None):
+        return self.history(req_id).wait(timeout)
+
+    def release_history(self, req_id):
+        with self.lock:
+            self.history_events.pop(req_id, None)
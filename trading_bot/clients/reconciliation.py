@@ -0,0 +1,120 @@
+from trading_bot.clients.order_book import order_key, CANCELLED_STATUSES
+from trading_bot.clients.readiness import POSITION_END, OPEN_ORDER_END, EXEC_DETAILS_END
+from trading_bot.settings import logger
+
+STILL_OPEN = 'still_open'
+FILLED_WHILE_DOWN = 'filled_while_down'
+CANCELLED = 'cancelled'
+ORPHANED = 'orphaned'
+CLASSIFICATIONS = (STILL_OPEN, FILLED_WHILE_DOWN, CANCELLED, ORPHANED)
+STARTUP_EVENTS = (POSITION_END, OPEN_ORDER_END, EXEC_DETAILS_END)
+
+
+class ReconciledTrade:
+    def __init__(self, trade, status, entry_filled, exit_pending=False, closed=False, entry_execution=None,
+                 exit_execution=None, exit_order_id=None, order_status=None):
+        self.trade = trade
+        self.status = status
+        self.entry_filled = entry_filled
+        self.exit_pending = exit_pending
+        self.closed = closed
+        self.entry_execution = entry_execution
+        self.exit_execution = exit_execution
+        self.exit_order_id = exit_order_id
+        self.order_status = order_status
+
+    def __repr__(self):
+        return f'{self.trade["symbol"]}: {self.status}, closed: {self.closed}, trade_id: {self.trade["trade_id"]}'
+
+    @property
+    def entry_filled_while_down(self):
+        # Entry fill the db has not recorded yet
+        return self.entry_execution is not None and self.trade['entry_order_status'] != 'FILLED'
+
+
+class Reconciliation:
+    """
+    Open db trades classified against TWS. Closed trades need only a db update, the others a trade manager
+    started from entry_filled and exit_pending. untracked holds TWS positions no db trade accounts for.
+    """
+
+    def __init__(self):
+        self.trades = {status: [] for status in CLASSIFICATIONS}
+        self.untracked = []
+
+    def __iter__(self):
+        return (r for status in CLASSIFICATIONS for r in self.trades[status])
+
+    def open(self):
+        return [r for r in self if not r.closed]
+
+    def closed(self):
+        return [r for r in self if r.closed]
+
+    def summary(self):
+        return {status: len(trades) for status, trades in self.trades.items()}
+
+
+def reconcile(client, trades, exit_fields=('exit_order_id',), timeout=30):
+    """
+    Joins the open db trades with the positions, open orders and executions TWS sent at startup in one pass, once
+    positionEnd, openOrderEnd and execDetailsEnd are all in. None if they do not arrive within timeout.
+    """
+    if not client.readiness.wait(*STARTUP_EVENTS, timeout=timeout):
+        logger.error(f'Cannot reconcile open trades, waiting for: {client.readiness.pending(*STARTUP_EVENTS)}')
+        return None
+
+    order_book = client.order_book
+    open_orders = order_book.open_order_ids()
+    # Signed shares per symbol not yet claimed by a db trade
+    unclaimed = {p['symbol']: p['position'] for p in client.position_book if p['position']}
+    result = Reconciliation()
+    for trade in trades:
+        reconciled = _classify(trade, order_book, open_orders, unclaimed, exit_fields)
+        result.trades[reconciled.status].append(reconciled)
+        if reconciled.status != STILL_OPEN:
+            logger.info(f'Reconciled {reconciled}')
+
+    result.untracked = [{'symbol': symbol, 'position': position} for symbol, position in unclaimed.items()
+                        if position]
+    for position in result.untracked:
+        logger.warning(f'{position["symbol"]}: TWS position of {position["position"]} not in the database')
+    logger.info(f'Reconciled {len(trades)} open trades: {result.summary()}')
+    return result
+
+
+def _classify(trade, order_book, open_orders, unclaimed, exit_fields):
+    symbol = trade['symbol']
+    entry_execution = order_book.get_execution(trade['entry_order_id'], symbol)
+    entry_filled = trade['entry_order_status'] == 'FILLED' or entry_execution is not None
+    exit_ids = [i for i in (order_key(trade.get(f)) for f in exit_fields) if i is not None]
+
+    for exit_id in exit_ids:
+        exit_execution = order_book.get_execution(exit_id, symbol)
+        if exit_execution is not None:
+            return ReconciledTrade(trade, FILLED_WHILE_DOWN, True, closed=True, entry_execution=entry_execution,
+                                   exit_execution=exit_execution, exit_order_id=exit_id)
+
+    if not entry_filled:
+        if order_key(trade['entry_order_id']) in open_orders:
+            return ReconciledTrade(trade, STILL_OPEN, False)
+        # Neither working nor filled, TWS only reports a status for orders cancelled in this session
+        status = order_book.get_status(trade['entry_order_id'])
+        order_status = status['status'] if status is not None and status['status'] in CANCELLED_STATUSES \
+            else 'Cancelled'
+        return ReconciledTrade(trade, CANCELLED, False, closed=True, order_status=order_status)
+
+    sign = 1 if trade['side'] == 'BUY' else -1
+    qty = int(trade['quantity'])
+    if unclaimed.get(symbol, 0) * sign < qty:
+        return ReconciledTrade(trade, ORPHANED, True, closed=True, entry_execution=entry_execution)
+    unclaimed[symbol] -= sign * qty
+
+    exit_pending = any(i in open_orders for i in exit_ids)
+    if entry_execution is not None and trade['entry_order_status'] != 'FILLED':
+        status = FILLED_WHILE_DOWN
+    elif exit_ids and not exit_pending:
+        status = CANCELLED
+    else:
+        status = STILL_OPEN
+    return ReconciledTrade(trade, status, True, exit_pending=exit_pending, entry_execution=entry_execution)
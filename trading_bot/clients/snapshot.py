@@ -0,0 +1,123 @@
+import threading
+from types import MappingProxyType
+
+import pandas as pd
+
+from trading_bot.clients.bar_store import BAR_FIELDS
+from trading_bot.clients.order_book import order_key
+from trading_bot.settings import TZ
+
+EMPTY = MappingProxyType({})
+
+
+class ClientSnapshot:
+    """
+    Immutable view of positions, orders, bars, depth and last ticks at one version, read the same way as the books
+    it was taken from. Safe to share between threads without locks, it never changes after it is published.
+    """
+
+    __slots__ = ('version', 'positions', 'statuses', 'executions', 'bars', 'depth', 'ticks')
+
+    def __init__(self, version=0, positions=EMPTY, statuses=EMPTY, executions=EMPTY, bars=EMPTY, depth=EMPTY,
+                 ticks=EMPTY):
+        self.version = version
+        self.positions = positions
+        self.statuses = statuses
+        self.executions = executions
+        self.bars = bars
+        self.depth = depth
+        self.ticks = ticks
+
+    def position(self, symbol):
+        pos = self.positions.get(symbol)
+        return pos['position'] if pos is not None else 0
+
+    def changed_since(self, version, symbol):
+        # Same as PositionBook.changed_since for one symbol, as of this snapshot
+        pos = self.positions.get(symbol)
+        return pos is not None and pos['version'] > version
+
+    def get_status(self, order_id):
+        return self.statuses.get(order_key(order_id))
+
+    def get_execution(self, order_id, symbol=None):
+        execution = self.executions.get(order_key(order_id))
+        if execution is None or (symbol is not None and execution['symbol'] != symbol):
+            return None
+        return execution
+
+    def frame(self, req_id):
+        bars = self.bars.get(req_id)
+        if bars is None:
+            return pd.DataFrame(columns=list(BAR_FIELDS))
+        _, times, columns = bars
+        index = pd.to_datetime(times, unit='s', utc=True).tz_convert(TZ)
+        return pd.DataFrame(columns, index=index, columns=list(BAR_FIELDS), copy=False)
+
+    def depth_metrics(self, req_id):
+        return self.depth.get(req_id)
+
+    def latest_tick(self, req_id):
+        return self.ticks.get(req_id)
+
+
+class SnapshotPublisher:
+    """
+    Builds a ClientSnapshot when one is asked for and something changed since the last, copy on write: only the
+    books and bar series whose version moved are copied again, the rest is shared with the previous snapshot. The
+    new snapshot is swapped in with one assignment so readers see either the old or the new one whole.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.snapshot = ClientSnapshot()
+        self.versions = dict()
+
+    def current(self):
+        with self.lock:
+            prev = self.snapshot
+            changed = False
+            client = self.client
+
+            positions = prev.positions
+            if client.position_book.version != self.versions.get('positions'):
+                version, by_symbol = client.position_book.snapshot()
+                self.versions['positions'] = version
+                positions, changed = MappingProxyType(by_symbol), True
+
+            statuses, executions = prev.statuses, prev.executions
+            if client.order_book.version != self.versions.get('orders'):
+                version, statuses, executions = client.order_book.snapshot()
+                self.versions['orders'] = version
+                statuses, executions, changed = MappingProxyType(statuses), MappingProxyType(executions), True
+
+            bars = dict()
+            for req_id, series in list(client.bar_store.series.items()):
+                entry = prev.bars.get(req_id)
+                bars[req_id] = entry if entry is not None and entry[0] == series.version else series.snapshot()
+                changed = changed or bars[req_id] is not entry
+            changed = changed or len(bars) != len(prev.bars)
+
+            depth = dict()
+            for req_id, book in list(client.depth_books.books.items()):
+                entry = prev.depth.get(req_id)
+                depth[req_id] = entry if entry is not None and entry['updates'] == book.updates else \
+                    MappingProxyType(book.metrics())
+                changed = changed or depth[req_id] is not entry
+            changed = changed or len(depth) != len(prev.depth)
+
+            ticks = dict()
+            for req_id, buffer in list(client.tick_store.buffers.items()):
+                entry = prev.ticks.get(req_id)
+                latest = entry if entry is not None and entry['seq'] == buffer.seq else buffer.latest()
+                if latest is not None:
+                    ticks[req_id] = latest
+                changed = changed or latest is not entry
+            changed = changed or len(ticks) != len(prev.ticks)
+
+            if changed:
+                self.snapshot = ClientSnapshot(prev.version + 1, positions, statuses, executions,
+                                               MappingProxyType(bars), MappingProxyType(depth),
+                                               MappingProxyType(ticks))
+            return self.snapshot
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import deque
+
+TICK_BY_TICK = 'tick_by_tick'
+REAL_TIME_BARS = 'real_time_bars'
+MKT_DEPTH = 'mkt_depth'
+HISTORICAL = 'historical'
+SCANNER = 'scanner'
+POSITIONS = 'positions'
+ACCOUNT_SUMMARY = 'account_summary'
+ACCOUNT_UPDATES = 'account_updates'
+# One shot requests that are worth sending again after a reconnect to catch up on what happened meanwhile
+EXECUTIONS = 'executions'
+OPEN_ORDERS = 'open_orders'
+
+# Lifecycle of a request: sent, data arriving, cancelled, buffers released
+OPEN, STREAMING, CANCELLED, RECLAIMED = 'open', 'streaming', 'cancelled', 'reclaimed'
+
+
+class Subscription:
+    def __init__(self, kind, req_id, method, args):
+        self.kind = kind
+        self.req_id = req_id
+        self.method = method
+        self.args = args
+        self.state = OPEN
+        self.opened = time.time()
+
+    def __repr__(self):
+        return f'Subscription(kind: {self.kind}, req_id: {self.req_id}, method: {self.method}, state: {self.state})'
+
+
+class SubscriptionRegistry:
+    """
+    Active streaming requests with the arguments needed to send them again after a reconnect, and the last
+    retired_size cancelled ones so messages TWS sends after the cancel do not recreate their buffers.
+    """
+
+    def __init__(self, retired_size=4096):
+        self.lock = threading.Lock()
+        self.subscriptions = dict()
+        self.retired = deque(maxlen=retired_size)
+        self.retired_keys = set()
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+    def __contains__(self, key):
+        return key in self.subscriptions
+
+    def add(self, kind, req_id, method, args):
+        with self.lock:
+            self.subscriptions[(kind, req_id)] = Subscription(kind, req_id, method, args)
+            self._unretire((kind, req_id))
+
+    def remove(self, kind, req_id=None):
+        with self.lock:
+            subscription = self.subscriptions.pop((kind, req_id), None)
+        if subscription is not None:
+            subscription.state = CANCELLED
+        return subscription
+
+    def retire(self, kind, req_id):
+        with self.lock:
+            key = (kind, req_id)
+            if key in self.retired_keys:
+                return
+            if len(self.retired) == self.retired.maxlen:
+                self.retired_keys.discard(self.retired[0])
+            self.retired.append(key)
+            self.retired_keys.add(key)
+
+    def streaming(self, kind, req_id):
+        # Called with every message of a stream, moves its subscription on from OPEN with the first one
+        subscription = self.subscriptions.get((kind, req_id))
+        if subscription is not None and subscription.state == OPEN:
+            subscription.state = STREAMING
+
+    def is_retired(self, kind, req_id):
+        return (kind, req_id) in self.retired_keys
+
+    def revive(self, kind, req_id):
+        # A retired id requested again
+        with self.lock:
+            self._unretire((kind, req_id))
+
+    def _unretire(self, key):
+        # Callers hold the lock. The key leaves the deque too, or its eviction would drop a later retirement
+        if key in self.retired_keys:
+            self.retired_keys.discard(key)
+            self.retired.remove(key)
+
+    def get(self, kind, req_id=None):
+        return self.subscriptions.get((kind, req_id))
+
+    def active(self):
+        with self.lock:
+            return list(self.subscriptions.values())
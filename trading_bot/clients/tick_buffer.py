@@ -0,0 +1,86 @@
+import threading
+
+import numpy as np
+
+
+class TickBuffer:
+    """
+    Last capacity trade prints of one tick-by-tick request in circular arrays of epoch seconds, prices and sizes.
+    seq counts every print written, latest() reads the most recent one back so readers never act on stale prices.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.times = np.zeros(capacity, dtype='int64')
+        self.prices = np.zeros(capacity, dtype='float64')
+        self.sizes = np.zeros(capacity, dtype='float64')
+        self.seq = 0
+
+    def __len__(self):
+        return min(self.seq, self.capacity)
+
+    @property
+    def nbytes(self):
+        return self.times.nbytes + self.prices.nbytes + self.sizes.nbytes
+
+    def append(self, time, price, size):
+        with self.lock:
+            i = self.seq % self.capacity
+            self.times[i] = time
+            self.prices[i] = price
+            self.sizes[i] = size
+            self.seq += 1
+
+    def latest(self):
+        with self.lock:
+            if not self.seq:
+                return None
+            i = (self.seq - 1) % self.capacity
+            return {'seq': self.seq, 'time': int(self.times[i]), 'price': float(self.prices[i]),
+                    'size': float(self.sizes[i])}
+
+    def since(self, seq):
+        # Ticks written after seq, oldest first. Ticks already overwritten are skipped.
+        with self.lock:
+            first = max(seq, self.seq - self.capacity)
+            idx = np.arange(first, self.seq) % self.capacity
+            return self.seq, self.times[idx], self.prices[idx], self.sizes[idx]
+
+
+class TickStore:
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.buffers = dict()
+
+    def __contains__(self, req_id):
+        return req_id in self.buffers
+
+    def get(self, req_id):
+        return self.buffers.get(req_id)
+
+    def create(self, req_id, capacity=None):
+        buffer = self.buffers.get(req_id)
+        if buffer is None:
+            buffer = TickBuffer(capacity or self.capacity)
+            self.buffers[req_id] = buffer
+        return buffer
+
+    def append(self, req_id, time, price, size):
+        buffer = self.buffers.get(req_id)
+        if buffer is None:
+            buffer = self.create(req_id)
+        buffer.append(time, price, size)
+
+    def latest(self, req_id):
+        buffer = self.buffers.get(req_id)
+        return buffer.latest() if buffer is not None else None
+
+    def since(self, req_id, seq=0):
+        buffer = self.buffers.get(req_id)
+        if buffer is None:
+            return seq, np.empty(0, dtype='int64'), np.empty(0), np.empty(0)
+        return buffer.since(seq)
+
+    def release(self, req_id):
+        return self.buffers.pop(req_id, None)
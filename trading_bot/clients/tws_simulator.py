@@ -0,0 +1,656 @@
+import heapq
+import itertools
+import os
+import random
+import socket
+import threading
+import time
+from datetime import datetime
+
+import pandas as pd
+from ibapi import comm
+from ibapi.message import IN, OUT
+from ibapi.server_versions import MAX_CLIENT_VER
+
+from trading_bot.settings import TZ, logger
+
+SERVER_VERSION = MAX_CLIENT_VER
+ACCOUNT = 'DU0000000'
+BAR_SECONDS = {'sec': 1, 'secs': 1, 'min': 60, 'mins': 60, 'hour': 3600, 'hours': 3600, 'day': 86400, 'days': 86400,
+               'week': 604800, 'month': 2592000}
+DURATION_SECONDS = {'S': 1, 'D': 86400, 'W': 604800, 'M': 2592000, 'Y': 31536000}
+MAX_BARS = 20000
+REAL_TIME_BAR_SECONDS = 5
+
+
+def bar_seconds(bar_size):
+    count, unit = bar_size.split()
+    return int(count) * BAR_SECONDS[unit]
+
+
+def duration_seconds(duration):
+    count, unit = duration.split()
+    return int(count) * DURATION_SECONDS[unit]
+
+
+class SymbolFeed:
+    """Price of one symbol, a random walk unless started from recorded bars, with the bar being built from it."""
+
+    def __init__(self, symbol, con_id, price, volatility, bars=None):
+        self.symbol = symbol
+        self.con_id = con_id
+        self.price = price
+        self.volatility = volatility
+        self.bars = bars
+        self.random = random.Random(symbol)
+        self.bar_open = self.bar_high = self.bar_low = price
+        self.bar_volume = 0
+        self.bar_start = None
+        self.real_time_bar = None
+
+    def step(self, now, bar_size):
+        self.price = round(max(self.price * (1 + self.random.gauss(0, self.volatility)), 0.01), 2)
+        size = self.random.randint(1, 10) * 100
+        start = int(now) - int(now) % bar_size
+        if start != self.bar_start:
+            self.bar_start = start
+            self.bar_open = self.bar_high = self.bar_low = self.price
+            self.bar_volume = 0
+        self.bar_high = max(self.bar_high, self.price)
+        self.bar_low = min(self.bar_low, self.price)
+        self.bar_volume += size
+        if self.real_time_bar is None:
+            self.real_time_bar = [self.price, self.price, self.price, self.price, 0, 0]
+        bar = self.real_time_bar
+        bar[1], bar[2], bar[3] = max(bar[1], self.price), min(bar[2], self.price), self.price
+        bar[4] += size
+        bar[5] += 1
+        return self.price, size
+
+    def take_real_time_bar(self):
+        # Open, high, low, close, volume and count since the last call, None when nothing traded
+        bar, self.real_time_bar = self.real_time_bar, None
+        return bar
+
+    def history(self, end, bar_size, count):
+        # Recorded bars when there are any, otherwise walk back from the current price
+        if self.bars is not None and len(self.bars):
+            bars = self.bars.iloc[-count:]
+            return [(int(t.timestamp()), r.open, r.high, r.low, r.close, int(r.volume)) for t, r in bars.iterrows()]
+        walk = random.Random(f'{self.symbol}:history')
+        bars = list()
+        close = self.price
+        for i in range(count):
+            open_ = round(max(close * (1 + walk.gauss(0, self.volatility * 5)), 0.01), 2)
+            high = round(max(open_, close) * (1 + abs(walk.gauss(0, self.volatility))), 2)
+            low = round(min(open_, close) * (1 - abs(walk.gauss(0, self.volatility))), 2)
+            bars.append((end - (i + 1) * bar_size, open_, high, low, close, walk.randint(1, 100) * 1000))
+            close = open_
+        bars.reverse()
+        return bars
+
+
+class SimulatedOrder:
+    def __init__(self, order_id, symbol, con_id, action, quantity, order_type, limit_price, stop_price, oca_group,
+                 parent_id, client_id):
+        self.order_id = order_id
+        self.symbol = symbol
+        self.con_id = con_id
+        self.action = action
+        self.quantity = quantity
+        self.order_type = order_type
+        self.limit_price = limit_price
+        self.stop_price = stop_price
+        self.oca_group = oca_group
+        self.parent_id = parent_id
+        self.client_id = client_id
+        self.status = 'PendingSubmit'
+        self.triggered = False
+        self.perm_id = order_id + 1000000
+
+    def fill_price(self, price):
+        # Price this order fills at given the last trade, None while it is not marketable
+        buy = self.action == 'BUY'
+        if self.order_type in ('STP', 'STP LMT') and not self.triggered:
+            if (buy and price < self.stop_price) or (not buy and price > self.stop_price):
+                return None
+            self.triggered = True
+        if self.order_type in ('LMT', 'STP LMT'):
+            if (buy and price > self.limit_price) or (not buy and price < self.limit_price):
+                return None
+            return self.limit_price
+        return price
+
+
+class Session:
+    """One API client connection."""
+
+    def __init__(self, server, conn, address):
+        self.server = server
+        self.conn = conn
+        self.address = address
+        self.send_lock = threading.Lock()
+        self.client_id = None
+        self.connected = True
+        self.tick_by_tick = dict()
+        self.depth = dict()
+        self.history_updates = dict()
+        self.real_time_bars = dict()
+        self.scanners = dict()
+        self.account_summaries = dict()
+        self.positions = False
+        self.account_updates = False
+
+    def send(self, *fields):
+        msg = comm.make_msg(''.join(comm.make_field(f) for f in fields))
+        with self.send_lock:
+            try:
+                self.conn.sendall(msg)
+            except OSError:
+                self.connected = False
+
+    def run(self):
+        buf = b''
+        try:
+            buf = self._handshake(buf)
+            while self.connected:
+                data = self.conn.recv(65536)
+                if not data:
+                    break
+                buf += data
+                while True:
+                    size, text, buf = comm.read_msg(buf)
+                    if not text:
+                        break
+                    fields = [f.decode(errors='backslashreplace') for f in comm.read_fields(text)]
+                    try:
+                        self.server.handle(self, fields)
+                    except Exception as e:
+                        logger.exception(f'Simulator could not handle {fields[:3]}: {e}')
+        except OSError:
+            pass
+        finally:
+            self.connected = False
+            self.conn.close()
+            self.server.remove_session(self)
+            logger.debug(f'Simulator client {self.client_id} disconnected')
+
+    def _handshake(self, buf):
+        while len(buf) < 4 or not comm.read_msg(buf[4:])[1]:
+            data = self.conn.recv(1024)
+            if not data:
+                raise OSError('Connection closed during handshake')
+            buf += data
+        if buf[:4] != b'API\0':
+            raise OSError('Not an API client')
+        size, text, rest = comm.read_msg(buf[4:])
+        connection_time = datetime.now(tz=TZ).strftime('%Y%m%d %H:%M:%S EST')
+        self.conn.sendall(comm.make_msg(comm.make_field(SERVER_VERSION) + comm.make_field(connection_time)))
+        return rest
+
+
+class TwsSimulator:
+    """
+    Stand-in for TWS/IB Gateway that speaks enough of the socket protocol for EClient to connect and run unchanged.
+    Serves historical bars (recorded from data_dir/<SYMBOL>.csv when present, random walk otherwise), 5 second real
+    time bars, tick-by-tick prints, L2 depth, scanner results, positions and account values, and fills orders after ack_latency and
+    fill_latency seconds. Load is set with tick_interval and ticks_per_step.
+    """
+
+    def __init__(self, host='127.0.0.1', port=7497, scanner_symbols=None, positions=None, cash=100000,
+                 data_dir=None, start_price=50, volatility=0.0005, tick_interval=0.1, ticks_per_step=1,
+                 bar_update_interval=5, scanner_interval=30, ack_latency=0.05, fill_latency=0.1, next_order_id=1):
+        self.host = host
+        self.port = port
+        self.scanner_symbols = scanner_symbols or ['AAPL', 'MSFT', 'AMZN', 'TSLA', 'NVDA', 'AMD', 'META', 'NFLX',
+                                                   'GOOGL', 'INTC']
+        self.cash = cash
+        self.realized_pnl = 0
+        self.data_dir = data_dir
+        self.start_price = start_price
+        self.volatility = volatility
+        self.tick_interval = tick_interval
+        self.ticks_per_step = ticks_per_step
+        self.bar_update_interval = bar_update_interval
+        self.scanner_interval = scanner_interval
+        self.ack_latency = ack_latency
+        self.fill_latency = fill_latency
+        self.next_order_id = next_order_id
+
+        self.lock = threading.RLock()
+        self.feeds = dict()
+        self.con_ids = itertools.count(100001)
+        self.positions = dict()
+        for symbol, (quantity, avg_cost) in (positions or dict()).items():
+            self.positions[symbol] = [quantity, avg_cost]
+        self.orders = dict()
+        self.executions = list()
+        self.exec_ids = itertools.count(1)
+        self.sessions = list()
+        self.events = list()
+        self.event_seq = itertools.count()
+        self.event_condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.listener = None
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen()
+        for target in (self._accept, self._run_market, self._run_events):
+            threading.Thread(target=target, daemon=True).start()
+        logger.info(f'TWS simulator listening on {self.host}:{self.port}')
+
+    def stop(self):
+        self.stopped.set()
+        if self.listener is not None:
+            self.listener.close()
+        with self.event_condition:
+            self.event_condition.notify()
+        for session in list(self.sessions):
+            session.connected = False
+            try:
+                session.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def remove_session(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    def feed(self, symbol):
+        with self.lock:
+            feed = self.feeds.get(symbol)
+            if feed is None:
+                bars = self._load_bars(symbol)
+                price = bars['close'].iloc[-1] if bars is not None and len(bars) else self.start_price
+                feed = SymbolFeed(symbol, next(self.con_ids), price, self.volatility, bars)
+                self.feeds[symbol] = feed
+            return feed
+
+    def _load_bars(self, symbol):
+        if self.data_dir is None:
+            return None
+        path = os.path.join(self.data_dir, f'{symbol}.csv')
+        if not os.path.exists(path):
+            return None
+        df = pd.read_csv(path)
+        df['datetime'] = pd.to_datetime(df['datetime'])
+        return df.set_index('datetime')
+
+    def schedule(self, delay, callback, *args):
+        with self.event_condition:
+            heapq.heappush(self.events, (time.monotonic() + delay, next(self.event_seq), callback, args))
+            self.event_condition.notify()
+
+    def _accept(self):
+        while not self.stopped.is_set():
+            try:
+                conn, address = self.listener.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = Session(self, conn, address)
+            with self.lock:
+                self.sessions.append(session)
+            threading.Thread(target=session.run, daemon=True).start()
+
+    def _run_events(self):
+        while not self.stopped.is_set():
+            with self.event_condition:
+                if not self.events:
+                    self.event_condition.wait()
+                    continue
+                wait = self.events[0][0] - time.monotonic()
+                if wait > 0:
+                    self.event_condition.wait(wait)
+                    continue
+                _, _, callback, args = heapq.heappop(self.events)
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.exception(f'Simulator event failed: {e}')
+
+    def _run_market(self):
+        last_bar_update = last_real_time_bar = last_scan = time.monotonic()
+        while not self.stopped.is_set():
+            started = time.monotonic()
+            with self.lock:
+                sessions = list(self.sessions)
+                symbols = {s for session in sessions for s in self._session_symbols(session)}
+                symbols.update(o.symbol for o in self.orders.values() if o.status in ('Submitted', 'PreSubmitted'))
+            now = time.time()
+            for symbol in symbols:
+                feed = self.feed(symbol)
+                for _ in range(self.ticks_per_step):
+                    price, size = feed.step(now, 60)
+                    for session in sessions:
+                        for req_id, (tick_symbol, tick_type) in list(session.tick_by_tick.items()):
+                            if tick_symbol == symbol:
+                                session.send(IN.TICK_BY_TICK, req_id, tick_type, int(now), price, size, 0, 'NASDAQ',
+                                             '')
+                for session in sessions:
+                    for req_id, (depth_symbol, rows, smart) in list(session.depth.items()):
+                        if depth_symbol == symbol:
+                            self._send_depth(session, req_id, feed, rows, smart, operation=1)
+                self._check_orders(symbol, feed.price)
+
+            if started - last_bar_update >= self.bar_update_interval:
+                last_bar_update = started
+                for session in sessions:
+                    for req_id, (symbol, size, format_date) in list(session.history_updates.items()):
+                        feed = self.feed(symbol)
+                        date = self._bar_date(feed.bar_start or int(now), size, format_date)
+                        session.send(IN.HISTORICAL_DATA_UPDATE, req_id, -1, date, feed.bar_open, feed.price,
+                                     feed.bar_high, feed.bar_low, feed.price, feed.bar_volume)
+            if started - last_real_time_bar >= REAL_TIME_BAR_SECONDS:
+                last_real_time_bar = started
+                bars = dict()
+                for session in sessions:
+                    for req_id, symbol in list(session.real_time_bars.items()):
+                        if symbol not in bars:
+                            bars[symbol] = self.feed(symbol).take_real_time_bar()
+                        if bars[symbol] is None:
+                            continue
+                        o, h, l, c, v, count = bars[symbol]
+                        session.send(IN.REAL_TIME_BARS, 3, req_id, int(now) - REAL_TIME_BAR_SECONDS, o, h, l, c, v, c,
+                                     count)
+            if started - last_scan >= self.scanner_interval:
+                last_scan = started
+                for session in sessions:
+                    for req_id, (scan_code, rows) in list(session.scanners.items()):
+                        self._send_scanner(session, req_id, scan_code, rows)
+
+            self.stopped.wait(max(self.tick_interval - (time.monotonic() - started), 0))
+
+    @staticmethod
+    def _session_symbols(session):
+        symbols = [s for s, _ in session.tick_by_tick.values()]
+        symbols += [s for s, _, _ in session.depth.values()]
+        symbols += [s for s, _, _ in session.history_updates.values()]
+        symbols += list(session.real_time_bars.values())
+        return symbols
+
+    def handle(self, session, fields):
+        msg_id = int(fields[0])
+        handler = self.handlers.get(msg_id)
+        if handler is None:
+            logger.debug(f'Simulator ignoring message {msg_id}')
+            return
+        handler(self, session, fields)
+
+    def _start_api(self, session, fields):
+        session.client_id = int(fields[2])
+        session.send(IN.NEXT_VALID_ID, 1, self.next_order_id)
+        session.send(IN.MANAGED_ACCTS, 1, ACCOUNT)
+
+    def _req_ids(self, session, fields):
+        session.send(IN.NEXT_VALID_ID, 1, self.next_order_id)
+
+    def _req_historical_data(self, session, fields):
+        req_id, symbol = int(fields[1]), fields[3]
+        bar_size, duration, format_date, keep_up_to_date = fields[16], fields[17], int(fields[20]), fields[21] == '1'
+        size = bar_seconds(bar_size)
+        count = max(min(duration_seconds(duration) // size, MAX_BARS), 1)
+        end = int(time.time()) - int(time.time()) % size
+        feed = self.feed(symbol)
+        bars = feed.history(end, size, count)
+        out = [IN.HISTORICAL_DATA, req_id, '', '', len(bars)]
+        for t, o, h, l, c, v in bars:
+            out += [self._bar_date(t, size, format_date), o, h, l, c, v, c, 1]
+        session.send(*out)
+        if keep_up_to_date:
+            session.history_updates[req_id] = (symbol, size, format_date)
+
+    @staticmethod
+    def _bar_date(t, size, format_date):
+        if size >= 86400:
+            return datetime.fromtimestamp(t, tz=TZ).strftime('%Y%m%d')
+        if format_date == 2:
+            return t
+        return datetime.fromtimestamp(t, tz=TZ).strftime('%Y%m%d  %H:%M:%S')
+
+    def _cancel_historical_data(self, session, fields):
+        session.history_updates.pop(int(fields[2]), None)
+
+    def _req_real_time_bars(self, session, fields):
+        session.real_time_bars[int(fields[2])] = fields[4]
+
+    def _cancel_real_time_bars(self, session, fields):
+        session.real_time_bars.pop(int(fields[2]), None)
+
+    def _req_tick_by_tick(self, session, fields):
+        tick_type = 2 if fields[14] == 'AllLast' else 1
+        session.tick_by_tick[int(fields[1])] = (fields[3], tick_type)
+
+    def _cancel_tick_by_tick(self, session, fields):
+        session.tick_by_tick.pop(int(fields[1]), None)
+
+    def _req_mkt_depth(self, session, fields):
+        req_id, symbol, rows, smart = int(fields[2]), fields[4], int(fields[15]), fields[16] == '1'
+        session.depth[req_id] = (symbol, rows, smart)
+        self._send_depth(session, req_id, self.feed(symbol), rows, smart, operation=0)
+
+    def _cancel_mkt_depth(self, session, fields):
+        session.depth.pop(int(fields[2]), None)
+
+    def _send_depth(self, session, req_id, feed, rows, smart, operation):
+        for side, sign in ((1, -1), (0, 1)):
+            for position in range(rows):
+                price = round(feed.price + sign * 0.01 * (position + 1), 2)
+                size = feed.random.randint(1, 50) * 100
+                session.send(IN.MARKET_DEPTH_L2, 1, req_id, position, 'SIM', operation, side, price, size, smart)
+
+    def _req_scanner(self, session, fields):
+        req_id, rows, scan_code = int(fields[1]), int(fields[2] or 0), fields[5]
+        rows = rows if rows > 0 else 50
+        session.scanners[req_id] = (scan_code, rows)
+        self._send_scanner(session, req_id, scan_code, rows)
+
+    def _cancel_scanner(self, session, fields):
+        session.scanners.pop(int(fields[2]), None)
+
+    def _send_scanner(self, session, req_id, scan_code, rows):
+        symbols = list(self.scanner_symbols)
+        random.Random(f'{scan_code}:{int(time.time() // self.scanner_interval)}').shuffle(symbols)
+        out = [IN.SCANNER_DATA, 3, req_id, min(rows, len(symbols))]
+        for rank, symbol in enumerate(symbols[:rows]):
+            feed = self.feed(symbol)
+            out += [rank, feed.con_id, symbol, 'STK', '', 0.0, '', 'SMART', 'USD', symbol, 'NMS', 'NMS', '', '', '',
+                    '']
+        session.send(*out)
+
+    def _req_contract_data(self, session, fields):
+        req_id, symbol, sec_type = int(fields[2]), fields[4], fields[5]
+        feed = self.feed(symbol)
+        session.send(IN.CONTRACT_DATA, 8, req_id, symbol, sec_type, '', 0.0, '', 'SMART', 'USD', symbol, 'NMS', 'NMS',
+                     feed.con_id, 0.01, 1, '', 'LMT,MKT,STP,STP LMT', 'SMART,NASDAQ,NYSE', 1, 0, symbol, 'NASDAQ',
+                     '', '', '', '', 'US/Eastern', '', '', '', 0, 0, 1, '', '', '26', '', 'COMMON')
+        session.send(IN.CONTRACT_DATA_END, 1, req_id)
+
+    def _req_positions(self, session, fields):
+        session.positions = True
+        with self.lock:
+            positions = list(self.positions.items())
+        for symbol, (quantity, avg_cost) in positions:
+            self._send_position(session, symbol, quantity, avg_cost)
+        session.send(IN.POSITION_END, 1)
+
+    def _cancel_positions(self, session, fields):
+        session.positions = False
+
+    def _send_position(self, session, symbol, quantity, avg_cost):
+        feed = self.feed(symbol)
+        session.send(IN.POSITION_DATA, 3, ACCOUNT, feed.con_id, symbol, 'STK', '', 0.0, '', '', 'NASDAQ', 'USD',
+                     symbol, 'NMS', quantity, avg_cost)
+
+    def account_values(self):
+        with self.lock:
+            unrealized = sum((self.feed(s).price - cost) * qty for s, (qty, cost) in self.positions.items())
+            market_value = sum(self.feed(s).price * qty for s, (qty, _) in self.positions.items())
+        net_liquidation = self.cash + market_value
+        return {'TotalCashBalance': self.cash, 'CashBalance': self.cash, 'NetLiquidation': net_liquidation,
+                'BuyingPower': self.cash * 4, 'AvailableFunds': self.cash, 'UnrealizedPnL': unrealized,
+                'RealizedPnL': self.realized_pnl}
+
+    def _req_account_summary(self, session, fields):
+        req_id = int(fields[2])
+        session.account_summaries[req_id] = fields[4]
+        self._send_account_summary(session, req_id)
+
+    def _send_account_summary(self, session, req_id):
+        for tag, value in self.account_values().items():
+            session.send(IN.ACCOUNT_SUMMARY, 1, req_id, ACCOUNT, tag, round(value, 2), 'USD')
+        session.send(IN.ACCOUNT_SUMMARY_END, 1, req_id)
+
+    def _cancel_account_summary(self, session, fields):
+        session.account_summaries.pop(int(fields[2]), None)
+
+    def _req_account_updates(self, session, fields):
+        session.account_updates = fields[2] == '1'
+        if session.account_updates:
+            self._send_account_updates(session)
+
+    def _send_account_updates(self, session):
+        for key, value in self.account_values().items():
+            session.send(IN.ACCT_VALUE, 2, key, round(value, 2), 'USD', ACCOUNT)
+        with self.lock:
+            positions = list(self.positions.items())
+        for symbol, (quantity, avg_cost) in positions:
+            feed = self.feed(symbol)
+            session.send(IN.PORTFOLIO_VALUE, 8, feed.con_id, symbol, 'STK', '', 0.0, '', '', 'NASDAQ', 'USD', symbol,
+                         'NMS', quantity, feed.price, round(feed.price * quantity, 2), avg_cost,
+                         round((feed.price - avg_cost) * quantity, 2), 0.0, ACCOUNT)
+        session.send(IN.ACCT_UPDATE_TIME, 1, datetime.now(tz=TZ).strftime('%H:%M'))
+        session.send(IN.ACCT_DOWNLOAD_END, 1, ACCOUNT)
+
+    def _req_open_orders(self, session, fields):
+        session.send(IN.OPEN_ORDER_END, 1)
+
+    def _req_executions(self, session, fields):
+        req_id = int(fields[2])
+        with self.lock:
+            executions = list(self.executions)
+        for execution in executions:
+            self._send_execution(session, req_id, *execution)
+        session.send(IN.EXECUTION_DATA_END, 1, req_id)
+
+    def _place_order(self, session, fields):
+        order_id, symbol = int(fields[1]), fields[3]
+        order = SimulatedOrder(order_id, symbol, self.feed(symbol).con_id, fields[16], float(fields[17]), fields[18],
+                               float(fields[19] or 0), float(fields[20] or 0), fields[22], int(fields[28] or 0),
+                               session.client_id)
+        with self.lock:
+            self.orders[order_id] = order
+            self.next_order_id = max(self.next_order_id, order_id + 1)
+        self.schedule(self.ack_latency, self._acknowledge, order)
+
+    def _cancel_order(self, session, fields):
+        order = self.orders.get(int(fields[2]))
+        if order is not None and order.status not in ('Filled', 'Cancelled'):
+            self.schedule(self.ack_latency, self._set_status, order, 'Cancelled')
+
+    def _acknowledge(self, order):
+        parent = self.orders.get(order.parent_id)
+        # Children of an unfilled bracket parent wait
+        self._set_status(order, 'PreSubmitted' if parent is not None and parent.status != 'Filled' else 'Submitted')
+        self._check_orders(order.symbol, self.feed(order.symbol).price)
+
+    def _set_status(self, order, status, fill_price=0.0):
+        order.status = status
+        filled = order.quantity if status == 'Filled' else 0
+        for session in self._order_sessions(order):
+            session.send(IN.ORDER_STATUS, order.order_id, status, filled, order.quantity - filled, fill_price,
+                         order.perm_id, order.parent_id, fill_price, order.client_id, '', 0.0)
+
+    def _order_sessions(self, order):
+        return [s for s in list(self.sessions) if s.client_id == order.client_id]
+
+    def _check_orders(self, symbol, price):
+        with self.lock:
+            working = [o for o in self.orders.values() if o.symbol == symbol and o.status == 'Submitted']
+            for order in working:
+                fill_price = order.fill_price(price)
+                if fill_price is not None:
+                    order.status = 'Filling'
+                    self.schedule(self.fill_latency, self._fill, order, fill_price)
+
+    def _fill(self, order, price):
+        if order.status != 'Filling':
+            return
+        signed = order.quantity if order.action == 'BUY' else -order.quantity
+        with self.lock:
+            quantity, avg_cost = self.positions.get(order.symbol, [0, 0.0])
+            if quantity == 0 or (quantity > 0) == (signed > 0):
+                avg_cost = (avg_cost * abs(quantity) + price * abs(signed)) / (abs(quantity) + abs(signed))
+            else:
+                closed = min(abs(quantity), abs(signed))
+                self.realized_pnl += closed * (price - avg_cost) * (1 if quantity > 0 else -1)
+            quantity += signed
+            self.positions[order.symbol] = [quantity, avg_cost if quantity else 0.0]
+            self.cash -= signed * price
+            exec_time = datetime.now(tz=TZ).strftime('%Y%m%d  %H:%M:%S')
+            execution = (order, f'0000sim.{next(self.exec_ids)}', exec_time, price)
+            self.executions.append(execution)
+            siblings = [o for o in self.orders.values() if order.oca_group and o is not order and
+                        o.oca_group == order.oca_group and o.status not in ('Filled', 'Cancelled')]
+            children = [o for o in self.orders.values() if o.parent_id == order.order_id and o.status == 'PreSubmitted']
+
+        self._set_status(order, 'Filled', price)
+        for session in self._order_sessions(order):
+            self._send_execution(session, -1, *execution)
+        for session in list(self.sessions):
+            if session.positions:
+                self._send_position(session, order.symbol, *self.positions[order.symbol])
+            for req_id in list(session.account_summaries):
+                self._send_account_summary(session, req_id)
+            if session.account_updates:
+                self._send_account_updates(session)
+        for sibling in siblings:
+            self._set_status(sibling, 'Cancelled')
+        for child in children:
+            self._set_status(child, 'Submitted')
+
+    def _send_execution(self, session, req_id, order, exec_id, exec_time, price):
+        session.send(IN.EXECUTION_DATA, req_id, order.order_id, order.con_id, order.symbol, 'STK', '', 0.0, '', '',
+                     'SMART', 'USD', order.symbol, 'NMS', exec_id, exec_time, ACCOUNT, 'NASDAQ',
+                     'BOT' if order.action == 'BUY' else 'SLD', order.quantity, price, order.perm_id, order.client_id,
+                     0, order.quantity, price, '', '', 0.0, '', 1)
+
+    handlers = {
+        OUT.START_API: _start_api,
+        OUT.REQ_IDS: _req_ids,
+        OUT.REQ_HISTORICAL_DATA: _req_historical_data,
+        OUT.CANCEL_HISTORICAL_DATA: _cancel_historical_data,
+        OUT.REQ_REAL_TIME_BARS: _req_real_time_bars,
+        OUT.CANCEL_REAL_TIME_BARS: _cancel_real_time_bars,
+        OUT.REQ_TICK_BY_TICK_DATA: _req_tick_by_tick,
+        OUT.CANCEL_TICK_BY_TICK_DATA: _cancel_tick_by_tick,
+        OUT.REQ_MKT_DEPTH: _req_mkt_depth,
+        OUT.CANCEL_MKT_DEPTH: _cancel_mkt_depth,
+        OUT.REQ_SCANNER_SUBSCRIPTION: _req_scanner,
+        OUT.CANCEL_SCANNER_SUBSCRIPTION: _cancel_scanner,
+        OUT.REQ_CONTRACT_DATA: _req_contract_data,
+        OUT.REQ_POSITIONS: _req_positions,
+        OUT.CANCEL_POSITIONS: _cancel_positions,
+        OUT.REQ_ACCOUNT_SUMMARY: _req_account_summary,
+        OUT.CANCEL_ACCOUNT_SUMMARY: _cancel_account_summary,
+        OUT.REQ_ACCT_DATA: _req_account_updates,
+        OUT.REQ_ALL_OPEN_ORDERS: _req_open_orders,
+        OUT.REQ_OPEN_ORDERS: _req_open_orders,
+        OUT.REQ_EXECUTIONS: _req_executions,
+        OUT.PLACE_ORDER: _place_order,
+        OUT.CANCEL_ORDER: _cancel_order,
+    }
+
+
+def run(port=7497, **kwargs):
+    simulator = TwsSimulator(port=port, **kwargs)
+    simulator.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
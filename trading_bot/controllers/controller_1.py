@@ -1,10 +1,8 @@
 from datetime import datetime
-from threading import Thread
-from time import sleep
 
 from ibapi.client import ExecutionFilter
 
-from trading_bot.clients.ib_client import IBapi
+from trading_bot.clients.client_pool import IBClientPool
 from trading_bot.database.db import ScannedData
 from trading_bot.scrappers.benzinga import BenzingaScraper
 from trading_bot.screeners.momentum_screener import MomentumScreener
@@ -42,7 +40,7 @@ class Controller:
     def run_trading_instance(self, args):
         symbol, price = args
         # Initialize Trade manager
-        contract = self.client.make_contract(symbol, 'STK', 'SMART', 'ISLAND')
+        contract = self.client.get_contract(symbol)
         trading_bot = TvTradeManager(self.client, trading_mode=self.trading_mode,
                                      contract=contract, pos_limit=self.position_limit,
                                      instruction='BUY', order_type=self.order_type,
@@ -89,20 +87,19 @@ class Controller:
 def run(rsi_period, gap_percent, price_limit, rsi_threshold, volume_period, volume_multiplier,
         trading_mode='PAPER', order_type='MKT', position_limit=100):
     # Initialize IB client
-    client = IBapi()
+    client = IBClientPool()
     socket_port = 7497 if trading_mode.lower() == 'paper' else 7496
-    client.connect('127.0.0.1', socket_port, 123)
-    client_thread = Thread(target=client.run, daemon=True)
-    client_thread.start()
-    sleep(3)
+    client.start('127.0.0.1', socket_port, 123)
+    if not client.wait_ready():
+        return
     client.reqPositions()
-    client.reqAccountSummary(9002, "All", "$LEDGER")
+    client.reqAccountUpdates(True, '')
     client.reqAllOpenOrders()
-    client.reqExecutions(10001, ExecutionFilter())
-    while not client.total_amount:
-        pass
+    client.reqExecutions(client.next_req_id(), ExecutionFilter())
+    if not client.wait_account() or not client.total_amount:
+        logger.error('Could not read account balance from TWS, exiting')
+        return
 
-    sleep(1)
     logger.info('IB client started')
 
     scrapper = BenzingaScraper()
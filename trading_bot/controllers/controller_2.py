@@ -1,5 +1,3 @@
-import threading
-import time
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
@@ -7,7 +5,9 @@ import investpy
 import pandas as pd
 from ibapi.client import ExecutionFilter
 
-from trading_bot.clients.ib_client import IBapi
+from trading_bot.clients.client_pool import IBClientPool
+from trading_bot.clients.order_book import order_key
+from trading_bot.clients.reconciliation import reconcile, CANCELLED, FILLED_WHILE_DOWN
 from trading_bot.database.db import engine, session, TradesDataAll, ScannedData
 from trading_bot.database.db_handler import save_trade
 from trading_bot.scrappers.benzinga import BenzingaScraper
@@ -27,6 +27,10 @@ class Controller:
         self.trade_args = trade_args
         self.symbols_received = []
         self.symbols_passed_screener = []
+        self.executor = ThreadPoolExecutor()
+        for manager in trade_managers.values():
+            manager.wake = self.wake
+        self.client.position_book.subscribe(self.on_position)
 
     def run_screening_instance(self, args, benchmark_change):
         obj, symbol, news = args
@@ -47,7 +51,7 @@ class Controller:
 
     def create_trading_instance(self, unq_id, args):
         symbol, instruction, price = args
-        contract = self.client.make_contract(symbol, 'STK', 'SMART', 'ISLAND')
+        contract = self.client.get_contract(symbol)
         pos_limit = self.client.total_amount * (self.pos_limit / 100)
         self.client.reqMktDepth(unq_id, contract, 5, True, [])
         self.client.reqTickByTickData(unq_id, contract, "AllLast", 0, False)
@@ -55,11 +59,12 @@ class Controller:
         # Initialize Trade manager
         trade_obj = TradeManager(client=self.client, unique_id=unq_id, contract=contract, pos_limit=pos_limit,
                                  ltp=price, instruction=instruction, **self.trade_args)
+        trade_obj.wake = self.wake
         self.trade_managers[trade_obj.symbol] = trade_obj
 
     @staticmethod
-    def run_trading_instance(obj):
-        return obj.trade()
+    def run_trading_instance(obj, snapshot):
+        return obj.trade(snapshot)
 
     def run(self):
         if not self.scrapper.data_queue.empty():
@@ -100,27 +105,74 @@ class Controller:
         else:
             filtered_symbols = [(i['symbol'], 'BUY', None) for i in data if i['symbol'] not in self.trade_managers]
 
-        for i, s in enumerate(filtered_symbols, start=self.client.nextorderId):
-            self.create_trading_instance(unq_id=i, args=s)
-
-        max_workers = self.client.open_stocks_limit if self.client.open_stocks_limit > 0 else 1
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            res = executor.map(self.run_trading_instance, list(self.trade_managers.values()))
-        res = [r for r in res if r is not None]
-
-        for r in res:
-            # Store trade details if trade data received
-            if isinstance(r, dict):
-                if r['msg']:
-                    for i in r['msg']:
-                        if i:
-                            for k, v in i.items():
-                                save_trade(k, v)
-            else:
-                # Remove instance if trade is ended for it
-                if r.trade_ended:
-                    del self.trade_managers[r.symbol]
-                    logger.debug(f'{r.symbol} instance removed from trading manager')
+        for s in filtered_symbols:
+            self.create_trading_instance(unq_id=self.client.next_req_id(), args=s)
+
+        # One view of the client for the whole round, managers read it without locks so all of them run at once
+        snapshot = self.client.snapshot()
+        managers = list(self.trade_managers.values())
+        for r in self.executor.map(self.run_trading_instance, managers, [snapshot] * len(managers)):
+            self.handle_result(r)
+
+    def wake(self, manager):
+        # Called on the IB thread when an order of manager settles, its fill is handled now instead of next round
+        self.executor.submit(self.run_woken_instance, manager)
+
+    def on_position(self, position, delta):
+        # Called on the IB thread when a position moves, its manager checks it now instead of next round
+        manager = self.trade_managers.get(position['symbol'])
+        if manager is not None:
+            self.wake(manager)
+
+    def run_woken_instance(self, manager):
+        try:
+            self.handle_result(manager.trade())
+        except Exception as e:
+            logger.exception(e)
+
+    def handle_result(self, r):
+        if r is None:
+            return
+        # Store trade details if trade data received
+        if isinstance(r, dict):
+            if r['msg']:
+                for i in r['msg']:
+                    if i:
+                        for k, v in i.items():
+                            save_trade(k, v)
+        # Remove instance if trade is ended for it, a woken run may have removed it already
+        elif r.trade_ended and self.trade_managers.get(r.symbol) is r:
+            del self.trade_managers[r.symbol]
+            self.client.cancel_request(r.id)
+            logger.debug(f'{r.symbol} instance removed from trading manager')
+
+
+def reconciled_updates(r):
+    # Db updates closing a trade reconciliation found settled while the bot was down
+    trade = r.trade
+    key = {'symbol': trade['symbol'], 'trade_id': trade['trade_id']}
+    if r.status == CANCELLED:
+        return [('confirm_entry', {**key, 'entry_time': None, 'entry_price': None, 'stop_loss': None,
+                                   'target': None, 'entry_order_status': r.order_status, 'position_status': None})]
+    updates = []
+    if r.entry_filled_while_down:
+        updates.append(('confirm_entry', {**key, 'entry_time': r.entry_execution['exec_time'],
+                                          'entry_price': r.entry_execution['exec_avg_price'], 'stop_loss': None,
+                                          'target': None, 'entry_order_status': 'FILLED', 'position_status': 'OPEN'}))
+    if r.status == FILLED_WHILE_DOWN:
+        sl_filled = r.exit_order_id == order_key(trade['sl_exit_order_id'])
+        updates.append(('confirm_exit', {**key, 'exit_time': r.exit_execution['exec_time'],
+                                         'exit_price': r.exit_execution['exec_avg_price'],
+                                         'exit_type': 'SL' if sl_filled else 'Target',
+                                         'sl_exit_order_status': 'FILLED' if sl_filled else 'CANCELED',
+                                         'tr_exit_order_status': 'CANCELED' if sl_filled else 'FILLED',
+                                         'position_status': 'CLOSED'}))
+    else:
+        # Orphaned, same as a manager finding no position to exit
+        updates.append(('confirm_exit', {**key, 'exit_time': None, 'exit_price': None, 'exit_type': None,
+                                         'sl_exit_order_status': None, 'tr_exit_order_status': None,
+                                         'position_status': None}))
+    return updates
 
 
 def main(trading_mode, pos_limit, stop_loss, target, stock_limit, rsi_period, gap_percent, price_limit,
@@ -148,25 +200,21 @@ def main(trading_mode, pos_limit, stop_loss, target, stock_limit, rsi_period, ga
     open_pos_stock_list = list(open_pos_stock_list.T.to_dict().values())
     open_pos_symbols = {s['symbol']: s for s in open_pos_stock_list}
 
-    client = IBapi()
+    client = IBClientPool()
     socket_port = 7497 if trading_mode.lower() == 'paper' else 7496
-    client.connect('127.0.0.1', socket_port, 123)
-
-    client_thread = threading.Thread(target=client.run, daemon=True)
-    client_thread.start()
-
-    time.sleep(3)
+    client.start('127.0.0.1', socket_port, 123)
+    if not client.wait_ready():
+        return
     client.reqPositions()
-    client.reqAccountSummary(9002, "All", "$LEDGER")
+    client.reqAccountUpdates(True, '')
     client.reqAllOpenOrders()
-    client.reqExecutions(10001, ExecutionFilter())
+    client.reqExecutions(client.next_req_id(), ExecutionFilter())
 
-    while not client.total_amount:
-        pass
-
-    client.open_stocks_limit = stock_limit
+    if not client.wait_account() or not client.total_amount:
+        logger.error('Could not read account balance from TWS, exiting')
+        return
 
-    time.sleep(1)
+    client.position_slots.set_capacity(stock_limit)
     logger.info('IB client started')
 
     trade_managers = dict()
@@ -174,15 +222,25 @@ def main(trading_mode, pos_limit, stop_loss, target, stock_limit, rsi_period, ga
     trade_args = {'trading_mode': trading_mode, 'target': target, 'stop_loss': stop_loss,
                   'entry_order_type': order_type}
 
-    for i, s in enumerate(open_pos_symbols, start=client.nextorderId):
+    reconciliation = reconcile(client, list(open_pos_symbols.values()),
+                               exit_fields=('sl_exit_order_id', 'tr_exit_order_id'))
+    if reconciliation is None:
+        return
+    for r in reconciliation.closed():
+        for action, params in reconciled_updates(r):
+            save_trade(action, params)
+
+    for r in reconciliation.open():
+        i = client.next_req_id()
+        s = r.trade['symbol']
         logger.info(f'open position/order found in {s}, reading parameters...')
-        contract = client.make_contract(s, 'STK', 'SMART', 'ISLAND')
+        contract = client.get_contract(s)
         kwargs = {'client': client, 'unique_id': i, 'contract': contract,
                   'pos_limit': client.total_amount * (pos_limit / 100), **trade_args}
 
-        trade = open_pos_symbols[s]
-        entry_order_filled = True if trade['entry_order_status'] == 'FILLED' else False
-        exit_pending = True if trade['sl_exit_order_status'] == 'OPEN' else False
+        trade = r.trade
+        # An entry filled while down is confirmed by the manager on its first round
+        entry_order_filled = r.entry_filled and not r.entry_filled_while_down
         bought = True if trade['side'] == 'BUY' else False
         sold = True if trade['side'] == 'SELL' else False
         extra_args = {'entered': True, 'entry_order_filled': entry_order_filled,
@@ -190,11 +248,11 @@ def main(trading_mode, pos_limit, stop_loss, target, stock_limit, rsi_period, ga
                       'instruction': trade['instruction'], 'qty': trade['quantity'],
                       'entry_order_id': trade['entry_order_id'], 'sl_exit_order_id': trade['sl_exit_order_id'],
                       'tr_exit_order_id': trade['tr_exit_order_id'],
-                      'sl': trade['stop_loss'], 'tr': trade['target'], 'exit_pending': exit_pending,
+                      'sl': trade['stop_loss'], 'tr': trade['target'], 'exit_pending': r.exit_pending,
                       'entry_order_price': trade['entry_order_price'], 'trade_id': trade['trade_id'],
                       'sl_exit_order_price': trade['sl_exit_order_price'],
                       'tr_exit_order_price': trade['tr_exit_order_price']}
-        client.open_stocks_limit -= 1
+        client.position_slots.acquire(force=True)
 
         kwargs.update(extra_args)
 
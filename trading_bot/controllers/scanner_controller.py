@@ -1,12 +1,13 @@
-import threading
-import time
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 from ibapi.client import ExecutionFilter
 
-from trading_bot.clients.ib_client import IBapi
+from trading_bot.clients.bar_builder import REAL_TIME_BARS
+from trading_bot.clients.history_scheduler import PRIORITY_CANDIDATE, PRIORITY_POSITION
+from trading_bot.clients.client_pool import IBClientPool
+from trading_bot.clients.reconciliation import reconcile, CANCELLED, FILLED_WHILE_DOWN
 from trading_bot.database.db import engine, session, ScannerTradesData, ScannersSourceData
 from trading_bot.database.db_handler import save_scan_bot_trade
 from trading_bot.settings import logger, TZ
@@ -29,8 +30,12 @@ class Controller:
         self.hot_by_volume_id = hot_by_volume_id
         self.benzinga_scraper_symbols_received = []
         self.bbs_scraper_symbols_received = []
+        self.executor = ThreadPoolExecutor()
+        for manager in trade_managers.values():
+            manager.wake = self.wake
+        self.client.position_book.subscribe(self.on_position)
 
-    def create_trading_instance(self, unq_id, contract, rank, instruction, scan_name):
+    def create_trading_instance(self, contract, rank, instruction, scan_name):
         if contract.symbol not in self.benzinga_scraper_symbols_received or \
                 contract.symbol not in self.bbs_scraper_symbols_received:
             return
@@ -64,17 +69,21 @@ class Controller:
         logger.debug(f'{contract.symbol}: Scanned data Saved')
 
         pos_limit = self.client.total_amount * (self.pos_limit / 100)
-        self.client.reqHistoricalData(unq_id, contract, '', f'2 D', '1 min', 'TRADES', 0, 2, True, [])
+        contract = self.client.contract_cache.get(contract.symbol) or contract
+        unq_id = self.client.next_req_id()
+        # Minute bars from 5 second real time bars, tick-by-tick lines are too few to give every candidate one
+        self.client.build_bars(unq_id, contract, source=REAL_TIME_BARS, priority=PRIORITY_CANDIDATE)
 
         # Initialize Trade manager
         trade_obj = TradeManager(client=self.client, unique_id=unq_id, contract=contract, pos_limit=pos_limit,
                                  rank=rank, instruction=instruction, side=instruction, scan_name=scan_name,
                                  **self.trade_args)
+        trade_obj.wake = self.wake
         self.trade_managers[trade_obj.symbol] = trade_obj
 
     @staticmethod
-    def run_trading_instance(obj):
-        return obj.trade()
+    def run_trading_instance(obj, snapshot):
+        return obj.trade(snapshot)
 
     def run(self):
         if self.benzinga_scrapper is not None and not self.benzinga_scrapper.data_queue.empty():
@@ -92,7 +101,6 @@ class Controller:
         scanned_contracts = self.client.scanned_contracts
         if not len(scanned_contracts):
             return
-        i = self.client.nextorderId
         top_gainers, top_losers, hot_by_volume = [], [], []
         if self.top_gainers_id in scanned_contracts:
             top_gainers = scanned_contracts[self.top_gainers_id]
@@ -100,43 +108,76 @@ class Controller:
             top_losers = scanned_contracts[self.top_losers_id]
         if self.hot_by_volume_id in scanned_contracts:
             hot_by_volume = scanned_contracts[self.hot_by_volume_id]
-        for i, s in enumerate(top_gainers, start=self.client.nextorderId):
-            self.create_trading_instance(unq_id=i, rank=s, instruction='BUY', contract=top_gainers[s],
-                                         scan_name='TOP_GAINERS')
+        for s in top_gainers:
+            self.create_trading_instance(rank=s, instruction='BUY', contract=top_gainers[s], scan_name='TOP_GAINERS')
 
-        self.client.nextorderId = i + 1
+        for s in top_losers:
+            self.create_trading_instance(rank=s, instruction='SELL', contract=top_losers[s], scan_name='TOP_LOSERS')
 
-        for i, s in enumerate(top_losers, start=self.client.nextorderId):
-            self.create_trading_instance(unq_id=i, rank=s, instruction='SELL', contract=top_losers[s],
-                                         scan_name='TOP_LOSERS')
-
-        self.client.nextorderId = i + 1
-
-        for i, s in enumerate(hot_by_volume, start=self.client.nextorderId):
-            self.create_trading_instance(unq_id=i, rank=s, instruction=None, contract=hot_by_volume[s],
+        for s in hot_by_volume:
+            self.create_trading_instance(rank=s, instruction=None, contract=hot_by_volume[s],
                                          scan_name='HOT_BY_VOLUME')
 
-        self.client.nextorderId = i + 1
-
-        max_workers = self.client.open_stocks_limit if self.client.open_stocks_limit > 0 else 1
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            res = executor.map(self.run_trading_instance, list(self.trade_managers.values()))
-        res = [r for r in res if r is not None]
-
-        for r in res:
-            # Store trade details if trade data received
-            if isinstance(r, dict):
-                if r['msg']:
-                    for i in r['msg']:
-                        if i:
-                            for k, v in i.items():
-                                save_scan_bot_trade(k, v)
-            else:
-                # Remove instance if trade is ended for it
-                if r.trade_ended:
-                    del self.trade_managers[r.symbol]
-                    self.client.cancelHistoricalData(r.id)
-                    logger.debug(f'{r.symbol} instance removed from trading manager')
+        # One view of the client for the whole round, managers read it without locks so all of them run at once
+        snapshot = self.client.snapshot()
+        managers = list(self.trade_managers.values())
+        for r in self.executor.map(self.run_trading_instance, managers, [snapshot] * len(managers)):
+            self.handle_result(r)
+
+    def wake(self, manager):
+        # Called on the IB thread when an order of manager settles, its fill is handled now instead of next round
+        self.executor.submit(self.run_woken_instance, manager)
+
+    def on_position(self, position, delta):
+        # Called on the IB thread when a position moves, its manager checks it now instead of next round
+        manager = self.trade_managers.get(position['symbol'])
+        if manager is not None:
+            self.wake(manager)
+
+    def run_woken_instance(self, manager):
+        try:
+            self.handle_result(manager.trade())
+        except Exception as e:
+            logger.exception(e)
+
+    def handle_result(self, r):
+        if r is None:
+            return
+        # Store trade details if trade data received
+        if isinstance(r, dict):
+            if r['msg']:
+                for i in r['msg']:
+                    if i:
+                        for k, v in i.items():
+                            save_scan_bot_trade(k, v)
+        # Remove instance if trade is ended for it, a woken run may have removed it already
+        elif r.trade_ended and self.trade_managers.get(r.symbol) is r:
+            del self.trade_managers[r.symbol]
+            self.client.cancel_request(r.id)
+            logger.debug(f'{r.symbol} instance removed from trading manager')
+
+
+def reconciled_updates(r):
+    # Db updates closing a trade reconciliation found settled while the bot was down
+    trade = r.trade
+    key = {'symbol': trade['symbol'], 'trade_id': trade['trade_id']}
+    if r.status == CANCELLED:
+        return [('confirm_entry', {**key, 'entry_time': None, 'entry_price': None,
+                                   'entry_order_status': r.order_status, 'position_status': None})]
+    updates = []
+    if r.entry_filled_while_down:
+        updates.append(('confirm_entry', {**key, 'entry_time': r.entry_execution['exec_time'],
+                                          'entry_price': r.entry_execution['exec_avg_price'],
+                                          'entry_order_status': 'FILLED', 'position_status': 'OPEN'}))
+    if r.status == FILLED_WHILE_DOWN:
+        updates.append(('confirm_exit', {**key, 'exit_time': r.exit_execution['exec_time'],
+                                         'exit_price': r.exit_execution['exec_avg_price'], 'exit_type': None,
+                                         'exit_order_status': 'FILLED', 'position_status': 'CLOSED'}))
+    else:
+        # Orphaned, same as a manager finding no position to exit
+        updates.append(('confirm_exit', {**key, 'exit_time': None, 'exit_price': None, 'exit_type': None,
+                                         'exit_order_status': None, 'position_status': None}))
+    return updates
 
 
 def main(trading_mode, pos_limit, stock_limit, exit_percent, top_gainers_to_track, top_gainers_to_trade, above_price,
@@ -165,45 +206,38 @@ def main(trading_mode, pos_limit, stock_limit, exit_percent, top_gainers_to_trac
     open_pos_stock_list = list(open_pos_stock_list.T.to_dict().values())
     open_pos_symbols = {s['symbol']: s for s in open_pos_stock_list}
 
-    client = IBapi()
+    client = IBClientPool()
     socket_port = 7497 if trading_mode.lower() == 'paper' else 7496
-    client.connect('127.0.0.1', socket_port, 123)
-
-    client_thread = threading.Thread(target=client.run, daemon=True)
-    client_thread.start()
-
-    time.sleep(3)
+    client.start('127.0.0.1', socket_port, 123)
+    if not client.wait_ready():
+        return
     client.reqPositions()
-    client.reqAccountSummary(9002, "All", "$LEDGER")
+    client.reqAccountUpdates(True, '')
     client.reqAllOpenOrders()
-    client.reqExecutions(10001, ExecutionFilter())
-    top_gainers_id = 5001  # client.nextorderId
+    client.reqExecutions(client.next_req_id(), ExecutionFilter())
+    top_gainers_id = client.next_req_id()
     scan_sub = client.get_sub(scan_name="TOP_PERC_GAIN", above_price=above_price, below_price=below_price,
                               above_volume=above_volume, average_volume=average_volume, market_cap_usd=market_cap_usd,
                               limit=top_gainers_to_track)
     client.reqScannerSubscription(top_gainers_id, scan_sub, [], [])
-    client.nextorderId += 1
 
-    top_losers_id = 5002  # client.nextorderId
+    top_losers_id = client.next_req_id()
     scan_sub = client.get_sub(scan_name="TOP_PERC_LOSE", above_price=above_price, below_price=below_price,
                               above_volume=above_volume, average_volume=average_volume, market_cap_usd=market_cap_usd,
                               limit=top_gainers_to_track)
     client.reqScannerSubscription(top_losers_id, scan_sub, [], [])
-    client.nextorderId += 1
 
-    hot_by_volume_id = 5003  # client.nextorderId
+    hot_by_volume_id = client.next_req_id()
     scan_sub = client.get_sub(scan_name="HOT_BY_VOLUME", above_price=above_price, below_price=below_price,
                               above_volume=above_volume, average_volume=average_volume, market_cap_usd=market_cap_usd,
                               limit=top_gainers_to_track)
     client.reqScannerSubscription(hot_by_volume_id, scan_sub, [], [])
-    client.nextorderId += 1
-
-    while not client.total_amount:
-        pass
 
-    client.open_stocks_limit = stock_limit
+    if not client.wait_account() or not client.total_amount:
+        logger.error('Could not read account balance from TWS, exiting')
+        return
 
-    time.sleep(1)
+    client.position_slots.set_capacity(stock_limit)
     logger.info('IB client started')
 
     if enable_benzinga:
@@ -226,30 +260,39 @@ def main(trading_mode, pos_limit, stock_limit, exit_percent, top_gainers_to_trac
                   'average_volume_period': average_volume_period, 'short_sma_period': short_sma_period,
                   'long_sma_period': long_sma_period, 'above_volume': above_volume}
 
-    for i, s in enumerate(open_pos_symbols, start=client.nextorderId):
+    reconciliation = reconcile(client, list(open_pos_symbols.values()))
+    if reconciliation is None:
+        return
+    for r in reconciliation.closed():
+        for action, params in reconciled_updates(r):
+            save_scan_bot_trade(action, params)
+
+    for r in reconciliation.open():
+        i = client.next_req_id()
+        s = r.trade['symbol']
         logger.info(f'open position/order found in {s}, reading parameters...')
-        contract = client.make_contract(s, 'STK', 'SMART', 'ISLAND')
+        contract = client.get_contract(s)
         kwargs = {'client': client, 'unique_id': i, 'contract': contract,
                   'pos_limit': client.total_amount * (pos_limit / 100), **trade_args}
 
-        trade = open_pos_symbols[s]
-        entry_order_filled = True if trade['entry_order_status'] == 'FILLED' else False
-        exit_pending = True if trade['exit_order_status'] == 'OPEN' else False
+        trade = r.trade
+        # An entry filled while down is confirmed by the manager on its first round
+        entry_order_filled = r.entry_filled and not r.entry_filled_while_down
         bought = True if trade['side'] == 'BUY' else False
         sold = True if trade['side'] == 'SELL' else False
         extra_args = {'entered': True, 'entry_order_filled': entry_order_filled,
                       'bought': bought, 'sold': sold, 'rank': trade['rank'],
                       'instruction': trade['instruction'], 'qty': trade['quantity'],
                       'entry_order_id': trade['entry_order_id'], 'exit_order_id': trade['exit_order_id'],
-                      'exit_pending': exit_pending, 'entry_order_price': trade['entry_order_price'],
+                      'exit_pending': r.exit_pending, 'entry_order_price': trade['entry_order_price'],
                       'trade_id': trade['trade_id'], 'exit_order_price': trade['exit_order_price'],
                       'initial_change': trade['initial_change'], 'side': trade['side'], 'scan_name': trade['scan_name']}
-        client.open_stocks_limit -= 1
+        client.position_slots.acquire(force=True)
 
         kwargs.update(extra_args)
 
         trade_managers[s] = TradeManager(**kwargs)
-        client.reqHistoricalData(i, contract, '', f'2 D', '1 min', 'TRADES', 0, 2, True, [])
+        client.build_bars(i, contract, source=REAL_TIME_BARS, priority=PRIORITY_POSITION)
 
     controller = Controller(client=client, trade_managers=trade_managers, benzinga_scrapper=benzinga_scrapper,
                             bbs_scrapper=bbs_scrapper, pos_limit=pos_limit,
@@ -15,6 +15,18 @@ PASSWORD = config['PASSWORD']
 HOSTNAME = config['HOSTNAME']
 PORT = config['PORT']
 DB_NAME = config['DB_NAME']
+# Set JOURNAL=true in .env to record every message from TWS under journal/
+JOURNAL = config.get('JOURNAL', '').lower() == 'true'
+# Set INSTRUMENT=true in .env to time every TWS callback and log a summary each minute
+INSTRUMENT = config.get('INSTRUMENT', '').lower() == 'true'
+# Account market data limits: lines, level 2 depth and tick-by-tick subscriptions held at the same time
+MARKET_DATA_LINES = int(config.get('MARKET_DATA_LINES', 100))
+DEPTH_SLOTS = int(config.get('DEPTH_SLOTS', 3))
+TICK_BY_TICK_SLOTS = int(config.get('TICK_BY_TICK_SLOTS', 5))
+# Threads running market data and history callbacks off the message loop, 0 (the default) runs every callback on it
+DISPATCH_WORKERS = int(config.get('DISPATCH_WORKERS', 0))
+# Set FAST_DECODE=true in .env to decode trade ticks, depth and bar updates on the fast path
+FAST_DECODE = config.get('FAST_DECODE', '').lower() == 'true'
 bba_url = 'https://sa3.blackboxstocks.com/signalr/connect?transport=serverSentEvents&clientProtocol=2.1&' \
           'connectionToken=eKkvh2FQ5TRck4hbU1KGebGmCU5zw0WIjNsMrMGGRe8ba7eECLlylBi4sbG9NS9Faib%2B3%2B4PQALdPcHcoXqysi' \
           'JVwGyavpz9bElUwVk019GZQsNeHjMbdQQb7vCTZz1P&' \
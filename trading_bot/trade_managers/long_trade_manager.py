@@ -1,3 +1,4 @@
+import threading
 import uuid
 from datetime import datetime
 
@@ -55,64 +56,101 @@ class TradeManager:
         self.position_status = None
         self.trade_ended = False
         self.position_check = True
+        # Position as of the book version last read, re-read only when it changed
+        self.position, self.position_version = 0, 0
         self.market_depth_check = False
         self.messages = []
+        self.order_futures = dict()
+        # Set by the controller, called with this manager when one of its orders settles
+        self.wake = None
+        self.lock = threading.Lock()
+        self.snapshot = None
         self.trade_id = str(uuid.uuid4()) if trade_id is None else trade_id
         logger.debug(f"""{trading_mode} Trading bot {self.symbol} instance started, parameters: unique ID: {self.id}, 
                          position limit: {self.pos_limit} USD, target : {self.target}, stop loss: {self.stop_loss},
                          trade_id: {self.trade_id}""")
 
+        if self.entered and not self.entry_order_filled:
+            self.watch_order(self.entry_order_id)
+        if self.entered and self.exit_pending:
+            self.watch_order(self.sl_exit_order_id)
+            self.watch_order(self.tr_exit_order_id)
+
     def __repr__(self):
         return f"trading_mode: {self.trading_mode}, id: {self.id}, instrument: {self.symbol}, trade_id: {self.trade_id}"
 
-    def trade(self):
+    def trade(self, snapshot=None):
+        # snapshot is the client view the controller took for this round, shared by all the managers
+        with self.lock:
+            if snapshot is None:
+                snapshot = self.client.snapshot()
+            # A run woken by a fill may already have seen a newer view than the round's
+            if self.snapshot is None or snapshot.version >= self.snapshot.version:
+                self.snapshot = snapshot
+            return self._trade()
+
+    def _trade(self):
         if self.trade_ended:
-            return self
-
-        self.messages = []
+            return self.drain_messages() if self.messages else self
 
         if not self.entered:
             if self.ltp is None:
-                ltp_data = self.client.ltp_data[self.id].get() if not self.client.ltp_data[self.id].empty() else {}
-                self.ltp = ltp_data.get('ltp')
-
-                if self.ltp is None:
+                latest = self.snapshot.latest_tick(self.id)
+                if latest is None:
                     return
+                self.ltp = latest['price']
+                self.ltp_time = datetime.fromtimestamp(latest['time']).astimezone(TZ)
                 self.client.cancelTickByTickData(self.id)
 
         if self.is_valid_entry():
             self.make_entry()
 
-        if self.entered and not self.entry_order_filled:
+        if self.entered and not self.entry_order_filled and self.order_settled(self.entry_order_id):
             self.confirm_entry()
 
         if self.is_valid_exit():
             self.make_exit()
 
-        if self.entered and self.exit_pending:
+        if self.entered and self.exit_pending and \
+                (self.order_settled(self.sl_exit_order_id) or self.order_settled(self.tr_exit_order_id)):
             self.confirm_exit()
 
-        return {'msg': self.messages}
+        return self.drain_messages()
+
+    def drain_messages(self):
+        messages, self.messages = self.messages, []
+        return {'msg': messages}
+
+    def order_settled(self, order_id):
+        future = self.order_futures.get(order_id)
+        return future is None or future.done()
+
+    def watch_order(self, order_id):
+        if order_id is not None:
+            self.order_futures[order_id] = self.client.order_book.watch(order_id, callback=self.on_order_update)
+
+    def on_order_update(self, future):
+        # Runs on the IB thread, only asks the controller to run trade() now rather than on its next round
+        if self.wake is not None:
+            self.wake(self)
 
     def is_valid_entry(self):
         if self.entered:
             return False
 
-        if not self.market_depth_check and not len(self.client.l2_data[self.id]) > 100:
+        depth = self.snapshot.depth_metrics(self.id)
+        if not self.market_depth_check and (depth is None or not depth['updates'] > 100):
             return
-        # print(self.symbol, len(self.client.l2_data[self.id]), self.client.l2_data[self.id][:5])
 
         end_trade = False
 
         if not self.market_depth_check:
-            bids = [i for i in self.client.l2_data[self.id] if i['side'] == 1]
-            asks = [i for i in self.client.l2_data[self.id] if i['side'] == 0]
-            bid_length = len(bids)
-            ask_length = len(asks)
-            bid_size = sum([i['size'] for i in bids])
-            ask_size = sum([i['size'] for i in asks])
-            bid_price_level = sum([i['price'] for i in bids]) / bid_length
-            ask_price_level = sum([i['price'] for i in asks]) / ask_length
+            bid_length = depth['bid_levels']
+            ask_length = depth['ask_levels']
+            bid_size = depth['bid_size']
+            ask_size = depth['ask_size']
+            bid_price_level = depth['bid_price_level']
+            ask_price_level = depth['ask_price_level']
 
             if self.instruction == 'BUY':
                 if bid_length < ask_length:
@@ -164,6 +202,12 @@ class TradeManager:
             self.instruction = 'SELL'
             return True
 
+    def current_position(self):
+        if self.snapshot.changed_since(self.position_version, self.symbol):
+            pos = self.snapshot.positions[self.symbol]
+            self.position, self.position_version = pos['position'], pos['version']
+        return self.position
+
     def is_valid_exit(self):
         if not self.entered or not self.entry_order_filled or self.exit_pending:
             return False
@@ -172,10 +216,9 @@ class TradeManager:
 
         if self.bought:
             if self.position_check:
-                for pos in self.client.positions:
-                    if pos['symbol'] == self.symbol and pos['position'] >= self.qty:
-                        self.instruction = 'SELL'
-                        return True
+                if self.current_position() >= self.qty:
+                    self.instruction = 'SELL'
+                    return True
                 else:
                     logger.debug(f'{self.symbol} No long position exist for qty: {self.qty}')
                     close_entry_in_db = True
@@ -186,10 +229,9 @@ class TradeManager:
 
         elif self.sold:
             if self.position_check:
-                for pos in self.client.positions:
-                    if pos['symbol'] == self.symbol and pos['position'] <= -self.qty:
-                        self.instruction = 'BUY'
-                        return True
+                if self.current_position() <= -self.qty:
+                    self.instruction = 'BUY'
+                    return True
                 else:
                     logger.debug(f'{self.symbol} No short position exist for qty: {self.qty}')
                     close_entry_in_db = True
@@ -202,7 +244,7 @@ class TradeManager:
             self.exit_type, self.exit_time, self.exit_price = None, None, None
             self.sl_exit_order_status, self.tr_exit_order_status, self.position_status = None, None, None
             self.entered, self.bought, self.sold, self.exit_pending = False, False, False, False
-            self.client.open_stocks_limit += 1
+            self.client.position_slots.release()
             confirm_exit_data = self.save_trade(action='confirm_exit')
             self.messages.append(confirm_exit_data)
             self.trade_ended = True
@@ -222,12 +264,11 @@ class TradeManager:
             self.trade_ended = True
             return
 
-        if self.client.open_stocks_limit <= 0:
+        if not self.client.position_slots.acquire():
             # logger.debug(f'{self.symbol}, stocks limit is reached so ignoring entry')
             return
 
-        self.client.nextorderId += 1
-        self.entry_order_id = self.client.nextorderId
+        self.entry_order_id = self.client.next_order_id()
         self.client.placeOrder(self.entry_order_id, self.contract,
                                self.client.make_order(self.instruction, self.qty,
                                                       order_type=self.entry_order_type, price=price))
@@ -238,11 +279,6 @@ class TradeManager:
         self.entry_order_filled = False
         self.entry_order_status = 'OPEN'
 
-        # Update account balance after taking position
-        self.client.reqAccountSummary(9002, "All", "$LEDGER")
-
-        self.client.open_stocks_limit -= 1
-
         logger.debug(f"""Entry order Placed to {self.instruction} {self.qty} {self.symbol}, 
                          price: {self.entry_order_price}, time:{self.entry_order_time}, 
                          order id: {self.entry_order_id}""")
@@ -250,15 +286,12 @@ class TradeManager:
         logger.debug(f'{self.symbol} Instance, new trade_id: {self.trade_id}')
         entry_data = self.save_trade(action='make_entry')
         self.messages.append(entry_data)
+        self.watch_order(self.entry_order_id)
 
     def make_exit(self):
-        self.client.nextorderId += 1
-        oco_id = str(self.client.nextorderId)
-
-        self.client.nextorderId += 1
-        self.tr_exit_order_id = self.client.nextorderId
-        self.client.nextorderId += 1
-        self.sl_exit_order_id = self.client.nextorderId
+        oco_id = str(self.client.next_order_id())
+        self.tr_exit_order_id = self.client.next_order_id()
+        self.sl_exit_order_id = self.client.next_order_id()
 
         self.tr_exit_order_price = float("{:0.2f}".format(self.tr))
         self.sl_exit_order_price = float("{:0.2f}".format(self.sl))
@@ -288,57 +321,57 @@ class TradeManager:
                          Target order time time:{self.tr_exit_order_time}, Target order id: {self.tr_exit_order_id}""")
         exit_data = self.save_trade(action='make_exit')
         self.messages.append(exit_data)
+        self.watch_order(self.tr_exit_order_id)
+        self.watch_order(self.sl_exit_order_id)
 
     def confirm_entry(self):
-        for exec_order in self.client.exec_orders:
-            if str(exec_order['exec_order_id']) == str(self.entry_order_id) and exec_order['symbol'] == self.symbol:
-                self.entry_price = exec_order['exec_avg_price']
-                self.entry_time = exec_order['exec_time']
-                self.entry_order_filled = True
-                self.entry_order_status = 'FILLED'
-                self.position_status = 'OPEN'
-                if self.bought:
-                    self.tr = self.entry_price * (1 + (self.target / 100))
-                    self.sl = self.entry_price * (1 - (self.stop_loss / 100))
-                else:
-                    self.tr = self.entry_price * (1 - (self.target / 100))
-                    self.sl = self.entry_price * (1 + (self.stop_loss / 100))
-                logger.debug(
-                    f"Entry order Filled to {self.instruction} {self.symbol}, price: {self.entry_price},"
-                    f" qty:{self.qty}, time:{self.entry_time}, SL: {self.sl}, Target: {self.tr}")
-                entry_data = self.save_trade(action='confirm_entry')
-                self.position_check = False
-                self.messages.append(entry_data)
-                return
+        exec_order = self.snapshot.get_execution(self.entry_order_id, self.symbol)
+        if exec_order is not None:
+            self.entry_price = exec_order['exec_avg_price']
+            self.entry_time = exec_order['exec_time']
+            self.entry_order_filled = True
+            self.entry_order_status = 'FILLED'
+            self.position_status = 'OPEN'
+            if self.bought:
+                self.tr = self.entry_price * (1 + (self.target / 100))
+                self.sl = self.entry_price * (1 - (self.stop_loss / 100))
+            else:
+                self.tr = self.entry_price * (1 - (self.target / 100))
+                self.sl = self.entry_price * (1 + (self.stop_loss / 100))
+            logger.debug(
+                f"Entry order Filled to {self.instruction} {self.symbol}, price: {self.entry_price},"
+                f" qty:{self.qty}, time:{self.entry_time}, SL: {self.sl}, Target: {self.tr}")
+            entry_data = self.save_trade(action='confirm_entry')
+            self.position_check = False
+            self.messages.append(entry_data)
+            return
 
-        for order in self.client.orders:
-            if str(order['order_id']) == str(self.entry_order_id) and order['status'] in ['Cancelled', 'Inactive']:
-                logger.debug(f'{self.symbol} Entry order to {self.instruction} {order["status"]}')
-                self.entered = False
-                self.bought, self.sold = False, False
-                self.entry_time = None
-                self.entry_price = None
-                self.tr = None
-                self.sl = None
-                self.entry_order_status = order['status']
-                self.position_status = None
-
-                self.client.open_stocks_limit += 1
-                entry_data = self.save_trade(action='confirm_entry')
-                self.messages.append(entry_data)
-                self.trade_ended = True
-                logger.info(f'{self.symbol}, Entry order cancelled, Closing instance')
-                return
+        order = self.snapshot.get_status(self.entry_order_id)
+        if order is not None and order['status'] in ['Cancelled', 'Inactive']:
+            logger.debug(f'{self.symbol} Entry order to {self.instruction} {order["status"]}')
+            self.entered = False
+            self.bought, self.sold = False, False
+            self.entry_time = None
+            self.entry_price = None
+            self.tr = None
+            self.sl = None
+            self.entry_order_status = order['status']
+            self.position_status = None
+
+            self.client.position_slots.release()
+            entry_data = self.save_trade(action='confirm_entry')
+            self.messages.append(entry_data)
+            self.trade_ended = True
+            logger.info(f'{self.symbol}, Entry order cancelled, Closing instance')
+            return
 
     def confirm_exit(self):
-        for exec_order in self.client.exec_orders:
-            if exec_order['symbol'] != self.symbol:
-                continue
-            exec_order_id = str(exec_order['exec_order_id'])
-            if exec_order_id == str(self.sl_exit_order_id) or exec_order_id == str(self.tr_exit_order_id):
+        for exec_order_id in [self.sl_exit_order_id, self.tr_exit_order_id]:
+            exec_order = self.snapshot.get_execution(exec_order_id, self.symbol)
+            if exec_order is not None:
                 self.exit_price = exec_order['exec_avg_price']
                 self.exit_time = exec_order['exec_time']
-                if exec_order_id == str(self.sl_exit_order_id):
+                if exec_order_id == self.sl_exit_order_id:
                     self.exit_type = 'SL'
                     self.sl_exit_order_status = 'FILLED'
                     self.tr_exit_order_status = 'CANCELED'
@@ -351,7 +384,7 @@ class TradeManager:
                 self.exit_order_filled = True
                 self.entered = False
                 self.exit_pending = False
-                self.client.open_stocks_limit += 1
+                self.client.position_slots.release()
                 logger.debug(f"""Exit {self.exit_type} order Filled to {self.instruction} {self.qty} {self.symbol}, 
                                  price: {self.exit_price}, time:{self.exit_time}, order id: {self.sl_exit_order_id}""")
                 exit_data = self.save_trade(action='confirm_exit')
@@ -362,12 +395,11 @@ class TradeManager:
 
         order_cancelled = 0
         order_status = None
-        for order in self.client.orders:
-            order_id = str(order['order_id'])
-            if order_id == str(self.sl_exit_order_id) or order_id == str(self.tr_exit_order_id):
-                if order['status'] in ['Cancelled', 'Inactive']:
-                    order_cancelled += 1
-                    order_status = order['status']
+        for order_id in [self.sl_exit_order_id, self.tr_exit_order_id]:
+            order = self.snapshot.get_status(order_id)
+            if order is not None and order['status'] in ['Cancelled', 'Inactive']:
+                order_cancelled += 1
+                order_status = order['status']
 
         if order_cancelled == 2:
             logger.debug(f'{self.symbol} Exit order to {self.instruction}, status: {order_status}')
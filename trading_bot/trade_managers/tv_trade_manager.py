@@ -56,17 +56,15 @@ class TvTradeManager:
             if self.short_allowed:
                 return True
             else:
-                for pos in self.client.positions:
-                    if pos['symbol'] == self.symbol and pos['position'] >= self.quantity:
-                        self.instruction = 'SELL'
-                        return True
+                if self.client.position_book.position(self.symbol, self.contract.conId) >= self.quantity:
+                    self.instruction = 'SELL'
+                    return True
                 else:
                     logger.debug(f'{self.symbol} No long position exist for qty: {self.quantity}')
 
     def make_entry(self):
         self.order_price = float("{:0.2f}".format(self.order_price))
-        self.client.nextorderId += 1
-        self.order_id = self.client.nextorderId
+        self.order_id = self.client.next_order_id()
         self.client.placeOrder(self.order_id, self.contract,
                                self.client.make_order(self.instruction, self.quantity, order_type=self.order_type,
                                                       price=self.order_price))
@@ -74,29 +72,26 @@ class TvTradeManager:
         self.order_status = 'Open'
         self.entered = True
 
-        # Update account balance after taking position
-        self.client.reqAccountSummary(9002, "All", "$LEDGER")
-
         logger.debug(
             f"Order Placed to {self.instruction} {self.symbol}, price: {self.order_price}, quantity:{self.quantity}, "
             f"time:{self.order_time}, order id: {self.order_id}")
 
     def confirm_entry(self):
-        for exec_order in self.client.exec_orders:
-            if str(exec_order['exec_order_id']) == str(self.order_id) and exec_order['symbol'] == self.symbol:
-                self.entry_price = exec_order['exec_avg_price']
-                self.entry_time = exec_order['exec_time']
-                self.order_status = 'Filled'
-                logger.debug(
-                    f"Order Filled to {self.instruction} {self.symbol}, price: {self.entry_price},"
-                    f" qty:{self.quantity}, time:{self.entry_time}")
-                return
+        exec_order = self.client.order_book.get_execution(self.order_id, self.symbol)
+        if exec_order is not None:
+            self.entry_price = exec_order['exec_avg_price']
+            self.entry_time = exec_order['exec_time']
+            self.order_status = 'Filled'
+            logger.debug(
+                f"Order Filled to {self.instruction} {self.symbol}, price: {self.entry_price},"
+                f" qty:{self.quantity}, time:{self.entry_time}")
+            return
 
-        for order in self.client.orders:
-            if str(order['order_id']) == str(self.order_id):
-                self.order_status = order['status']
-                logger.debug(f'{self.symbol} Order to {self.instruction} {order["status"]}')
-                return
+        order = self.client.order_book.get_status(self.order_id)
+        if order is not None:
+            self.order_status = order['status']
+            logger.debug(f'{self.symbol} Order to {self.instruction} {order["status"]}')
+            return
 
     def save_trade(self):
         obj = TradesData(symbol=self.symbol, instruction=self.instruction,